@@ -0,0 +1,57 @@
+"""Compares the per-stream RecordSelector with singer's Transformer.filter_data_by_metadata on
+a wide Heap event table, and checks that both produce the same records.
+
+    pip install -e .
+    python benchmarks/bench_record_filter.py [--columns 300] [--selected 30] [--rows 20000]
+"""
+import argparse
+import time
+
+from singer import metadata
+from singer import Transformer
+
+from tap_heap.discover import load_metadata
+from tap_heap.schema import generate_fake_schema
+from tap_heap.sync import RecordSelector
+
+
+def build_stream(columns, selected):
+    schema = generate_fake_schema(['event_id'] + [f'property_{i}' for i in range(columns - 1)])
+    mdata = metadata.to_map(load_metadata('pageviews', schema))
+    for i, field_name in enumerate(schema['properties']):
+        mdata = metadata.write(mdata, ('properties', field_name), 'selected', i < selected)
+    return {'stream': 'pageviews', 'metadata': metadata.to_list(mdata)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--columns', type=int, default=300)
+    parser.add_argument('--selected', type=int, default=30)
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args()
+
+    stream = build_stream(args.columns, args.selected)
+    field_names = ['event_id'] + [f'property_{i}' for i in range(args.columns - 1)]
+    rows = [{name: f'{name}-{i}' for name in field_names} for i in range(args.rows)]
+
+    mdata = metadata.to_map(stream['metadata'])
+    start = time.perf_counter()
+    with Transformer() as transformer:
+        expected = [transformer.filter_data_by_metadata(dict(row), mdata) for row in rows]
+    transformer_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    select_fields = RecordSelector(stream).compile(field_names)
+    actual = [select_fields(row) for row in rows]
+    selector_seconds = time.perf_counter() - start
+
+    assert actual == expected, "RecordSelector output differs from the Transformer"
+
+    print(f"{args.rows} rows, {args.columns} columns, {args.selected} selected")
+    print(f"Transformer.filter_data_by_metadata: {args.rows / transformer_seconds:12.0f} rows/s")
+    print(f"RecordSelector:                      {args.rows / selector_seconds:12.0f} rows/s")
+    print(f"Speedup: {transformer_seconds / selector_seconds:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
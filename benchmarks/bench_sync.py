@@ -0,0 +1,192 @@
+"""Measures sync throughput offline on synthetic Heap dumps. Generates Heap style manifests and
+Avro part files of the given size and width, reads them through the local storage backend in
+place of S3, and reports records per second and peak RSS of `sync_file`, `sync_stream` and
+`do_sync` for each worker count. Every case runs in its own process so peak RSS is measured per
+case. Records are written to /dev/null.
+
+    pip install -e .
+    python benchmarks/bench_sync.py [--tables 2] [--dumps 2] [--files 4] [--rows 20000]
+                                    [--columns 50] [--codec snappy] [--workers 1,2,4]
+                                    [--cases sync_file,sync_stream,do_sync] [--data DIR]
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import fastavro
+
+import tap_heap
+from tap_heap import consumer
+from tap_heap import manifest
+from tap_heap import sync
+from tap_heap.discover import discover_streams
+from tap_heap.storage import LocalStorage
+
+BUCKET = 'bench-bucket'
+
+
+def build_avro_schema(columns):
+    fields = [{'name': 'event_id', 'type': 'long'},
+              {'name': 'user_id', 'type': ['null', 'long']},
+              {'name': 'time', 'type': ['null', 'string']}]
+    for i in range(columns - len(fields)):
+        fields.append({'name': f'property_{i}',
+                       'type': ['null', ['string', 'long', 'double', 'boolean'][i % 4]]})
+    return {'type': 'record', 'name': 'topLevelRecord', 'fields': fields}
+
+
+def generate_rows(avro_schema, count, first_event_id):
+    values = {'string': lambda i: f'value-{i % 997}', 'long': lambda i: i,
+              'double': lambda i: i / 7, 'boolean': lambda i: i % 2 == 0}
+    field_types = [(field['name'], field['type'][1] if isinstance(field['type'], list)
+                    else field['type']) for field in avro_schema['fields']]
+    for event_id in range(first_event_id, first_event_id + count):
+        row = {name: values[typ](event_id) if random.random() > 0.2 else None
+               for name, typ in field_types}
+        row['event_id'] = event_id
+        yield row
+
+
+def generate_dumps(directory, args):
+    """Writes `manifests/sync_N.json` and `sync_N/{table}/part-*.avro` like a Heap bucket."""
+    avro_schema = build_avro_schema(args.columns)
+    os.makedirs(os.path.join(directory, 'manifests'), exist_ok=True)
+    event_id = 0
+    for dump_id in range(1, args.dumps + 1):
+        tables = []
+        for table_index in range(args.tables):
+            table_name = f'table_{table_index}'
+            os.makedirs(os.path.join(directory, f'sync_{dump_id}', table_name), exist_ok=True)
+            files = []
+            for part in range(args.files):
+                key = f'sync_{dump_id}/{table_name}/part-{part:05d}-bench-c000.avro'
+                with open(os.path.join(directory, key), 'wb') as avro_file:
+                    fastavro.writer(avro_file, avro_schema,
+                                    generate_rows(avro_schema, args.rows, event_id),
+                                    codec=args.codec)
+                event_id += args.rows
+                files.append(f's3://{BUCKET}/{key}')
+            tables.append({'name': table_name, 'files': files, 'incremental': dump_id > 1,
+                           'columns': [field['name'] for field in avro_schema['fields']]})
+
+        with open(os.path.join(directory, 'manifests', f'sync_{dump_id}.json'), 'w',
+                  encoding='utf-8') as manifest_file:
+            json.dump({'dump_id': dump_id, 'tables': tables, 'property_definitions': {}},
+                      manifest_file)
+
+
+def get_catalog(storage):
+    streams = discover_streams(storage, {'bucket': BUCKET})
+    for stream in streams:
+        stream['metadata'][0]['metadata']['selected'] = True
+    return {'streams': sorted(streams, key=lambda stream: stream['stream'])}
+
+
+@contextlib.contextmanager
+def stdout_to_devnull():
+    """Sends what the tap writes to stdout, from this process and its children, to /dev/null."""
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_stdout, 1)
+        os.close(devnull)
+        os.close(saved_stdout)
+
+
+def run_sync_file(storage, stream, manifests, _workers, _rows):
+    s3_path = sync.remove_prefix(manifests[1][stream['stream']]['files'][0], BUCKET)
+    consumer_process = sync.multiprocessing.Process(target=consumer.run_consumer,
+                                                    args=(consumer.open_ipc(),))
+    consumer_process.start()
+    try:
+        return sync.sync_file(storage, s3_path, stream).records
+    finally:
+        consumer.MessageGate().put(consumer.EndOfRecords())
+        consumer_process.join()
+
+
+def run_sync_stream(storage, stream, manifests, workers, _rows):
+    return sync.sync_stream(storage, {}, stream, manifests, workers, {'max_workers': workers})
+
+
+def run_do_sync(storage, _stream, manifests, workers, rows):
+    tap_heap.do_sync({'bucket': BUCKET, 'local_directory': storage.directory,
+                      'max_workers': workers}, get_catalog(storage), {})
+    return rows * sum(len(table['files']) for dump in manifests.values()
+                      for table in dump.values())
+
+
+CASES = {'sync_file': run_sync_file, 'sync_stream': run_sync_stream, 'do_sync': run_do_sync}
+
+
+def run_case(directory, case, workers, rows):
+    storage = LocalStorage(BUCKET, directory)
+    catalog = get_catalog(storage)
+    manifests = manifest.generate_manifests(storage)
+
+    with stdout_to_devnull():
+        start = time.perf_counter()
+        records = CASES[case](storage, catalog['streams'][0], manifests, workers, rows)
+        seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux. The children are the workers and the consumer
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print(json.dumps({'case': case, 'workers': workers, 'records': records,
+                      'seconds': seconds, 'peak_rss_mb': peak_rss / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tables', type=int, default=2)
+    parser.add_argument('--dumps', type=int, default=2)
+    parser.add_argument('--files', type=int, default=4, help='part files per table and dump')
+    parser.add_argument('--rows', type=int, default=20000, help='rows per part file')
+    parser.add_argument('--columns', type=int, default=50)
+    parser.add_argument('--codec', default='snappy')
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--cases', default='sync_file,sync_stream,do_sync')
+    parser.add_argument('--data', help='directory to generate the dumps in, kept afterwards')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case(args.data, args.run_case, int(args.workers), args.rows)
+        return
+
+    with contextlib.ExitStack() as stack:
+        directory = args.data or stack.enter_context(tempfile.TemporaryDirectory())
+        if not os.path.exists(os.path.join(directory, 'manifests')):
+            print(f"Generating {args.dumps * args.tables * args.files} files of {args.rows} rows "
+                  f"and {args.columns} columns in {directory}", file=sys.stderr)
+            generate_dumps(directory, args)
+
+        print(f"{'case':<12} {'workers':>7} {'records':>9} {'seconds':>8} {'records/s':>10} "
+              f"{'peak RSS MB':>11}")
+        for case in args.cases.split(','):
+            # A single file is synced by one worker whatever the pool size
+            for workers in [1] if case == 'sync_file' else args.workers.split(','):
+                output = subprocess.run([sys.executable, __file__, '--run-case', case,
+                                         '--data', directory, '--workers', str(workers),
+                                         '--rows', str(args.rows)],
+                                        check=True, capture_output=True, text=True).stdout
+                result = json.loads(output.splitlines()[-1])
+                print(f"{case:<12} {result['workers']:>7} {result['records']:>9} "
+                      f"{result['seconds']:>8.2f} {result['records'] / result['seconds']:>10.0f} "
+                      f"{result['peak_rss_mb']:>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,9 @@ setup(name='tap-heap',
               'ipdb',
               'pylint',
               'pytest',
+          ],
+          'orjson': [
+              'orjson==3.10.18',
           ]
       },
       entry_points='''
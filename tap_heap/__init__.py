@@ -1,23 +1,26 @@
 import json
 import sys
 
-import botocore
-
 import singer
 from singer import metadata
 
 from tap_heap import manifest
-from tap_heap import s3
-from tap_heap.discover import discover_streams
-from tap_heap.sync import sync_stream
+from tap_heap.config import get_flag
+from tap_heap.file_index import build_file_index
+from tap_heap.storage import get_s3
+from tap_heap.storage import get_storage
 
 LOGGER = singer.get_logger()
 
 REQUIRED_CONFIG_KEYS = ["start_date", "bucket", "account_id", "external_id", "role_name"]
 
+# Discovery and sync import fastavro and multiprocessing, so they are only imported by the mode
+# that runs
 def do_discover(config):
+    from tap_heap.discover import discover_streams    # pylint: disable=import-outside-toplevel
+
     LOGGER.info("Starting discover")
-    streams = discover_streams(config['bucket'])
+    streams = discover_streams(get_storage(config), config)
     if not streams:
         raise Exception("No streams found")     # pylint: disable=broad-exception-raised
     catalog = {"streams": streams}
@@ -30,20 +33,16 @@ def do_discover(config):
 def stream_is_selected(mdata):
     return mdata.get((), {}).get('selected', False)
 
-def manifest_contains_table(manifests, table_name):
-    for mani in manifests.values():
-        if table_name in mani:
-            return True
-
-    return False
 
+def do_sync(config, catalog, state):    # pylint: disable=too-many-locals
+    from tap_heap.sync import get_min_bookmarked_dump_id    # pylint: disable=import-outside-toplevel
+    from tap_heap.sync import sync_streams    # pylint: disable=import-outside-toplevel
 
-def do_sync(config, catalog, state):
     LOGGER.info('Starting sync.')
 
-    bucket = config['bucket']
-    manifests = manifest.generate_manifests(bucket)
+    storage = get_storage(config)
 
+    selected_streams = []
     for stream in catalog['streams']:
         stream_name = stream['tap_stream_id']
         mdata = metadata.to_map(stream['metadata'])
@@ -52,42 +51,63 @@ def do_sync(config, catalog, state):
             LOGGER.info("%s: Skipping - not selected", stream_name)
             continue
 
-        if not manifest_contains_table(manifests, stream_name):
+        selected_streams.append(stream)
+
+    min_dump_id = None
+    if get_flag(config, 'incremental_manifest_listing'):
+        min_dump_id = get_min_bookmarked_dump_id(selected_streams, state)
+        LOGGER.info("Listing manifests from dump %s", min_dump_id or "0")
+    manifests = manifest.generate_manifests(storage, config, min_dump_id)
+    file_index = build_file_index(manifests, storage.bucket)
+
+    streams_to_sync = []
+    for stream in selected_streams:
+        if stream['tap_stream_id'] not in file_index:
             LOGGER.info("Selected table not found in manifests. Skipping")
             continue
 
-        singer.write_state(state)
-        LOGGER.info("%s: Starting sync", stream_name)
-        counter_value = sync_stream(bucket, state, stream, manifests)
+        streams_to_sync.append(stream)
+
+    singer.write_state(state)
+    records_streamed = sync_streams(storage, state, streams_to_sync, manifests, config=config,
+                                    file_index=file_index)
+    for stream_name, counter_value in records_streamed.items():
         LOGGER.info("%s: Completed sync (%s rows)", stream_name, counter_value)
 
     LOGGER.info('Done syncing.')
 
 
-@singer.utils.handle_top_exception(LOGGER)
-def main():
-    args = singer.utils.parse_args(REQUIRED_CONFIG_KEYS)
-
+def setup_s3_access(config):
+    s3 = get_s3()
     try:
         # This should never succeed in production. It exists solely for
         # development purposes where you can't actually assume the target
         # role but can nevertheless initialize your environment such that
         # you have access to the bucket.
         #
-        # We disable expression-not-assigned because we're using this to
-        # duck type whether we have access to the bucket or not.
-        #
-        # pylint: disable=expression-not-assigned
-        next(s3.list_manifest_files_in_bucket(args.config['bucket']))
+        # The probe only asks for a single key, and the listing of the
+        # manifests continues from its page.
+        s3.probe_manifest_files(config['bucket'])
         LOGGER.warning("Able to access manifest files without assuming role!")
-    except botocore.exceptions.ClientError:
+    except s3.ClientError:
         # Check if proxy_account_id and proxy_role_name are in config
-        if 'proxy_account_id' in args.config and 'proxy_role_name' in args.config:
+        if 'proxy_account_id' in config and 'proxy_role_name' in config:
             # If both are present, call setup_aws_client_with_proxy
-            s3.setup_aws_client_with_proxy(args.config)
+            s3.setup_aws_client_with_proxy(config)
         else:
             # Otherwise, call setup_aws_client
-            s3.setup_aws_client(args.config)
+            s3.setup_aws_client(config)
+
+
+@singer.utils.handle_top_exception(LOGGER)
+def main():
+    args = singer.utils.parse_args(REQUIRED_CONFIG_KEYS)
+
+    # A local copy of the bucket needs no AWS access
+    if args.config.get('local_directory'):
+        LOGGER.info("Reading the dumps from %s", args.config['local_directory'])
+    else:
+        setup_s3_access(args.config)
 
     if args.discover:
         do_discover(args.config)
@@ -0,0 +1,213 @@
+import io
+import json
+
+import fastavro
+from fastavro.read import HEADER_SCHEMA
+
+AVRO_MAGIC = b'Obj\x01'
+SYNC_SIZE = 16
+SCAN_SIZE = 64 * 1024
+# The header is read with ranged reads of these sizes until one holds all of it
+HEADER_READ_SIZES = (64 * 1024, 1024 * 1024, None)
+# Avro writers end a block every 64 KB or so by default, so a byte range is read this far past
+# its end to finish its last block, and further only if that block is larger
+BLOCK_READ_AHEAD = 256 * 1024
+
+
+class RecordingReader():
+    """Keeps a copy of everything read through it, so the header bytes can be replayed."""
+
+    def __init__(self, fo):
+        self.fo = fo
+        self.recorded = bytearray()
+
+    def read(self, size=-1):
+        data = self.fo.read(size)
+        self.recorded += data
+        return data
+
+
+class ChainedStream():
+    """Reads `prefix` and then `fo` as one stream. This lets an Avro header that was read on its
+    own be put back in front of the rest of the file for fastavro."""
+
+    def __init__(self, prefix, fo):
+        self.prefix = io.BytesIO(prefix)
+        self.prefix_size = len(prefix)
+        self.fo = fo
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.prefix.read(size)
+        if size < 0:
+            data += self.fo.read()
+        elif len(data) < size:
+            data += self.fo.read(size - len(data))
+
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+
+class RangedStream():
+    """Reads a file from `offset` through `open_stream`, starting with a ranged read of `length`
+    bytes and doubling the length of each further one, so a byte range is not fetched much past
+    where its decoding stops. Each further read starts a byte early, so it always starts inside
+    the file, even when the file ends where the previous read did."""
+
+    def __init__(self, open_stream, offset, length):
+        self.open_stream = open_stream
+        self.position = offset
+        self.length = length
+        self.fo = open_stream(offset, length)
+        self.left = length
+        self.at_end = False
+
+    def _read_further(self):
+        self.fo.close()
+        self.length *= 2
+        self.fo = self.open_stream(self.position - 1, self.length + 1)
+        self.fo.read(1)
+        self.left = self.length
+
+    def read(self, size=-1):
+        data = b''
+        while not self.at_end and (size < 0 or len(data) < size):
+            if not self.left:
+                self._read_further()
+
+            read = self.fo.read(self.left if size < 0 else min(size - len(data), self.left))
+            if not read:
+                self.at_end = True
+            data += read
+            self.position += len(read)
+            self.left -= len(read)
+        return data
+
+    def close(self):
+        self.fo.close()
+
+
+def read_header(fo):
+    """Reads the Avro container header from the start of `fo`. Returns the decoded header and
+    the raw bytes it was read from."""
+    recorder = RecordingReader(fo)
+    try:
+        header = fastavro.schemaless_reader(recorder, HEADER_SCHEMA)
+    except EOFError as ex:
+        raise ValueError("Cannot read the Avro header") from ex
+
+    if header['magic'] != AVRO_MAGIC:
+        raise ValueError("Not an Avro object container file")
+    return header, bytes(recorder.recorded)
+
+
+def read_bounded_header(open_stream):
+    """Reads the Avro container header with ranged reads from `open_stream(offset, length)`,
+    so only the start of the file is fetched. Returns the decoded header and its raw bytes."""
+    for length in HEADER_READ_SIZES:
+        fo = open_stream(0, length)
+        try:
+            return read_header(fo)
+        except ValueError:
+            if length is None:
+                raise
+        finally:
+            fo.close()
+    return None
+
+
+def get_writer_schema(header):
+    return json.loads(header['meta']['avro.schema'])
+
+
+def project_schema(writer_schema, excluded_fields):
+    """Returns a reader schema for `writer_schema` without `excluded_fields`. fastavro skips over
+    the fields that are missing from the reader schema instead of decoding them."""
+    return dict(writer_schema,
+                fields=[field for field in writer_schema['fields']
+                        if field['name'] not in excluded_fields])
+
+
+def get_reader_schema(writer_schema, excluded_fields):
+    """Returns the projected reader schema, or None if no field needs to be left out."""
+    if any(field['name'] in excluded_fields for field in writer_schema['fields']):
+        return project_schema(writer_schema, excluded_fields)
+    return None
+
+
+def find_block_start(fo, sync_marker, offset):
+    """Scans `fo`, which reads the file from `offset`, for the first sync marker. Returns the
+    offset of the block that follows the marker along with the bytes of that block that were
+    already read, or None if the file ends first."""
+    window = b''
+    while True:
+        data = fo.read(SCAN_SIZE)
+        if not data:
+            return None, b''
+
+        window += data
+        position = window.find(sync_marker)
+        if position >= 0:
+            block_start = position + SYNC_SIZE
+            return offset + block_start, window[block_start:]
+
+        # Keep enough of the tail to match a marker split across two reads
+        keep_from = max(len(window) - (SYNC_SIZE - 1), 0)
+        offset += keep_from
+        window = window[keep_from:]
+
+
+def iter_blocks(header_bytes, fo, offset, reader_schema=None, end=None):
+    """Yields `(offset, block)` for the blocks of the file read by `fo`, which must be positioned
+    at the block starting at `offset`. Stops before the first block starting at or after `end`,
+    so a byte range of the file yields exactly the blocks that start inside it."""
+    for block in fastavro.block_reader(ChainedStream(header_bytes, fo), reader_schema):
+        block_offset = offset + block.offset - len(header_bytes)
+        if end is not None and block_offset >= end:
+            return
+        yield block_offset, block
+
+
+def open_range(open_stream, offset, end):
+    """Returns a file object reading the file from `offset`, to its end or, for a byte range
+    ending at `end`, only about as far as the blocks starting before `end` go."""
+    if end is None:
+        return open_stream(offset)
+    return RangedStream(open_stream, offset, end - offset + BLOCK_READ_AHEAD)
+
+
+def read_blocks(open_stream, excluded_fields=(), byte_range=None):
+    """Opens an Avro file for decoding, either whole or only the blocks that start inside
+    `byte_range`. `open_stream(offset, length=None)` must return a file object reading the file
+    from `offset`, for `length` bytes or to its end. Returns the writer schema, the reader schema
+    without `excluded_fields` (None if nothing is left out) and an iterator of
+    `(offset, block)`."""
+    start, end = byte_range or (0, None)
+
+    if start > 0:
+        # Blocks are found by their preceding sync marker, which ends at or after `start` for
+        # any block starting inside the range
+        header, header_bytes = read_bounded_header(open_stream)
+        scan_from = max(start - SYNC_SIZE, 0)
+        fo = open_range(open_stream, scan_from, end)
+        block_start, prefix = find_block_start(fo, header['sync'], scan_from)
+    else:
+        fo = open_range(open_stream, 0, end)
+        header, header_bytes = read_header(fo)
+        block_start, prefix = len(header_bytes), b''
+
+    writer_schema = get_writer_schema(header)
+    reader_schema = get_reader_schema(writer_schema, excluded_fields)
+
+    def blocks():
+        try:
+            if block_start is not None and (end is None or block_start < end):
+                yield from iter_blocks(header_bytes, ChainedStream(prefix, fo), block_start,
+                                       reader_schema, end)
+        finally:
+            fo.close()
+
+    return writer_schema, reader_schema, blocks()
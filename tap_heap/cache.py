@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import singer
+
+LOGGER = singer.get_logger()
+
+DEFAULT_MANIFEST_CACHE_MAX_MB = 512
+
+
+class ManifestCache():
+    """On-disk cache of parsed manifests. Heap never rewrites a manifest once it is written, so an
+    entry keyed by the object's key and ETag stays valid for as long as it is kept. The least
+    recently used entries are evicted once the cache grows past `max_bytes`."""
+
+    def __init__(self, directory, max_bytes=DEFAULT_MANIFEST_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, version):
+        digest = hashlib.sha256(f"{key}\0{version}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def get(self, key, version):
+        path = self._path(key, version)
+        try:
+            with open(path, encoding='utf-8') as cache_file:
+                manifest = json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            LOGGER.warning("Discarding unreadable manifest cache entry for %s", key)
+            self._remove(path)
+            return None
+
+        # Bump the modification time so eviction drops the least recently used entries first
+        os.utime(path)
+        return manifest
+
+    def put(self, key, version, manifest):
+        # Write to a temporary file and rename it so concurrent readers never see a partial entry
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w', encoding='utf-8') as temp_file:
+                json.dump(manifest, temp_file)
+            os.replace(temp_path, self._path(key, version))
+        except OSError:
+            LOGGER.warning("Unable to cache manifest %s", key)
+            self._remove(temp_path)
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_manifest_cache(config):
+    """Returns the manifest cache configured by `manifest_cache_dir`, or None if caching is off."""
+    directory = config.get('manifest_cache_dir')
+    if not directory:
+        return None
+
+    max_mb = int(config.get('manifest_cache_max_mb', DEFAULT_MANIFEST_CACHE_MAX_MB))
+    return ManifestCache(directory, max_mb * 1024 * 1024)
@@ -0,0 +1,204 @@
+from concurrent import futures
+import glob
+import hashlib
+import os
+import shutil
+import sqlite3
+
+import singer
+
+from tap_heap.file_index import get_file_key
+from tap_heap.file_index import get_file_sort_key
+
+LOGGER = singer.get_logger()
+
+DEFAULT_CHANGE_INDEX_CACHE_MB = 64
+DIGEST_SIZE = 16
+STAGED_ENTRY_SIZE = 2 * DIGEST_SIZE
+
+
+def get_digest(value):
+    return hashlib.blake2b(repr(value).encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+
+def get_staged_path(staging_directory, s3_path, byte_range):
+    start = byte_range[0] if byte_range else 0
+    return os.path.join(staging_directory, f"{s3_path.replace('/', '__')}@{start}.changes")
+
+
+class ChangeIndex():
+    """On-disk index of a stream from the digest of each row's key properties to the digest of
+    its content, and the file that last wrote it. It lets a full dump emit only the rows that
+    are new or changed since the rows the index has seen.
+
+    Workers look rows up without writing to the index. The rows they emit are staged in a file
+    per unit of work and only merged, in file order, once every file before theirs is complete,
+    on a background thread so the main process keeps scheduling units meanwhile. The `file`
+    bookmark only moves past a file once its rows are merged, so the index never holds rows of
+    a file that a resumed sync will read again. A resumed sync
+    may still find rows of files past its `file` bookmark, if a STATE was lost after the merge,
+    and `ChangeFilter` treats those as unseen."""
+
+    def __init__(self, directory, table_name, cache_mb=DEFAULT_CHANGE_INDEX_CACHE_MB):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{table_name}.sqlite')
+        self.staging_directory = os.path.join(directory, f'{table_name}.staged')
+        self.cache_mb = cache_mb
+        # Merges run one at a time, in the order they were started
+        self.merger = futures.ThreadPoolExecutor(max_workers=1)
+
+    def reset(self):
+        for path in [self.path, self.path + '-wal', self.path + '-shm']:
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(self.staging_directory, ignore_errors=True)
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute(f'PRAGMA cache_size = -{self.cache_mb * 1024}')
+        # Workers keep reading while the main process merges
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, '
+                           'path TEXT UNIQUE)')
+        connection.execute('CREATE TABLE IF NOT EXISTS rows (key BLOB PRIMARY KEY, hash BLOB, '
+                           'file_id INTEGER) WITHOUT ROWID')
+        return connection
+
+    def prepare(self, files):
+        """Creates the index and drops what was staged for files that are no longer synced, by
+        a run that failed before their dump was replaced."""
+        self.connect().close()
+        os.makedirs(self.staging_directory, exist_ok=True)
+        staged_prefixes = {s3_path.replace('/', '__') for s3_path in files}
+        for name in os.listdir(self.staging_directory):
+            if name.rsplit('@', 1)[0] not in staged_prefixes:
+                os.remove(os.path.join(self.staging_directory, name))
+
+    def commit_files(self, files):
+        """Merges the rows staged for `files`, in file order, into the index."""
+        connection = self.connect()
+        try:
+            with connection:
+                for s3_path in files:
+                    connection.execute('INSERT OR IGNORE INTO files (path) VALUES (?)', (s3_path,))
+                    file_id = connection.execute('SELECT id FROM files WHERE path = ?',
+                                                 (s3_path,)).fetchone()[0]
+                    for staged_path in self.get_staged_paths(s3_path):
+                        connection.executemany(
+                            'INSERT OR REPLACE INTO rows VALUES (?, ?, ?)',
+                            ((key, row_hash, file_id)
+                             for key, row_hash in read_staged_rows(staged_path)))
+        finally:
+            connection.close()
+
+        for s3_path in files:
+            for staged_path in self.get_staged_paths(s3_path):
+                os.remove(staged_path)
+
+    def merge_files(self, files):
+        """Commits `files` on the background thread and returns the future of the merge."""
+        return self.merger.submit(self.commit_files, files)
+
+    def close(self):
+        self.merger.shutdown()
+
+    def get_staged_paths(self, s3_path):
+        # The units of a split file are merged in the order of their byte ranges
+        prefix = get_staged_path(self.staging_directory, s3_path, None).rsplit('@', 1)[0]
+        return sorted(glob.glob(glob.escape(prefix) + '@*.changes'),
+                      key=lambda path: int(path.rsplit('@', 1)[1].split('.')[0]))
+
+    def get_filter(self, key_properties, full_dump_ids, bookmark):
+        committed_key = get_file_sort_key(bookmark) if bookmark else None
+        return ChangeFilter(self.path, self.staging_directory, self.cache_mb, key_properties,
+                            frozenset(full_dump_ids), committed_key)
+
+
+def read_staged_rows(staged_path):
+    with open(staged_path, 'rb') as staged_file:
+        while True:
+            entry = staged_file.read(STAGED_ENTRY_SIZE)
+            if len(entry) < STAGED_ENTRY_SIZE:
+                return
+            yield entry[:DIGEST_SIZE], entry[DIGEST_SIZE:]
+
+
+class ChangeFilter():
+    """What a worker needs to filter the rows of a stream against its `ChangeIndex`. Rows of a
+    full dump are only emitted when their key is new, their content changed, or the index got
+    them from a file past `committed_key`, the sort key of the `file` bookmark the sync started
+    from, see `file_index.get_file_sort_key`. Rows of
+    incremental dumps are always emitted. Either way the emitted rows are staged."""
+
+    def __init__(self, path, staging_directory, cache_mb, key_properties, full_dump_ids,    # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 committed_key):
+        self.path = path
+        self.staging_directory = staging_directory
+        self.cache_mb = cache_mb
+        self.key_properties = key_properties
+        self.full_dump_ids = full_dump_ids
+        self.committed_key = committed_key
+
+    def open(self, s3_path, byte_range):
+        return RowChanges(self, s3_path, byte_range, get_file_key(s3_path)[0] in self.full_dump_ids)
+
+
+class RowChanges():
+    """Filters and stages the rows of one unit of work. The staged file only appears under its
+    final name once the unit is complete, so a worker that fails leaves nothing to merge."""
+
+    def __init__(self, change_filter, s3_path, byte_range, compare):
+        self.change_filter = change_filter
+        self.compare = compare
+        self.staged_path = get_staged_path(change_filter.staging_directory, s3_path, byte_range)
+        self.staged_file = open(self.staged_path + '.tmp', 'wb')    # pylint: disable=consider-using-with
+        self.connection = None
+        # The sort keys of the files rows were found in, which are few
+        self.file_sort_keys = {}
+        if compare:
+            self.connection = sqlite3.connect(f'file:{change_filter.path}?mode=ro', uri=True)
+            self.connection.execute(f'PRAGMA cache_size = -{change_filter.cache_mb * 1024}')
+
+    def is_changed(self, row):
+        key = get_digest([row.get(name) for name in self.change_filter.key_properties])
+        row_hash = get_digest(list(row.items()))
+        if self.compare:
+            found = self.connection.execute('SELECT hash, path FROM rows JOIN files '
+                                            'ON files.id = rows.file_id WHERE key = ?',
+                                            (key,)).fetchone()
+            committed_key = self.change_filter.committed_key
+            if found and found[0] == row_hash and committed_key and \
+               self.get_file_sort_key(found[1]) <= committed_key:
+                return False
+
+        self.staged_file.write(key + row_hash)
+        return True
+
+    def get_file_sort_key(self, s3_path):
+        if s3_path not in self.file_sort_keys:
+            self.file_sort_keys[s3_path] = get_file_sort_key(s3_path)
+        return self.file_sort_keys[s3_path]
+
+    def close(self, completed):
+        self.staged_file.close()
+        if completed:
+            os.replace(self.staged_path + '.tmp', self.staged_path)
+        else:
+            os.remove(self.staged_path + '.tmp')
+        if self.connection:
+            self.connection.close()
+
+
+def get_change_index(config, table_name, key_properties):
+    """Returns the change index of a stream if `change_index_dir` is configured, or None. Rows
+    can only be matched by their key, so streams without key properties are synced in full."""
+    directory = config.get('change_index_dir')
+    if not directory:
+        return None
+    if not key_properties:
+        LOGGER.warning('Stream "%s" has no key properties, syncing full dumps in full.',
+                       table_name)
+        return None
+
+    cache_mb = int(config.get('change_index_cache_mb', DEFAULT_CHANGE_INDEX_CACHE_MB))
+    return ChangeIndex(directory, table_name, cache_mb)
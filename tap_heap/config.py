@@ -0,0 +1,6 @@
+def get_flag(config, key, default=False):
+    """Boolean options set through the UI arrive as strings, so accept 'true'/'false' too."""
+    value = config.get(key, default)
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return bool(value)
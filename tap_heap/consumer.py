@@ -0,0 +1,316 @@
+import collections
+import copy
+import multiprocessing
+from multiprocessing import ProcessError
+import time
+import queue
+import singer
+
+from tap_heap import serialize
+from tap_heap import stats
+from tap_heap.file_index import get_file_sort_key
+from tap_heap.plan import merge_ranges
+
+LOGGER = singer.get_logger()
+
+QUEUE_TIMEOUT = 120
+# Records travel from the workers to the consumer in chunks of `record_chunk_size` rows, so
+# the queue is sized in chunks to keep roughly QUEUE_MAX_LIMIT records in flight, see
+# `get_queue_max_chunks`
+QUEUE_MAX_LIMIT = 20000
+DEFAULT_RECORD_CHUNK_SIZE = 1000
+
+# The queue the workers put their chunks on for the consumer. It is only created once a sync
+# starts, see `open_ipc`, and handed to the workers and the consumer as they start.
+record_queue = None    # pylint: disable=invalid-name
+
+# This event will signal all producer and consumer threads to stop their execution
+# if all files are extracted or any other thread exits abruptly.
+terminate_event = None    # pylint: disable=invalid-name
+
+# How many chunks the record queue holds
+queue_max_chunks = None    # pylint: disable=invalid-name
+
+# How long the consumer waits for a chunk before it checks whether the main process failed
+CONSUMER_WAIT_SECONDS = 5
+
+
+def use_ipc(ipc):
+    """Makes this process use the `(record_queue, terminate_event)` of `ipc`."""
+    global record_queue, terminate_event    # pylint: disable=global-statement
+    record_queue, terminate_event = ipc
+
+
+def get_queue_max_chunks(chunk_size):
+    """Returns how many chunks of `chunk_size` records make up QUEUE_MAX_LIMIT records."""
+    return max(1, QUEUE_MAX_LIMIT // chunk_size)
+
+
+def open_ipc(chunk_size=None):
+    """Returns the `(record_queue, terminate_event)` of this process, creating them on first
+    use so importing the tap or running discovery sets up no IPC. With `chunk_size` given, the
+    queue is sized for chunks of that many records, and created again if it was sized for
+    another chunk size by an earlier sync."""
+    global queue_max_chunks    # pylint: disable=global-statement
+    max_chunks = get_queue_max_chunks(chunk_size or DEFAULT_RECORD_CHUNK_SIZE)
+    if record_queue is None or (chunk_size and max_chunks != queue_max_chunks):
+        queue_max_chunks = max_chunks
+        use_ipc((multiprocessing.Queue(maxsize=max_chunks), multiprocessing.Event()))
+    return record_queue, terminate_event
+
+
+def run_consumer(ipc, *args):
+    use_ipc(ipc)
+    write_records(*args)
+
+class FileSynced():
+    """Follows the last chunk of a file on the queue, telling the consumer that every record of
+    the file has been written."""
+
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class StreamSchema():
+    """Starts every chunk a worker puts on the queue, naming the schema of the chunk's records
+    by its fingerprint. The first chunk of a file also carries the SCHEMA message, so the
+    consumer can write it whenever the records of a stream switch to another schema and skip
+    it otherwise."""
+
+    def __init__(self, stream, fingerprint, message=None):
+        self.stream = stream
+        self.fingerprint = fingerprint
+        self.message = message
+
+
+class BlocksSynced():
+    """Put by a worker before it decodes the block at `offset`, telling the consumer that every
+    record of the earlier blocks in the file's byte range has been written."""
+
+    def __init__(self, file_id, offset):
+        self.file_id = file_id
+        self.offset = offset
+
+
+class CheckpointTracker():
+    """Collects, in the consumer, the byte ranges of files whose records have all been written,
+    and adds them to each STATE as the `checkpoints` bookmark so an interrupted file can resume
+    where it stopped. A STATE carrying the latest checkpoints is also written every `interval`
+    seconds, as a large file can take a long time to move the `file` bookmark."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.synced_ranges = collections.defaultdict(dict)
+        self.last_state = None
+        self.last_written = time.monotonic()
+        self.changed = False
+
+    def range_synced(self, file_id, end):
+        table_name, s3_path, byte_range = file_id
+        start = byte_range[0] if byte_range else 0
+        ranges = self.synced_ranges[table_name].get(s3_path, [])
+        self.synced_ranges[table_name][s3_path] = merge_ranges(ranges + [[start, end]])
+        self.changed = True
+
+    def file_synced(self, file_id):
+        byte_range = file_id[2]
+        self.range_synced(file_id, byte_range[1] if byte_range else None)
+
+    def add_checkpoints(self, state):
+        state = copy.deepcopy(state)
+        bookmarks = state.setdefault('bookmarks', {})
+        for table_name in set(bookmarks) | set(self.synced_ranges):
+            bookmark = bookmarks.setdefault(table_name, {})
+            checkpoints = dict(bookmark.get('checkpoints', {}))
+            for s3_path, ranges in self.synced_ranges.get(table_name, {}).items():
+                checkpoints[s3_path] = merge_ranges(checkpoints.get(s3_path, []) + ranges)
+
+            # Files up to the `file` bookmark are synced in full and need no checkpoint
+            if bookmark.get('file'):
+                bookmarked_key = get_file_sort_key(bookmark['file'])
+                checkpoints = {s3_path: ranges for s3_path, ranges in checkpoints.items()
+                               if get_file_sort_key(s3_path) > bookmarked_key}
+                self.synced_ranges[table_name] = {
+                    s3_path: ranges
+                    for s3_path, ranges in self.synced_ranges.get(table_name, {}).items()
+                    if s3_path in checkpoints}
+
+            if checkpoints:
+                bookmark['checkpoints'] = checkpoints
+            else:
+                bookmark.pop('checkpoints', None)
+
+        self.last_state = state
+        self.last_written = time.monotonic()
+        self.changed = False
+        return state
+
+    def get_due_state(self):
+        """Returns the last STATE with the latest checkpoints if it is time to write it."""
+        if self.last_state is None or not self.changed or \
+           time.monotonic() - self.last_written < self.interval:
+            return None
+        return self.add_checkpoints(self.last_state)
+
+
+class GatedMessage():
+    """A message from the main process, like a STATE, that the consumer may only write once it
+    has seen the `FileSynced` marker of every file in `file_ids`. Every process feeds the queue
+    from its own background thread, so a message the main process puts after a worker returns
+    can otherwise overtake that worker's last records."""
+
+    def __init__(self, message, file_ids):
+        self.message = message
+        self.file_ids = file_ids
+
+
+class EndOfRecords():
+    """Put by the main process behind every file once the sync is complete, so the consumer
+    stops after the last records instead of when the queue first looks empty."""
+
+
+class MessageGate():
+    """Puts messages from the main process on the queue behind every file that finished before
+    them."""
+
+    def __init__(self):
+        self.unreported_files = set()
+
+    def file_synced(self, file_id):
+        self.unreported_files.add(file_id)
+
+    def put(self, message):
+        chunk = [GatedMessage(message, frozenset(self.unreported_files))]
+        # A consumer that failed sets the terminate event, and one that died without doing so
+        # stops taking chunks, so neither leaves this process waiting on a full queue forever
+        waited = 0
+        while True:
+            try:
+                record_queue.put(chunk, timeout=CONSUMER_WAIT_SECONDS)
+                break
+            except queue.Full as ex:
+                waited += CONSUMER_WAIT_SECONDS
+                if terminate_event.is_set() or waited >= QUEUE_TIMEOUT:
+                    raise ProcessError("The consumer stopped taking messages from the queue!") \
+                        from ex
+        self.unreported_files = set()
+
+    def put_state(self, state):
+        # The queue pickles in the background, so send a copy the caller can keep changing
+        self.put(singer.StateMessage(value=copy.deepcopy(state)))
+
+
+def write_gated_messages(gated_messages, synced_files, checkpoints=None, writer=None):
+    """Writes the gated messages that are due and returns whether the end of the records was
+    reached."""
+    write_message = writer.write_message if writer else singer.write_message
+    # Gated messages are written in the order they were put
+    while gated_messages and gated_messages[0].file_ids <= synced_files:
+        gated_message = gated_messages.popleft()
+        synced_files.difference_update(gated_message.file_ids)
+        message = gated_message.message
+        if isinstance(message, EndOfRecords):
+            return True
+        if checkpoints and isinstance(message, singer.StateMessage):
+            message = singer.StateMessage(value=checkpoints.add_checkpoints(message.value))
+        write_message(message)
+    return False
+
+def write_stream_schema(stream_schema, schema_messages, current_schemas, writer=None):
+    write_message = writer.write_message if writer else singer.write_message
+    # Tables with the same columns share a fingerprint, but their SCHEMA messages name their own
+    # stream and key properties
+    schema_key = (stream_schema.stream, stream_schema.fingerprint)
+    if stream_schema.message is not None:
+        schema_messages[schema_key] = stream_schema.message
+
+    # Only the first chunk of a file carries its SCHEMA message, but it may arrive after
+    # chunks of other files with another schema, so each chunk names the schema it uses
+    if current_schemas.get(stream_schema.stream) != stream_schema.fingerprint:
+        write_message(schema_messages[schema_key])
+        current_schemas[stream_schema.stream] = stream_schema.fingerprint
+
+def write_records(checkpoint_interval=0, buffer_size=serialize.DEFAULT_OUTPUT_BUFFER_SIZE,    # pylint: disable=too-many-branches,too-many-locals,too-many-statements
+                  flush_interval=serialize.DEFAULT_OUTPUT_FLUSH_INTERVAL):
+    writer = serialize.OutputWriter(buffer_size, flush_interval)
+    synced_files = set()
+    gated_messages = collections.deque()
+    schema_messages = {}
+    current_schemas = {}
+    checkpoints = CheckpointTracker(checkpoint_interval) if checkpoint_interval else None
+    wait_seconds = write_seconds = 0
+    chunks = 0
+
+    # The consumer exits at the end of the records, or once the queue is drained after the
+    # terminate event was set by a process that failed
+    while True:
+        waiting_since = time.monotonic()
+        try:
+            # Wake up in time to flush what is buffered when nothing else arrives
+            flush_timeout = writer.get_flush_timeout()
+            chunk = record_queue.get(timeout=CONSUMER_WAIT_SECONDS if flush_timeout is None
+                                     else min(flush_timeout, CONSUMER_WAIT_SECONDS))
+            received_at = time.monotonic()
+            wait_seconds += received_at - waiting_since
+
+            for message in chunk:
+                if isinstance(message, bytes):
+                    # Already encoded by a worker, see `serialize_records` in sync_file
+                    writer.write_encoded(message)
+                elif isinstance(message, StreamSchema):
+                    write_stream_schema(message, schema_messages, current_schemas, writer)
+                elif isinstance(message, FileSynced):
+                    synced_files.add(message.file_id)
+                    if checkpoints:
+                        checkpoints.file_synced(message.file_id)
+                elif isinstance(message, BlocksSynced):
+                    if checkpoints:
+                        checkpoints.range_synced(message.file_id, message.offset)
+                elif isinstance(message, GatedMessage):
+                    gated_messages.append(message)
+                else:
+                    writer.write_message(message)
+
+            finished = write_gated_messages(gated_messages, synced_files, checkpoints, writer)
+            checkpoint_state = checkpoints.get_due_state() if checkpoints else None
+            if checkpoint_state:
+                writer.write_message(singer.StateMessage(value=checkpoint_state))
+            writer.flush_if_due()
+
+            write_seconds += time.monotonic() - received_at
+            chunks += 1
+            if finished:
+                break
+        except queue.Empty:
+            wait_seconds += time.monotonic() - waiting_since
+            writer.flush_if_due()
+            if terminate_event.is_set():
+                break
+            continue
+        except Exception as ex:    # pylint: disable=broad-exception-caught
+            terminate_event.set()
+            raise ProcessError("Consumer thread stopped abruptly!") from ex
+
+    writer.flush()
+
+    # Time spent writing to stdout, and waiting on the workers for something to write
+    stats.log_timer('consumer_write', write_seconds, chunks=chunks,
+                    wait_seconds=round(wait_seconds, 3))
+    LOGGER.info("Exiting from the consumer thread!")
+
+def get_queue_fill():
+    """Returns how full the record queue is, or None where its size cannot be read."""
+    try:
+        return record_queue.qsize() / queue_max_chunks
+    except NotImplementedError:
+        return None
+
+
+def put_chunk(chunk, encoded, file_stats=None):
+    if encoded:
+        chunk = serialize.pack_chunk(chunk)
+
+    started = time.monotonic()
+    record_queue.put(chunk, timeout=QUEUE_TIMEOUT)
+    if file_stats:
+        file_stats.queue_put_seconds += time.monotonic() - started
@@ -1,26 +1,69 @@
 from collections import defaultdict
+from concurrent import futures
+from functools import partial
 from singer import metadata
+from tap_heap import avro
 from tap_heap import manifest
+from tap_heap.file_index import build_file_index
 from tap_heap.schema import generate_fake_schema
+from tap_heap.schema import generate_schema_from_avro
 
-def discover_streams(bucket):
+DEFAULT_DISCOVERY_SAMPLE_FILES = 1
+DEFAULT_DISCOVERY_CONCURRENCY = 16
+
+def discover_streams(storage, config=None):
+    config = config or {}
     streams = []
 
-    manifests = manifest.generate_manifests(bucket)
+    manifests = manifest.generate_manifests(storage, config)
+    file_index = build_file_index(manifests, storage.bucket)
 
-    table_name_to_columns = defaultdict(set)
-    for all_table_manifests in manifests.values():
-        for table_name, table_manifest in all_table_manifests.items():
-            table_name_to_columns[table_name].update(set(table_manifest['columns']))
+    avro_schemas = {}
+    if config.get('discovery_mode') == 'avro_header':
+        sample_files = int(config.get('discovery_sample_files', DEFAULT_DISCOVERY_SAMPLE_FILES))
+        avro_schemas = read_sample_schemas(storage, file_index, sample_files)
 
-    for table_name, columns in table_name_to_columns.items():
-        schema = generate_fake_schema(columns)
+    for table_name, table_files in file_index.items():
+        schema = generate_schema_from_samples(table_files.columns,
+                                              avro_schemas.get(table_name, []))
         streams.append({'stream': table_name, 'tap_stream_id': table_name,
                         'schema': schema, 'metadata': load_metadata(table_name, schema)})
 
     return streams
 
 
+def read_avro_schema(storage, s3_path):
+    """Reads the writer schema from the header of the Avro file at `s3_path` without fetching
+    the rest of the file."""
+    header, _ = avro.read_bounded_header(partial(storage.open_file, s3_path))
+    return avro.get_writer_schema(header)
+
+
+def read_sample_schemas(storage, file_index, sample_files):
+    """Reads the Avro schemas of the tables' most recent part files, newest first, with the
+    headers of every table read concurrently."""
+    sampled_files = [(table_name, s3_path) for table_name, table_files in file_index.items()
+                     for s3_path in table_files.get_recent_files(sample_files)]
+
+    with futures.ThreadPoolExecutor(max_workers=DEFAULT_DISCOVERY_CONCURRENCY) as executor:
+        sampled_schemas = executor.map(partial(read_avro_schema, storage),
+                                       [s3_path for _, s3_path in sampled_files])
+
+        avro_schemas = defaultdict(list)
+        for (table_name, _), avro_schema in zip(sampled_files, sampled_schemas):
+            avro_schemas[table_name].append(avro_schema)
+    return avro_schemas
+
+
+def generate_schema_from_samples(columns, avro_schemas):
+    """Types the columns that appear in the sampled `avro_schemas`, newest first, and leaves
+    the columns that only older dumps have as strings."""
+    schema = generate_fake_schema(columns)
+    for avro_schema in reversed(avro_schemas):
+        schema['properties'].update(generate_schema_from_avro(avro_schema)['properties'])
+    return schema
+
+
 def get_key_properties(table_name):
     if table_name == 'user_migrations':
         return ['from_user_id']
@@ -0,0 +1,98 @@
+import array
+import bisect
+import re
+
+FILE_NUMBER_PATTERN = re.compile('[0-9]+')
+# A file's sort key packs its dump id and part number into one integer
+PART_BITS = 32
+
+
+def get_file_key(s3_path):
+    """Returns the (dump_id, part) a path like 'sync_852/sessions/part-00000-<guid>.avro' sorts
+    by, the same as `sync.key_fn`."""
+    dump_directory, _, file_name = s3_path.partition('/')
+    file_name = file_name.rsplit('/', 1)[-1]
+    return (int(dump_directory.replace('sync_', '')),
+            int(FILE_NUMBER_PATTERN.search(file_name).group()))
+
+
+def pack_file_key(dump_id, part):
+    return (dump_id << PART_BITS) | part
+
+
+def get_file_sort_key(s3_path):
+    """Returns the key that orders files by dump and part, then by path. Spark can write several
+    files with the same part number, like `part-00000-<guid>-c000.avro` and `-c001.avro`, so the
+    part alone does not tell whether a file comes before or after another."""
+    return get_file_key(s3_path), s3_path
+
+
+class TableFiles():
+    """The part files of one table across every dump, sorted by dump and part with their sort
+    keys parsed once. The files to sync from a dump, or after a bookmark, are found by binary
+    search over the packed keys."""
+
+    def __init__(self):
+        self.keys = array.array('q')
+        self.paths = []
+        self.dump_ids = []
+        self.full_dump_ids = []
+        self.columns = set()
+        self.entries = []
+
+    def add_dump(self, dump_id, table_manifest, path_prefix):
+        self.dump_ids.append(dump_id)
+        if table_manifest.get('incremental') is False:
+            self.full_dump_ids.append(dump_id)
+        self.columns.update(table_manifest.get('columns', []))
+        for file_name in table_manifest.get('files', []):
+            s3_path = file_name[len(path_prefix):] if file_name.startswith(path_prefix) \
+                else file_name
+            self.entries.append((pack_file_key(*get_file_key(s3_path)), s3_path))
+
+    def sort(self):
+        # Dumps are added in order, so this mostly merges runs that are already sorted
+        self.entries.sort()
+        self.dump_ids.sort()
+        self.full_dump_ids.sort()
+        self.keys = array.array('q', (key for key, _ in self.entries))
+        self.paths = [s3_path for _, s3_path in self.entries]
+        self.entries = []
+
+    def get_files(self, min_dump_id=0, after=None):
+        """Returns the files of dumps from `min_dump_id` on that sort after the file `after`,
+        by `get_file_sort_key`."""
+        start = bisect.bisect_left(self.keys, pack_file_key(min_dump_id, 0))
+        if after:
+            # Files with the same dump and part are sorted by their path
+            key = pack_file_key(*get_file_key(after))
+            low = bisect.bisect_left(self.keys, key)
+            high = bisect.bisect_right(self.keys, key)
+            start = max(start, bisect.bisect_right(self.paths, after, low, high))
+        return self.paths[start:]
+
+    def get_recent_files(self, count):
+        """Returns up to `count` files from the most recent dumps, newest dump first."""
+        files = []
+        for dump_id in reversed(self.dump_ids):
+            start = bisect.bisect_left(self.keys, pack_file_key(dump_id, 0))
+            end = bisect.bisect_left(self.keys, pack_file_key(dump_id + 1, 0))
+            files.extend(self.paths[start:min(end, start + count - len(files))])
+            if len(files) == count:
+                break
+        return files
+
+
+def build_file_index(manifests, bucket):
+    """Returns the `TableFiles` of every table in `manifests`, built in one pass so discovery
+    and every stream share it."""
+    path_prefix = f's3://{bucket}/'
+    file_index = {}
+    for dump_id in sorted(manifests):
+        for table_name, table_manifest in manifests[dump_id].items():
+            file_index.setdefault(table_name, TableFiles()).add_dump(dump_id, table_manifest,
+                                                                     path_prefix)
+
+    for table_files in file_index.values():
+        table_files.sort()
+    return file_index
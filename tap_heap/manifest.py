@@ -1,14 +1,50 @@
 import json
+import time
+from concurrent import futures
+from functools import partial
 
-from tap_heap import s3
+from tap_heap import stats
+from tap_heap.cache import get_manifest_cache
 
-def get_s3_manifest_file_contents(bucket):
-    manifests = s3.list_manifest_files_in_bucket(bucket)
-    for manifest in manifests:
-        contents = s3.get_file_handle(bucket, manifest['Key'])
-        yield json.loads(contents.read().decode('utf-8'))
+DEFAULT_MANIFEST_CONCURRENCY = 16
+
+def read_manifest(storage, s3_object, cache=None):
+    key = s3_object['Key']
+    # Fall back to the modification time for listings that do not carry an ETag
+    version = s3_object.get('ETag') or str(s3_object.get('LastModified'))
+
+    if cache:
+        manifest = cache.get(key, version)
+        if manifest is not None:
+            return manifest
+
+    contents = storage.open_file(key)
+    manifest = json.loads(contents.read().decode('utf-8'))
+    manifest = {'dump_id': manifest['dump_id'], 'tables': manifest['tables']}
+
+    if cache:
+        cache.put(key, version, manifest)
+    return manifest
+
+def get_manifest_file_contents(storage, concurrency=DEFAULT_MANIFEST_CONCURRENCY, cache=None,
+                               min_dump_id=None):
+    started = time.monotonic()
+    s3_objects = list(storage.list_manifest_files(min_dump_id))
+    stats.log_timer('manifest_list', time.monotonic() - started, manifests=len(s3_objects))
+
+    # Every download goes through the process' shared client, so there is no point in running
+    # more threads than it has pooled connections
+    max_workers = max(1, min(concurrency, storage.max_connections or concurrency))
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(partial(read_manifest, storage, cache=cache), s3_objects)
+
+def generate_manifests(storage, config=None, min_dump_id=None):
+    """Reads every manifest in `storage`, or only those of dumps at or after `min_dump_id`."""
+    config = config or {}
+    concurrency = int(config.get('manifest_concurrency', DEFAULT_MANIFEST_CONCURRENCY))
+    cache = get_manifest_cache(config)
+    started = time.monotonic()
 
-def generate_manifests(bucket):
     # NB> We drop the `property_definitions` because we don't need it
     # This will generate our manifests in the structure:
     # manifests[dump_id][table_name] =
@@ -16,6 +52,12 @@ def generate_manifests(bucket):
     #    "incremental": True,
     #    "columns": ["column_1"]}
     manifests = {manifest['dump_id']: {table['name']: table for table in manifest['tables']}
-                 for manifest in get_s3_manifest_file_contents(bucket)}
+                 for manifest in get_manifest_file_contents(storage, concurrency, cache,
+                                                            min_dump_id)}
+
+    if cache:
+        cache.evict()
 
+    stats.log_timer('manifest_read', time.monotonic() - started, manifests=len(manifests),
+                    cached=cache is not None)
     return manifests
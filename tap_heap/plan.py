@@ -0,0 +1,202 @@
+import collections
+import time
+
+from tap_heap import stats
+
+# The rate one worker is assumed to sync a file at, in MB of Avro per second, for the ETA
+DEFAULT_ESTIMATED_WORKER_THROUGHPUT_MB = 5
+
+
+def advance_watermark(completed_indexes, watermark):
+    """Files can finish out of order, so the bookmark may only move past a file once every
+    file before it has finished too. Consumes the contiguous run of completed indexes starting
+    at `watermark` and returns the index of the first file that is not yet complete."""
+    while watermark in completed_indexes:
+        completed_indexes.remove(watermark)
+        watermark += 1
+    return watermark
+
+
+def merge_ranges(ranges):
+    """Merges overlapping and adjacent `[start, end]` byte ranges. An end of None stands for the
+    end of the file."""
+    merged = []
+    for start, end in sorted(ranges, key=lambda byte_range: byte_range[0]):
+        if not merged or (merged[-1][1] is not None and start > merged[-1][1]):
+            merged.append([start, end])
+        elif merged[-1][1] is not None and (end is None or end > merged[-1][1]):
+            merged[-1][1] = end
+    return merged
+
+
+def subtract_ranges(byte_range, synced_ranges):
+    """Returns the parts of `byte_range`, or of the whole file if it is None, that are not
+    covered by `synced_ranges`."""
+    start, end = byte_range or (0, None)
+    remaining = []
+    for synced_start, synced_end in merge_ranges(synced_ranges):
+        if end is not None and synced_start >= end:
+            break
+        if synced_end is not None and synced_end <= start:
+            continue
+        if synced_start > start:
+            remaining.append((start, synced_start))
+        if synced_end is None:
+            return remaining
+        start = synced_end
+
+    if end is None or start < end:
+        remaining.append((start, end))
+    return remaining
+
+
+def get_unsynced_ranges(byte_ranges, synced_ranges):
+    """Returns what is left to sync of a file planned as `byte_ranges` after a previous run
+    synced `synced_ranges` of it."""
+    if not synced_ranges:
+        return byte_ranges
+    return [remaining for byte_range in byte_ranges
+            for remaining in subtract_ranges(byte_range, synced_ranges)]
+
+
+class TableSync():    # pylint: disable=too-many-instance-attributes
+    """Progress of one stream while `sync_streams` runs its files on the shared pool. The
+    `selector` is the stream's `sync.RecordSelector`."""
+
+    def __init__(self, stream, selector, files, version, file_ranges=None, change_index=None,    # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 change_filter=None):
+        self.stream = stream
+        self.table_name = stream['stream']
+        self.selector = selector
+        self.files = files
+        self.version = version
+        self.watermark = 0
+        # Files up to here are complete, but with a change index the watermark only follows
+        # once their rows are merged, see `advance`
+        self.completed_watermark = 0
+        self.merge = None
+        self.completed_indexes = set()
+        self.in_flight = 0
+        self.records_streamed = 0
+        self.started_at = time.monotonic()
+        self.file_stats = stats.FileStats()
+        self.change_index = change_index
+        self.change_filter = change_filter
+
+        # A file is synced as one unit of work, or as one unit per byte range when it was split
+        # or resumed from a checkpoint
+        file_ranges = file_ranges or [[None]] * len(files)
+        self.pending_units = collections.deque((index, byte_range)
+                                               for index, byte_ranges in enumerate(file_ranges)
+                                               for byte_range in byte_ranges)
+        self.remaining_units = [len(byte_ranges) for byte_ranges in file_ranges]
+        # Files a previous run already synced in full only have to move the watermark
+        self.completed_indexes.update(index for index, byte_ranges in enumerate(file_ranges)
+                                      if not byte_ranges)
+
+    def has_pending_units(self):
+        return bool(self.pending_units)
+
+    def is_done(self):
+        return self.watermark == len(self.files)
+
+    def next_unit(self):
+        return self.pending_units[0]
+
+    def pending_files(self):
+        """Yields the files that still have units to start, in the order they will start."""
+        last_index = None
+        for index, _ in self.pending_units:
+            if index != last_index:
+                last_index = index
+                yield self.files[index]
+
+    def start_unit(self):
+        self.in_flight += 1
+        return self.pending_units.popleft()
+
+    def get_unit_sizes(self, sizes):
+        """Returns the size in bytes of each pending unit, given the `sizes` of the files."""
+        return [get_range_size(byte_range, sizes[index])
+                for index, byte_range in self.pending_units]
+
+    def schedule_largest_first(self, sizes):
+        """Starts the files with the most bytes left to sync first, so a large file late in the
+        order does not become the tail of the sync. The units of a file stay together, so a
+        spooled file is released as soon as possible. The watermark still moves in file order,
+        so the bookmark only passes a small file once the larger files before it are done too."""
+        file_units = collections.defaultdict(list)
+        remaining_bytes = collections.Counter()
+        for unit, unit_size in zip(self.pending_units, self.get_unit_sizes(sizes)):
+            file_units[unit[0]].append(unit)
+            remaining_bytes[unit[0]] += unit_size
+
+        # The sort is stable, so files with as many bytes left still start in file order
+        self.pending_units = collections.deque(
+            unit for index in sorted(file_units, key=lambda index: -remaining_bytes[index])
+            for unit in file_units[index])
+
+    def complete_unit(self, index, file_stats):
+        """Records a finished unit and returns whether its whole file is now synced."""
+        self.in_flight -= 1
+        self.records_streamed += file_stats.records
+        self.file_stats.add(file_stats)
+        self.remaining_units[index] -= 1
+        if self.remaining_units[index] == 0:
+            self.completed_indexes.add(index)
+            self.file_stats.files += 1
+            return True
+        return False
+
+    def advance(self):
+        """Moves the watermark past the files that are now contiguously complete and returns
+        whether it moved. With a change index, the rows those files emitted are merged into it
+        in the background first, and the watermark only moves once that merge is done. Files
+        completed during a merge are merged together by the next one."""
+        self.completed_watermark = advance_watermark(self.completed_indexes,
+                                                     self.completed_watermark)
+        if not self.change_index:
+            moved = self.completed_watermark != self.watermark
+            self.watermark = self.completed_watermark
+            return moved
+
+        moved = False
+        if self.merge and self.merge[0].done():
+            merge, merged_watermark = self.merge
+            # A failed merge fails the sync
+            merge.result()
+            self.merge = None
+            self.watermark = merged_watermark
+            moved = True
+
+        if self.merge is None and self.completed_watermark != self.watermark:
+            self.merge = (self.change_index.merge_files(
+                self.files[self.watermark:self.completed_watermark]), self.completed_watermark)
+        return moved
+
+    def pending_merges(self):
+        """Returns the future of the running merge, if any, for the caller to wait on."""
+        return [self.merge[0]] if self.merge else []
+
+
+def get_range_size(byte_range, size):
+    """Returns the bytes in `byte_range` of a file of `size` bytes, all of them if it is None."""
+    if byte_range is None:
+        return size
+    start, end = byte_range
+    return (size if end is None else min(end, size)) - start
+
+def estimate_sync_seconds(unit_sizes, worker_count, throughput):
+    """Estimates how long `worker_count` workers take to sync units of `unit_sizes` bytes at
+    `throughput` bytes per second each. The sync takes at least as long as its largest unit."""
+    if not unit_sizes:
+        return 0
+    largest_unit = max(unit_sizes)
+    return max(sum(unit_sizes) / worker_count, largest_unit) / throughput
+
+def plan_file_ranges(size, split_size):
+    """Returns the byte ranges to sync a file of `size` bytes in, or `[None]` to sync it whole.
+    Ranges do not have to line up with Avro blocks, each one syncs the blocks starting in it."""
+    if not split_size or size <= split_size:
+        return [None]
+    return [(start, min(start + split_size, size)) for start in range(0, size, split_size)]
@@ -1,8 +1,15 @@
+import os
 import re
+import threading
+from concurrent import futures
+from functools import partial
 import backoff
 import boto3
 import singer
 
+from boto3.s3.transfer import TransferConfig
+
+from botocore.config import Config
 from botocore.credentials import (
     AssumeRoleCredentialFetcher,
     CredentialResolver,
@@ -16,6 +23,45 @@ from urllib3.exceptions import ReadTimeoutError
 
 LOGGER = singer.get_logger()
 
+# Heap writes one manifest per dump at `manifests/sync_{DUMP_ID}.json`
+MANIFEST_PREFIX = "manifests"
+MANIFEST_KEY_PREFIX = MANIFEST_PREFIX + "/sync_"
+
+# Manifests are fetched from a thread pool, so the shared client needs a connection per thread
+MAX_POOL_CONNECTIONS = 64
+
+# Spooled files are downloaded as concurrent ranged GETs of this size
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=8)
+
+# S3 clients keyed by the pid of the process that built them
+_S3_CLIENTS = {}
+# The refreshable credentials of the assumed role, see `use_credential_fetcher`
+_CREDENTIALS = None
+_S3_CLIENTS_LOCK = threading.Lock()
+# The first page of a listing that was fetched by `probe_manifest_files`, by bucket and prefix
+_PROBED_PAGES = {}
+
+
+def get_s3_client():
+    """Returns the S3 client shared by every thread in this process. boto3 clients are thread
+    safe but their connection pool must not cross a fork, so a process that inherited the
+    client from its parent builds its own."""
+    pid = os.getpid()
+    with _S3_CLIENTS_LOCK:
+        if pid not in _S3_CLIENTS:
+            _S3_CLIENTS[pid] = boto3.client(
+                's3', config=Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                                    tcp_keepalive=True))
+        return _S3_CLIENTS[pid]
+
+
+def reset_s3_client():
+    with _S3_CLIENTS_LOCK:
+        _S3_CLIENTS.clear()
+
+
 def retry_pattern():
     return backoff.on_exception(backoff.expo,
                                 (ClientError, ReadTimeoutError),
@@ -42,14 +88,16 @@ class AssumeRoleProvider():
         )
 
 
-@retry_pattern()
-def setup_aws_client(config):
-    role_arn = f"arn:aws:iam::{config['account_id'].replace('-', '')}:role/{config['role_name']}"
+def get_role_arn(account_id, role_name):
+    return f"arn:aws:iam::{account_id.replace('-', '')}:role/{role_name}"
+
+
+def create_role_fetcher(config):
     session = Session()
-    fetcher = AssumeRoleCredentialFetcher(
+    return AssumeRoleCredentialFetcher(
         session.create_client,
         session.get_credentials(),
-        role_arn,
+        get_role_arn(config['account_id'], config['role_name']),
         extra_args={
             'DurationSeconds': 3600,
             'RoleSessionName': 'TapHeap',
@@ -58,28 +106,15 @@ def setup_aws_client(config):
         cache=JSONFileCache()
     )
 
-    refreshable_session = Session()
-    refreshable_session.register_component(
-        'credential_provider',
-        CredentialResolver([AssumeRoleProvider(fetcher)])
-    )
-
-    LOGGER.info("Attempting to assume_role on RoleArn: %s", role_arn)
-    boto3.setup_default_session(botocore_session=refreshable_session)
 
-
-@retry_pattern()
-def setup_aws_client_with_proxy(config):
-    # pylint: disable=line-too-long
-    proxy_role_arn = f"arn:aws:iam::{config['proxy_account_id'].replace('-', '')}:role/{config['proxy_role_name']}"
-    cust_role_arn = f"arn:aws:iam::{config['account_id'].replace('-', '')}:role/{config['role_name']}"
+def create_proxy_role_fetcher(config):
     credentials_cache_path = config.get("credentials_cache_path", JSONFileCache.CACHE_DIR)
     # Step 1: Assume Role in Account Proxy and set up refreshable session
     session_proxy = Session()
     fetcher_proxy = AssumeRoleCredentialFetcher(
         client_creator=session_proxy.create_client,
         source_credentials=session_proxy.get_credentials(),
-        role_arn=proxy_role_arn,
+        role_arn=get_role_arn(config['proxy_account_id'], config['proxy_role_name']),
         extra_args={
             'DurationSeconds': 3600,
             'RoleSessionName': 'ProxySession'
@@ -96,10 +131,10 @@ def setup_aws_client_with_proxy(config):
 
     # Step 2: Use Proxy Account's session to assume Role in Customer Account
     session_cust = Session()
-    fetcher_cust = AssumeRoleCredentialFetcher(
+    return AssumeRoleCredentialFetcher(
         client_creator=session_cust.create_client,
         source_credentials=refreshable_credentials_proxy,
-        role_arn=cust_role_arn,
+        role_arn=get_role_arn(config['account_id'], config['role_name']),
         extra_args={
             'DurationSeconds': 3600,
             'RoleSessionName': 'TapHeapCustSession',
@@ -108,20 +143,80 @@ def setup_aws_client_with_proxy(config):
         cache=JSONFileCache(credentials_cache_path)
     )
 
-    # Set up refreshable session for Customer Account
-    refreshable_session_cust = Session()
-    refreshable_session_cust.register_component(
+
+def create_credential_fetcher(config):
+    if 'proxy_account_id' in config and 'proxy_role_name' in config:
+        return create_proxy_role_fetcher(config)
+    return create_role_fetcher(config)
+
+
+def use_credential_fetcher(fetcher):
+    """Makes the default session, and the S3 clients built from it, use the credentials of
+    `fetcher`."""
+    global _CREDENTIALS    # pylint: disable=global-statement
+
+    refreshable_session = Session()
+    refreshable_session.register_component(
         'credential_provider',
-        CredentialResolver([AssumeRoleProvider(fetcher_cust)])
+        CredentialResolver([AssumeRoleProvider(fetcher)])
     )
+    boto3.setup_default_session(botocore_session=refreshable_session)
+    _CREDENTIALS = refreshable_session.get_credentials()
+    reset_s3_client()
 
-    LOGGER.info("Attempting to assume_role on RoleArn: %s", cust_role_arn)
-    boto3.setup_default_session(botocore_session=refreshable_session_cust)
+
+@retry_pattern()
+def setup_aws_client(config):
+    LOGGER.info("Attempting to assume_role on RoleArn: %s",
+                get_role_arn(config['account_id'], config['role_name']))
+    use_credential_fetcher(create_role_fetcher(config))
 
 
 @retry_pattern()
-def list_manifest_files_in_bucket(bucket):
-    s3_client = boto3.client('s3')
+def setup_aws_client_with_proxy(config):
+    LOGGER.info("Attempting to assume_role on RoleArn: %s",
+                get_role_arn(config['account_id'], config['role_name']))
+    use_credential_fetcher(create_proxy_role_fetcher(config))
+
+
+class WorkerCredentialFetcher():
+    """Gives a worker the credentials its parent process resolved, and assumes the role again
+    in the worker once they are due to be refreshed."""
+
+    def __init__(self, credentials, config):
+        self.credentials = credentials
+        self.config = config
+
+    def fetch_credentials(self):
+        if self.credentials is not None:
+            credentials, self.credentials = self.credentials, None
+            return credentials
+        return create_credential_fetcher(self.config).fetch_credentials()
+
+
+def get_worker_credentials():
+    """Resolves the assumed role credentials in this process, so the workers it starts share
+    them instead of each calling STS. Returns None when the default credentials are used."""
+    if _CREDENTIALS is None:
+        return None
+
+    frozen_credentials = _CREDENTIALS.get_frozen_credentials()
+    return {'access_key': frozen_credentials.access_key,
+            'secret_key': frozen_credentials.secret_key,
+            'token': frozen_credentials.token,
+            'expiry_time': _CREDENTIALS._expiry_time.isoformat()}
+
+
+def init_worker(credentials, config):
+    """Initializes a sync worker process with the credentials of its parent and builds its S3
+    client up front, so its connections are kept alive across the files it syncs."""
+    if credentials is not None:
+        use_credential_fetcher(WorkerCredentialFetcher(credentials, config))
+    get_s3_client()
+
+
+def list_objects(bucket, prefix, start_after=None):
+    s3_client = get_s3_client()
 
     s3_objects = []
     max_results = 1000
@@ -130,8 +225,13 @@ def list_manifest_files_in_bucket(bucket):
         'MaxKeys': max_results,
     }
 
-    args['Prefix'] = "manifests"
-    result = s3_client.list_objects_v2(**args)
+    args['Prefix'] = prefix
+    if start_after:
+        args['StartAfter'] = start_after
+        result = s3_client.list_objects_v2(**args)
+    else:
+        # Continue from the page of the access probe rather than listing its key again
+        result = _PROBED_PAGES.pop((bucket, prefix), None) or s3_client.list_objects_v2(**args)
 
     next_continuation_token = None
     if result['KeyCount'] > 0:
@@ -149,6 +249,65 @@ def list_manifest_files_in_bucket(bucket):
         s3_objects += result['Contents']
         next_continuation_token = result.get('NextContinuationToken')
 
+    return s3_objects
+
+
+def probe_manifest_files(bucket):
+    """Checks that the manifests of `bucket` can be listed with a request for a single key. The
+    page is kept, so listing the manifests afterwards continues from it."""
+    result = get_s3_client().list_objects_v2(Bucket=bucket, Prefix=MANIFEST_PREFIX, MaxKeys=1)
+    _PROBED_PAGES[(bucket, MANIFEST_PREFIX)] = result
+    return result
+
+
+def get_partition_start_after(leading_digit, min_dump_id):
+    """Keys sort as strings, so `sync_1000.json` lists before `sync_999.json`. Returns the
+    StartAfter for the `manifests/sync_{leading_digit}` partition that skips as many manifests
+    older than `min_dump_id` as possible without skipping any manifest at or after it."""
+    min_dump = str(min_dump_id)
+    # The smallest dump id in this partition with more digits than `min_dump_id`
+    longer_dump = str(leading_digit) + '0' * len(min_dump)
+
+    if leading_digit < int(min_dump[0]):
+        smallest_dump = longer_dump
+    elif leading_digit == int(min_dump[0]):
+        smallest_dump = min(min_dump, longer_dump)
+    else:
+        smallest_dump = str(leading_digit) + '0' * (len(min_dump) - 1)
+
+    # A key's own prefix sorts before it, so this lets the smallest dump's manifest through
+    return MANIFEST_KEY_PREFIX + smallest_dump
+
+
+def list_manifest_files_after(bucket, min_dump_id):
+    """Lists the manifests of dumps at or after `min_dump_id`. The key space is split into one
+    partition per leading digit of the dump id, and each one is listed concurrently from its own
+    StartAfter."""
+    def list_partition(leading_digit):
+        return list_objects(bucket,
+                            MANIFEST_KEY_PREFIX + str(leading_digit),
+                            get_partition_start_after(leading_digit, min_dump_id))
+
+    with futures.ThreadPoolExecutor(max_workers=9) as executor:
+        partitions = list(executor.map(list_partition, range(1, 10)))
+
+    # StartAfter can only approximate the numeric bound, so apply it exactly here
+    matcher = re.compile(MANIFEST_KEY_PREFIX + r"([0-9]+)\.json$")
+    s3_objects = []
+    for s3_object in (s3_object for partition in partitions for s3_object in partition):
+        match = matcher.match(s3_object['Key'])
+        if match and int(match.group(1)) >= min_dump_id:
+            s3_objects.append(s3_object)
+    return s3_objects
+
+
+@retry_pattern()
+def list_manifest_files_in_bucket(bucket, min_dump_id=None):
+    if min_dump_id:
+        s3_objects = list_manifest_files_after(bucket, min_dump_id)
+    else:
+        s3_objects = list_objects(bucket, MANIFEST_PREFIX)
+
     if s3_objects:
         LOGGER.info("Found %s files.", len([o for o in s3_objects if o["Key"] != "manifests/"]))
     else:
@@ -161,9 +320,25 @@ def list_manifest_files_in_bucket(bucket):
 
 
 @retry_pattern()
-def get_file_handle(bucket, s3_path):
-    s3_client = boto3.resource('s3')
+def get_file_handle(bucket, s3_path, start=0, length=None):
+    args = {'Bucket': bucket, 'Key': s3_path}
+    if length:
+        args['Range'] = f'bytes={start}-{start + length - 1}'
+    elif start:
+        args['Range'] = f'bytes={start}-'
+    return get_s3_client().get_object(**args)['Body']
+
+
+@retry_pattern()
+def download_file(bucket, s3_path, local_path):
+    get_s3_client().download_file(bucket, s3_path, local_path, Config=TRANSFER_CONFIG)
+
+
+@retry_pattern()
+def get_object_size(bucket, s3_path):
+    return get_s3_client().head_object(Bucket=bucket, Key=s3_path)['ContentLength']
+
 
-    s3_bucket = s3_client.Bucket(bucket)
-    s3_object = s3_bucket.Object(s3_path)
-    return s3_object.get()['Body']
+def get_object_sizes(bucket, s3_paths, concurrency=MAX_POOL_CONNECTIONS):
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(partial(get_object_size, bucket), s3_paths))
@@ -1,3 +1,8 @@
+import functools
+import hashlib
+import json
+
+
 def generate_fake_schema(columns):
     schema = {
         "type": "object",
@@ -17,6 +22,16 @@ def generate_schema_from_avro(avro_schema):
     return {"type": "object", "properties": properties}
 
 
+@functools.lru_cache(maxsize=128)
+def translate_writer_schema(writer_schema_json):
+    """Returns the JSON schema for the Avro schema in `writer_schema_json` along with its
+    fingerprint. Every part file of a table usually has the same schema, so the translation
+    is cached by the Avro schema's canonical JSON."""
+    schema = generate_schema_from_avro(json.loads(writer_schema_json))
+    fingerprint = hashlib.sha256(json.dumps(schema, sort_keys=True).encode('utf-8')).hexdigest()
+    return schema, fingerprint
+
+
 def translate_avro_type(avro_type):
     translated_type = []
 
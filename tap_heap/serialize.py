@@ -0,0 +1,118 @@
+import math
+import sys
+import time
+
+import singer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The consumer writes its output in batches of about this many bytes, and at least this often
+DEFAULT_OUTPUT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_OUTPUT_FLUSH_INTERVAL = 1
+
+
+def encode_with_singer(message):
+    return (singer.format_message(message) + '\n').encode('utf-8')
+
+
+def has_non_finite_float(value):
+    if isinstance(value, float):
+        return not math.isfinite(value)
+    if isinstance(value, dict):
+        return any(has_non_finite_float(item) for item in value.values())
+    if isinstance(value, list):
+        return any(has_non_finite_float(item) for item in value)
+    return False
+
+
+def encode_with_orjson(message):
+    try:
+        line = orjson.dumps(message.asdict(), option=orjson.OPT_APPEND_NEWLINE)    # pylint: disable=no-member
+    except TypeError:
+        # orjson cannot encode Decimals, so fall back to singer's encoder for those records
+        return encode_with_singer(message)
+
+    # orjson writes NaN and Infinity as null where singer's encoder refuses them, so those
+    # records go through singer's encoder and fail the same way whether orjson is installed
+    if b'null' in line and has_non_finite_float(message.record):
+        return encode_with_singer(message)
+    return line
+
+
+def get_record_encoder():
+    """Returns a function that turns a RecordMessage into a JSON line, using orjson when it is
+    installed and singer's encoder otherwise."""
+    if orjson is None:
+        return encode_with_singer
+    return encode_with_orjson
+
+
+def pack_chunk(chunk):
+    """Joins each run of encoded lines in a chunk into one byte string, so the chunk pickles as a
+    handful of objects instead of one per record. Messages that were not encoded, like the
+    SCHEMA message, are kept in place."""
+    packed = []
+    lines = []
+    for message in chunk:
+        if isinstance(message, bytes):
+            lines.append(message)
+            continue
+        if lines:
+            packed.append(b''.join(lines))
+            lines = []
+        packed.append(message)
+
+    if lines:
+        packed.append(b''.join(lines))
+    return packed
+
+
+class OutputWriter():
+    """Writes the consumer's messages to stdout in large batches instead of flushing after each
+    one. The buffer is flushed once it holds `buffer_size` bytes, when it has waited
+    `flush_interval` seconds, and right after a STATE message, so a target never sees a
+    bookmark later than the records it covers and never waits long for one."""
+
+    def __init__(self, buffer_size=DEFAULT_OUTPUT_BUFFER_SIZE,
+                 flush_interval=DEFAULT_OUTPUT_FLUSH_INTERVAL, stream=None):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.stream = stream or sys.stdout.buffer
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.buffered_since = None
+
+    def write_message(self, message):
+        self.write_encoded(encode_with_singer(message))
+        if isinstance(message, singer.StateMessage):
+            self.flush()
+
+    def write_encoded(self, data):
+        """Buffers lines that are already encoded, see `serialize_records` in sync_file."""
+        if not self.buffer:
+            self.buffered_since = time.monotonic()
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+        if self.buffered_bytes >= self.buffer_size:
+            self.flush()
+
+    def get_flush_timeout(self):
+        """Returns how long the buffer can wait before it is due to be flushed, or None when it
+        is empty."""
+        if not self.buffer:
+            return None
+        return max(self.buffered_since + self.flush_interval - time.monotonic(), 0)
+
+    def flush_if_due(self):
+        if self.buffer and self.get_flush_timeout() == 0:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered_bytes = 0
+        self.stream.flush()
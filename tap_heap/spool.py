@@ -0,0 +1,100 @@
+import functools
+import mmap
+import os
+import shutil
+import tempfile
+from concurrent import futures
+
+DEFAULT_SPOOL_READ_AHEAD = 2
+
+
+class MappedStream():
+    """File object over a memory-mapped local file, starting at `offset`, for `length` bytes or
+    to the end of the file."""
+
+    def __init__(self, mapped_file, offset=0, length=None):
+        self.mapped_file = mapped_file
+        self.position = offset
+        self.end = len(mapped_file) if length is None else min(offset + length, len(mapped_file))
+
+    def read(self, size=-1):
+        end = self.end if size is None or size < 0 else min(self.position + size, self.end)
+        data = self.mapped_file[self.position:end]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+
+def open_mapped_file(local_path):
+    """Returns a function that opens a stream over the memory-mapped file at `local_path` from a
+    given offset, for `avro.read_blocks`."""
+    with open(local_path, 'rb') as local_file:
+        mapped_file = mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return functools.partial(MappedStream, mapped_file)
+
+
+class Spooler():
+    """Downloads the files that are about to be synced into a local spool directory while the
+    workers decode the current ones, so decoding does not wait on S3. At most `capacity` files
+    are downloading or on disk at any time, and a file is deleted once it has been synced."""
+
+    def __init__(self, storage, directory, capacity):
+        os.makedirs(directory, exist_ok=True)
+        self.storage = storage
+        self.directory = tempfile.mkdtemp(prefix='tap-heap-', dir=directory)
+        self.capacity = capacity
+        self.executor = futures.ThreadPoolExecutor(max_workers=capacity)
+        self.downloads = {}
+
+    def _local_path(self, s3_path):
+        return os.path.join(self.directory, s3_path.replace('/', '__'))
+
+    def _download(self, s3_path):
+        local_path = self._local_path(s3_path)
+        self.storage.download_file(s3_path, local_path)
+        return local_path
+
+    def prefetch(self, s3_paths):
+        """Starts downloading `s3_paths`, in order, until the spool is full."""
+        for s3_path in s3_paths:
+            if len(self.downloads) >= self.capacity:
+                return
+            if s3_path not in self.downloads:
+                self.downloads[s3_path] = self.executor.submit(self._download, s3_path)
+
+    def pending_downloads(self):
+        return [download for download in self.downloads.values() if not download.done()]
+
+    def get_local_path(self, s3_path):
+        """Returns the local copy of `s3_path`, or None if it is still downloading. Raises the
+        download's error if it failed."""
+        download = self.downloads.get(s3_path)
+        if download is None or not download.done():
+            return None
+        return download.result()
+
+    def release(self, s3_path):
+        download = self.downloads.pop(s3_path, None)
+        if download is not None and download.done() and not download.exception():
+            os.remove(download.result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
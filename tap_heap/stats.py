@@ -0,0 +1,88 @@
+import time
+
+import singer
+from singer import metrics
+
+LOGGER = singer.get_logger()
+
+
+def log_timer(metric, seconds, **tags):
+    """Logs a Singer timer metric, with the figures of the stage it measures as tags."""
+    metrics.log(LOGGER, metrics.Point('timer', metric, round(seconds, 3), tags))
+
+
+class MeteredStream():
+    """Counts the bytes read through `fo` and the time spent waiting on it."""
+
+    def __init__(self, fo, file_stats, opened_at):
+        self.fo = fo
+        self.file_stats = file_stats
+        self.opened_at = opened_at
+
+    def read(self, size=-1):
+        started = time.monotonic()
+        data = self.fo.read(size)
+        finished = time.monotonic()
+
+        self.file_stats.read_seconds += finished - started
+        self.file_stats.bytes_read += len(data)
+        if data and self.file_stats.first_byte_seconds is None:
+            self.file_stats.first_byte_seconds = finished - self.opened_at
+        return data
+
+    def close(self):
+        self.fo.close()
+
+
+class FileStats():    # pylint: disable=too-many-instance-attributes
+    """Where the time to sync a file, or a whole stream once added up, went. Reading covers
+    waiting on S3 or the spooled copy, and decoding is everything else the worker does besides
+    waiting to put chunks on the record queue. Added up over several units of work, a file or
+    one of its byte ranges, the time to first byte is logged as the mean per unit, while
+    `files` only counts the files whose every unit was synced."""
+
+    def __init__(self):
+        self.files = 0
+        self.units = 0
+        self.records = 0
+        self.unchanged_records = 0
+        self.bytes_read = 0
+        self.first_byte_seconds = None
+        self.read_seconds = 0
+        self.queue_put_seconds = 0
+        self.total_seconds = 0
+
+    def meter(self, open_stream):
+        """Wraps `open_stream` for `avro.read_blocks` so the streams it opens are metered."""
+        def open_metered_stream(offset, length=None):
+            opened_at = time.monotonic()
+            return MeteredStream(open_stream(offset, length), self, opened_at)
+        return open_metered_stream
+
+    def get_decode_seconds(self):
+        return max(self.total_seconds - self.read_seconds - self.queue_put_seconds, 0)
+
+    def add(self, file_stats):
+        self.files += file_stats.files
+        self.units += file_stats.units
+        self.records += file_stats.records
+        self.unchanged_records += file_stats.unchanged_records
+        self.bytes_read += file_stats.bytes_read
+        self.first_byte_seconds = (self.first_byte_seconds or 0) + \
+            (file_stats.first_byte_seconds or 0)
+        self.read_seconds += file_stats.read_seconds
+        self.queue_put_seconds += file_stats.queue_put_seconds
+        self.total_seconds += file_stats.total_seconds
+
+    def log(self, metric, **tags):
+        log_timer(metric,
+                  self.total_seconds,
+                  records=self.records,
+                  unchanged_records=self.unchanged_records,
+                  bytes_read=self.bytes_read,
+                  time_to_first_byte=round((self.first_byte_seconds or 0) / max(self.units, 1),
+                                           3),
+                  read_seconds=round(self.read_seconds, 3),
+                  decode_seconds=round(self.get_decode_seconds(), 3),
+                  queue_put_seconds=round(self.queue_put_seconds, 3),
+                  **tags)
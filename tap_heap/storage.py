@@ -0,0 +1,94 @@
+import io
+import os
+import re
+import shutil
+
+MANIFEST_FILE_PATTERN = re.compile(r"sync_([0-9]+)\.json$")
+
+
+def get_s3():
+    """Returns the `tap_heap.s3` module. Importing boto3 takes a good part of the tap's startup,
+    so it is only imported once the bucket is used."""
+    from tap_heap import s3    # pylint: disable=import-outside-toplevel
+    return s3
+
+
+class S3Storage():
+    """Reads the Heap dumps from the S3 bucket Heap exports them to."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    @property
+    def max_connections(self):
+        # Every request goes through the process' shared client, see `s3.get_s3_client`
+        return get_s3().MAX_POOL_CONNECTIONS
+
+    def list_manifest_files(self, min_dump_id=None):
+        return get_s3().list_manifest_files_in_bucket(self.bucket, min_dump_id)
+
+    def open_file(self, path, start=0, length=None):
+        """Returns a file object reading the object at `path` from `start`, for `length` bytes
+        or to its end."""
+        return get_s3().get_file_handle(self.bucket, path, start, length)._raw_stream
+
+    def get_file_sizes(self, paths):
+        return get_s3().get_object_sizes(self.bucket, paths)
+
+    def download_file(self, path, local_path):
+        get_s3().download_file(self.bucket, path, local_path)
+
+    def get_worker_initializer(self, config):
+        """Returns the initializer of the sync workers and its arguments."""
+        s3 = get_s3()
+        return s3.init_worker, (s3.get_worker_credentials(), config)
+
+
+class LocalStorage():
+    """Reads the Heap dumps from a local copy of the bucket, with the same `manifests/` and
+    `sync_N/` layout. Manifests still name their files as `s3://{bucket}/...`, so it needs the
+    bucket's name too."""
+
+    max_connections = None
+
+    def __init__(self, bucket, directory):
+        self.bucket = bucket
+        self.directory = directory
+
+    def list_manifest_files(self, min_dump_id=None):
+        manifest_directory = os.path.join(self.directory, 'manifests')
+        for name in sorted(os.listdir(manifest_directory)):
+            match = MANIFEST_FILE_PATTERN.match(name)
+            if not match or (min_dump_id and int(match.group(1)) < min_dump_id):
+                continue
+
+            stat = os.stat(os.path.join(manifest_directory, name))
+            yield {'Key': f'manifests/{name}',
+                   'ETag': f'{stat.st_size}-{stat.st_mtime_ns}',
+                   'Size': stat.st_size}
+
+    def open_file(self, path, start=0, length=None):
+        local_file = open(os.path.join(self.directory, path), 'rb')    # pylint: disable=consider-using-with
+        local_file.seek(start)
+        if length is None:
+            return local_file
+
+        with local_file:
+            return io.BytesIO(local_file.read(length))
+
+    def get_file_sizes(self, paths):
+        return [os.path.getsize(os.path.join(self.directory, path)) for path in paths]
+
+    def download_file(self, path, local_path):
+        shutil.copyfile(os.path.join(self.directory, path), local_path)
+
+    def get_worker_initializer(self, _config):
+        return None, ()
+
+
+def get_storage(config):
+    """Returns the storage for the config, the bucket unless `local_directory` points at a local
+    copy of it."""
+    if config.get('local_directory'):
+        return LocalStorage(config['bucket'], config['local_directory'])
+    return S3Storage(config['bucket'])
@@ -1,63 +1,76 @@
 from concurrent import futures
 
+import collections
+import contextlib
+import functools
+import itertools
+import json
 import multiprocessing
 from multiprocessing import ProcessError
 import time
-import re
-import queue
 import backoff
-import fastavro
 import singer
 
 from singer import metadata
-from singer import Transformer
 
-from tap_heap import s3
-from tap_heap.schema import generate_schema_from_avro
+from tap_heap import avro
+from tap_heap import changes
+from tap_heap import consumer
+from tap_heap import serialize
+from tap_heap import spool
+from tap_heap import stats
+from tap_heap import workers
+from tap_heap.config import get_flag
+from tap_heap.consumer import DEFAULT_RECORD_CHUNK_SIZE
+from tap_heap.file_index import build_file_index
+from tap_heap.file_index import get_file_key
+from tap_heap.plan import DEFAULT_ESTIMATED_WORKER_THROUGHPUT_MB
+from tap_heap.plan import estimate_sync_seconds
+from tap_heap.plan import get_unsynced_ranges
+from tap_heap.plan import plan_file_ranges
+from tap_heap.plan import TableSync
+from tap_heap.schema import translate_writer_schema
 
 LOGGER = singer.get_logger()
 
-# Define global queue
-QUEUE_TIMEOUT = 120
-QUEUE_MAX_LIMIT = 20000
-record_queue = multiprocessing.Queue(maxsize=QUEUE_MAX_LIMIT)
+# A file that fails to read is retried from its last block with a short, jittered backoff
+READ_MAX_TRIES = 5
+READ_MAX_BACKOFF = 30
 
 
-# This event will signal all producer and consumer threads to stop their execution
-# if all files are extracted or any other thread exits abruptly.
-terminate_event = multiprocessing.Event()
+def init_worker(ipc, initializer=None, initargs=()):
+    """Initializes a sync worker with the queue and event of the main process, then with the
+    `initializer` of its storage."""
+    consumer.use_ipc(ipc)
+    if initializer:
+        initializer(*initargs)
 
 
-def filter_manifests_to_sync(manifests, table_name, state):
-    """Filters a set of files for the table using 2 parts of the file name and drops up to
-    the bookmark if there is a bookmark."""
+def get_first_dump_to_sync(full_dump_ids, table_name, state):
+    """Returns the first dump of the table to sync and whether syncing it starts a new
+    version. A full table dump replaces the dumps before it, so the sync starts from the latest
+    of the sorted `full_dump_ids` unless the bookmark is already past it. A version that was
+    already started for that dump, as recorded by the `version_dump_id` bookmark, is resumed
+    even if the sync stopped before its first file was bookmarked."""
 
     bookmark = singer.get_bookmark(state, table_name, 'file')
     # bookmark = "sync_{DUMP_ID}/{TABLE_NAME}/part-00016-{GUID}.avro"
     bookmarked_version = singer.get_bookmark(state, table_name, 'version')
-    if bookmark and bookmarked_version:
-        bookmarked_dump_id = int(bookmark.split('/')[0].replace('sync_', ''))
-
-    full_table_dumps = [dump_id for dump_id, manifest in manifests.items()
-                        if manifest.get(table_name, {}).get('incremental') is False]
+    latest_full_dump_id = full_dump_ids[-1] if full_dump_ids else 0
 
     if bookmark and bookmarked_version:
-        minimum_dump_id_to_sync = max([bookmarked_dump_id] + full_table_dumps)
+        bookmarked_dump_id = key_fn(bookmark)[0]
+        minimum_dump_id_to_sync = max(bookmarked_dump_id, latest_full_dump_id)
         should_create_new_version = minimum_dump_id_to_sync != bookmarked_dump_id
     else:
-        if len(full_table_dumps) > 0:
-            minimum_dump_id_to_sync = max(full_table_dumps)
-        else:
-            minimum_dump_id_to_sync = 0
-
+        minimum_dump_id_to_sync = latest_full_dump_id
         should_create_new_version = True
 
-    # table_manifest[dump_id] = {"files" ["file 1"], "incremental": True, "columns": ["column_1"]}
-    table_manifests = {dump_id: manifest.get(table_name)
-                       for dump_id, manifest in manifests.items()
-                       if dump_id >= minimum_dump_id_to_sync and manifest.get(table_name)}
+    if should_create_new_version and bookmarked_version and \
+       singer.get_bookmark(state, table_name, 'version_dump_id') == latest_full_dump_id:
+        should_create_new_version = False
 
-    return (table_manifests, should_create_new_version)
+    return (minimum_dump_id_to_sync, should_create_new_version)
 
 def remove_prefix(file_name, bucket):
     path_prefix = f's3://{bucket}/'
@@ -71,155 +84,513 @@ def key_fn(key):
     This function returns a tuple: (int("852"), int("00000")
     """
 
-    file_path = key.split('/')
-    dump_id = file_path[0].replace('sync_', '')
-    part_number = re.findall('([0-9]+)', file_path[-1])[0]
-    return (int(dump_id), int(part_number))
+    return get_file_key(key)
+
+def get_deselected_fields(mdata):
+    """Returns the top level fields that `Transformer.filter_data_by_metadata` drops from a
+    record with this metadata."""
+    deselected_fields = set()
+    for breadcrumb, field_metadata in mdata.items():
+        if len(breadcrumb) != 2 or breadcrumb[0] != 'properties':
+            continue
+        if field_metadata.get('inclusion') == 'automatic':
+            continue
+        if field_metadata.get('selected') is False or \
+           field_metadata.get('inclusion') == 'unsupported':
+            deselected_fields.add(breadcrumb[1])
+    return deselected_fields
+
+class RecordSelector():
+    """Keeps the selected and automatic fields of a stream's records. It is built once per
+    stream and gives the same output as `Transformer.filter_data_by_metadata` for Heap's flat
+    records, without looking up the metadata of every field of every row."""
 
-def get_files_to_sync(table_manifests, table_name, state, bucket):
+    def __init__(self, stream):
+        mdata = metadata.to_map(stream['metadata'])
+        self.key_properties = metadata.get(mdata, (), 'table-key-properties')
+        self.deselected_fields = frozenset(get_deselected_fields(mdata))
+
+    def compile(self, field_names):
+        """Returns a function that filters records made of `field_names`, or None when none of
+        them are dropped and records can be written as they are."""
+        kept_fields = tuple(name for name in field_names if name not in self.deselected_fields)
+        if len(kept_fields) == len(field_names):
+            return None
+        return lambda row: {name: row[name] for name in kept_fields}
+
+def get_min_bookmarked_dump_id(streams, state):
+    """Returns the oldest dump that any of `streams` resumes from, or None if one of them has no
+    bookmark and needs every manifest. A full table dump older than a stream's bookmark never
+    changes what `get_first_dump_to_sync` picks for it, so older manifests can be skipped."""
+    dump_ids = []
+    for stream in streams:
+        table_name = stream['tap_stream_id']
+        bookmark = singer.get_bookmark(state, table_name, 'file')
+        bookmarked_version = singer.get_bookmark(state, table_name, 'version')
+        if not (bookmark and bookmarked_version):
+            return None
+        dump_ids.append(key_fn(bookmark)[0])
+
+    return min(dump_ids) if dump_ids else None
+
+def get_indexed_files_to_sync(table_files, min_dump_id, table_name, state):
+    """Returns the files of the table's `TableFiles` from `min_dump_id` on, after the
+    bookmark."""
     bookmark = singer.get_bookmark(state, table_name, 'file')
     bookmarked_version = singer.get_bookmark(state, table_name, 'version')
 
-    # Get flattened file names and remove the prefix
-    files = sorted([remove_prefix(file_name, bucket)
-                    for manifest in table_manifests.values()
-                    for file_name in manifest['files']], key=key_fn)
-
-    if bookmark and bookmarked_version and bookmark in files:
-        # NB> The bookmark is a fully synced file, so start immediately
-        # after the bookmark
-        files = files[files.index(bookmark)+1:]
+    # NB> The bookmark is a fully synced file, so start immediately
+    # after the bookmark
+    files = table_files.get_files(min_dump_id,
+                                  bookmark if bookmark and bookmarked_version else None)
 
     LOGGER.info("Found %d manifest files.", len(files))
     return files
 
-def write_records():
-    # Consumer thread will exit when terminate event is set but
-    # wait for queue to get empty after terminate event is set.
-    while not terminate_event.is_set() or record_queue.qsize():
-        try:
-            singer.write_message(record_queue.get(timeout=5))
-        except queue.Empty:
-            continue
-        except Exception as ex:    # pylint: disable=broad-exception-caught
-            terminate_event.set()
-            raise ProcessError("Consumer thread stopped abruptly!") from ex
-    LOGGER.info("Exiting from the consumer thread!")
-
-def sync_stream(bucket, state, stream, manifests, batch_size=5):    # pylint: disable=too-many-locals
+def start_table_sync(storage, state, stream, table_files, gate, split_size=0, config=None,    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals,too-many-branches
+                     worker_count=1):
+    """Plans the sync of a stream and returns its `TableSync`. With `schedule_largest_first`
+    set, its largest files are started first. Whenever the sizes of the files are known, the
+    bytes it plans to read are logged with an ETA for `worker_count` workers that each read
+    `estimated_worker_throughput_mb` per second."""
+    config = config or {}
+    largest_first = get_flag(config, 'schedule_largest_first')
     table_name = stream['stream']
     LOGGER.info('Syncing table "%s".', table_name)
 
-    table_manifests, should_create_new_version = filter_manifests_to_sync(manifests,
-                                                                          table_name,
-                                                                          state)
+    min_dump_id, should_create_new_version = get_first_dump_to_sync(table_files.full_dump_ids,
+                                                                    table_name,
+                                                                    state)
 
-    files = get_files_to_sync(table_manifests, table_name, state, bucket)
+    files = get_indexed_files_to_sync(table_files, min_dump_id, table_name, state)
 
-    records_streamed = 0
+    file_ranges = [[None]] * len(files)
+    # Heap's manifests do not list the sizes of the files, so they cost a HEAD request each
+    sizes = storage.get_file_sizes(files) if split_size or largest_first else None
+    if split_size:
+        file_ranges = [plan_file_ranges(size, split_size) for size in sizes]
+        LOGGER.info("Split %d large files into %d byte ranges.",
+                    sum(1 for byte_ranges in file_ranges if len(byte_ranges) > 1),
+                    sum(len(byte_ranges) for byte_ranges in file_ranges if len(byte_ranges) > 1))
 
+    bookmark = singer.get_bookmark(state, table_name, 'file')
     version = singer.get_bookmark(state, table_name, 'version')
-
-    if should_create_new_version:
+    key_properties = metadata.get(metadata.to_map(stream['metadata']), (),
+                                  'table-key-properties')
+    change_index = changes.get_change_index(config, table_name, key_properties)
+
+    if should_create_new_version and change_index and bookmark and version:
+        # The rows of the new full dump are compared with the index instead, under the same
+        # version, so rows missing from the new dump are not deleted
+        LOGGER.info('Detected full sync for stream table name %s, writing only its new and '
+                    'changed rows to version %d',
+                    table_name,
+                    version)
+        state = singer.clear_bookmark(state, table_name, 'checkpoints')
+        state = singer.write_bookmark(state, table_name, 'version_dump_id', min_dump_id)
+        gate.put_state(state)
+    elif should_create_new_version:
         # Set version so it can be used for an activate version message
         version = int(time.time() * 1000)
 
         LOGGER.info('Detected full sync for stream table name %s, setting version to %d',
                     table_name,
                     version)
+        # Checkpoints were written under the old version, so the new one syncs every row
+        state = singer.clear_bookmark(state, table_name, 'checkpoints')
         state = singer.write_bookmark(state, table_name, 'version', version)
-        singer.write_state(state)
-
-    with futures.ProcessPoolExecutor(max_workers=batch_size) as executor:
-        # Create and start the consumer process
-        consumer = multiprocessing.Process(target=write_records)
-        consumer.start()
-
-        stored_exception = None
-        for i in range(0, len(files), batch_size):
-            batch = files[i:i + batch_size]
-            future_to_file = {executor.submit(
-                sync_file, bucket, file_path, stream, version): file_path for file_path in batch}
-
-            # Wait for the current batch to complete
-            for future in futures.as_completed(future_to_file):
-                file_path = future_to_file[future]
-                try:
-                    records_streamed += future.result()
-                except Exception as ex:     # pylint: disable=broad-exception-caught
-                    stored_exception = ex
-                    terminate_event.set()
-                    break
-
-            if terminate_event.is_set():
-                raise Exception(f"Error reading file {file_path}") from stored_exception     # pylint: disable=broad-exception-raised
-
-            LOGGER.info("Extracted %d/%d manifest files.", i + batch_size, len(files))
-
-            # Finished syncing a file, write a bookmark
-            state = singer.write_bookmark(state, table_name, 'file', files[i + len(batch) - 1])
-            singer.write_state(state)
-
-        # Signal the consumer process to stop
-        LOGGER.info("Main thread is setting the terminate event after successful extraction!")
-        terminate_event.set()
-
-        LOGGER.info("Waiting for all records in the Queue to sync.")
-        consumer.join()
+        # A sync that stops before its first file is bookmarked resumes this version from its
+        # checkpoints
+        state = singer.write_bookmark(state, table_name, 'version_dump_id', min_dump_id)
+        gate.put_state(state)
+        if change_index:
+            # A new version writes every row again, so start the index over. A version that is
+            # resumed keeps what its synced files staged and merged
+            change_index.reset()
+    else:
+        checkpoints = singer.get_bookmark(state, table_name, 'checkpoints', {})
+        if checkpoints:
+            LOGGER.info("Resuming %d partially synced files.",
+                        sum(1 for s3_path in files if s3_path in checkpoints))
+            file_ranges = [get_unsynced_ranges(byte_ranges, checkpoints.get(s3_path))
+                           for s3_path, byte_ranges in zip(files, file_ranges)]
+
+    change_filter = None
+    if change_index:
+        change_index.prepare(files)
+        full_dump_ids = [dump_id for dump_id in table_files.full_dump_ids
+                         if dump_id >= min_dump_id]
+        change_filter = change_index.get_filter(key_properties, full_dump_ids,
+                                                bookmark if version else None)
+
+    table_sync = TableSync(stream, RecordSelector(stream), files, version, file_ranges,
+                           change_index, change_filter)
+    if largest_first:
+        table_sync.schedule_largest_first(sizes)
+    if sizes is not None:
+        unit_sizes = table_sync.get_unit_sizes(sizes)
+        throughput = float(config.get('estimated_worker_throughput_mb',
+                                      DEFAULT_ESTIMATED_WORKER_THROUGHPUT_MB)) * 1024 * 1024
+        LOGGER.info('Planned %.1f MB in %d units of work for table "%s", estimated to take '
+                    '%.1f s with %d workers.',
+                    sum(unit_sizes) / (1024 * 1024),
+                    len(unit_sizes),
+                    table_name,
+                    estimate_sync_seconds(unit_sizes, worker_count, throughput),
+                    worker_count)
+    return table_sync
+
+def finish_table_sync(table_sync, gate):
+    if table_sync.records_streamed > 0:
+        LOGGER.info('Sending activate version message %d', table_sync.version)
+        gate.put(singer.ActivateVersionMessage(stream=table_sync.table_name,
+                                               version=table_sync.version))
+
+    LOGGER.info('Wrote %s records for table "%s".',
+                table_sync.records_streamed,
+                table_sync.table_name)
+    if table_sync.change_filter:
+        LOGGER.info('Skipped %s unchanged records for table "%s".',
+                    table_sync.file_stats.unchanged_records,
+                    table_sync.table_name)
+    if table_sync.change_index:
+        table_sync.change_index.close()
+
+    # The stage times add up the time of every worker, so they can exceed the elapsed time
+    elapsed = time.monotonic() - table_sync.started_at
+    file_stats = table_sync.file_stats
+    LOGGER.info('Synced table "%s" in %.1f s at %.0f records/s. Workers spent %.1f s reading '
+                '%.1f MB, %.1f s decoding and %.1f s waiting on the record queue.',
+                table_sync.table_name,
+                elapsed,
+                table_sync.records_streamed / elapsed if elapsed else 0,
+                file_stats.read_seconds,
+                file_stats.bytes_read / (1024 * 1024),
+                file_stats.get_decode_seconds(),
+                file_stats.queue_put_seconds)
+    file_stats.log('stream_sync', stream=table_sync.table_name, files=file_stats.files,
+                   units=file_stats.units, elapsed_seconds=round(elapsed, 3))
+
+def get_worker_scaler(config, batch_size):
+    """Builds the `WorkerScaler` for the `max_workers` config, `batch_size` by default. With
+    `adaptive_workers` set the number of workers moves between `min_workers` and `max_workers`,
+    which then defaults to the CPUs available to the tap."""
+    max_workers = int(config.get('max_workers', 0))
+    if get_flag(config, 'adaptive_workers'):
+        max_workers = max_workers or workers.get_default_max_workers()
+        return workers.WorkerScaler(int(config.get('min_workers', 1)), max_workers)
+
+    max_workers = max_workers or batch_size
+    return workers.WorkerScaler(max_workers, max_workers)
+
+def sync_streams(storage, state, streams, manifests, batch_size=5, config=None,    # pylint: disable=too-many-locals,too-many-branches,too-many-statements,too-many-arguments,too-many-positional-arguments
+                 file_index=None):
+    """Syncs `streams` on one shared pool of workers and one consumer process that writes every
+    message, including STATE and ACTIVATE_VERSION, so stdout has a single writer. The pool has
+    `max_workers` workers, `batch_size` unless configured, and may run fewer of them in the
+    adaptive mode, see `get_worker_scaler`.
+    Up to `max_concurrent_streams` streams run at once and each one is limited to
+    `max_workers_per_stream` files in flight. With `spool_dir` set, the next
+    `spool_read_ahead` files are downloaded to local disk ahead of the workers, and a file is
+    only handed to a worker once its download is complete. With `checkpoint_interval` set,
+    the byte ranges of files synced so far are kept in STATE, written at least that many
+    seconds apart while files are in progress, so an interrupted file resumes where it stopped.
+    The consumer buffers up to `output_buffer_size_mb` of output and flushes it at least every
+    `output_flush_interval` seconds, see `serialize.OutputWriter`.
+    With `schedule_largest_first` set, each stream starts its largest files first, see
+    `start_table_sync`.
+    `file_index` is built from `manifests` unless the caller already has one.
+    Returns the number of records per table."""
+    config = config or {}
+    file_index = file_index or build_file_index(manifests, storage.bucket)
+    chunk_size = int(config.get('record_chunk_size', DEFAULT_RECORD_CHUNK_SIZE))
+    serialize_records = get_flag(config, 'serialize_in_workers')
+    max_concurrent_streams = int(config.get('max_concurrent_streams', 1))
+    scaler = get_worker_scaler(config, batch_size)
+    max_workers_per_stream = int(config.get('max_workers_per_stream', scaler.max_workers))
+    split_size = int(float(config.get('split_file_size_mb', 0)) * 1024 * 1024)
+    spool_dir = config.get('spool_dir')
+    spool_read_ahead = int(config.get('spool_read_ahead', spool.DEFAULT_SPOOL_READ_AHEAD))
+    checkpoint_interval = float(config.get('checkpoint_interval', 0))
+    output_buffer_size = int(float(config.get('output_buffer_size_mb', 1)) * 1024 * 1024)
+    output_flush_interval = float(config.get('output_flush_interval',
+                                             serialize.DEFAULT_OUTPUT_FLUSH_INTERVAL))
+
+    records_streamed = {}
+    pending_streams = collections.deque(streams)
+    table_syncs = []
+    gate = consumer.MessageGate()
+    # The files being decoded stay spooled too, so room is left for one per worker
+    spooler = spool.Spooler(storage, spool_dir, scaler.max_workers + spool_read_ahead) \
+        if spool_dir else contextlib.nullcontext()
+
+    LOGGER.info("Syncing with %s workers.",
+                scaler.max_workers if scaler.is_fixed() else
+                f'{scaler.min_workers} to {scaler.max_workers}')
+
+    # Every worker builds its S3 client once, with the credentials resolved here
+    ipc = consumer.open_ipc(chunk_size)
+    with futures.ProcessPoolExecutor(max_workers=scaler.max_workers, initializer=init_worker,
+                                     initargs=(ipc, *storage.get_worker_initializer(config))) \
+         as executor, spooler as spooler:
+        # A failure in this process must stop the workers and the consumer as well, or the
+        # consumer waits on the queue forever
+        try:    # pylint: disable=too-many-nested-blocks
+            # Create and start the consumer process
+            consumer_process = multiprocessing.Process(target=consumer.run_consumer,
+                                                       args=(ipc, checkpoint_interval,
+                                                             output_buffer_size,
+                                                             output_flush_interval))
+            consumer_process.start()
+            if checkpoint_interval:
+                # Checkpoints are written on top of the latest STATE, so the consumer needs one
+                gate.put_state(state)
+
+            future_to_file = {}
+            while pending_streams or table_syncs:
+                while pending_streams and len(table_syncs) < max_concurrent_streams:
+                    stream = pending_streams.popleft()
+                    table_syncs.append(start_table_sync(storage, state, stream,
+                                                        file_index[stream['stream']], gate,
+                                                        split_size, config,
+                                                        min(scaler.max_workers,
+                                                            max_workers_per_stream)))
+
+                if spooler:
+                    spooler.prefetch(s3_path for table_sync in table_syncs
+                                     for s3_path in table_sync.pending_files())
+
+                # Keep up to `target` files in flight, taking turns between the streams, and
+                # submit the next file as soon as any worker frees up so one slow file does not
+                # leave the rest of the pool idle
+                target = scaler.update(consumer.get_queue_fill())
+                submitted = True
+                while submitted and len(future_to_file) < target:
+                    submitted = False
+                    for table_sync in table_syncs:
+                        if len(future_to_file) >= target:
+                            break
+                        if not table_sync.has_pending_units() or \
+                           table_sync.in_flight >= max_workers_per_stream:
+                            continue
+
+                        local_path = None
+                        if spooler:
+                            local_path = spooler.get_local_path(
+                                table_sync.files[table_sync.next_unit()[0]])
+                            if local_path is None:
+                                continue
+
+                        index, byte_range = table_sync.start_unit()
+                        future = executor.submit(sync_file, storage, table_sync.files[index],
+                                                 table_sync.stream, table_sync.version, chunk_size,
+                                                 serialize_records, table_sync.selector, byte_range,
+                                                 local_path, bool(checkpoint_interval),
+                                                 table_sync.change_filter)
+                        future_to_file[future] = (table_sync, index, byte_range)
+                        submitted = True
+
+                # Wake up for a finished download as well, it may let a file be submitted, and
+                # for a finished merge into a change index, which lets the bookmark move
+                waiting_on = list(future_to_file) + \
+                    (spooler.pending_downloads() if spooler else []) + \
+                    [merge for table_sync in table_syncs for merge in table_sync.pending_merges()]
+                if not waiting_on and any(table_sync.has_pending_units()
+                                          for table_sync in table_syncs):
+                    raise Exception("No file can be started while no file is being synced or "     # pylint: disable=broad-exception-raised
+                                    "downloaded, so the sync would never finish.")
+                if waiting_on:
+                    # The adaptive mode also wakes up to look at the queue again
+                    done, _ = futures.wait(waiting_on,
+                                           timeout=None if scaler.is_fixed() else scaler.interval,
+                                           return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        if future not in future_to_file:
+                            continue
+                        table_sync, index, byte_range = future_to_file.pop(future)
+                        file_path = table_sync.files[index]
+                        try:
+                            file_stats = future.result()
+                        except Exception as ex:     # pylint: disable=broad-exception-caught
+                            consumer.terminate_event.set()
+                            raise Exception(f"Error reading file {file_path}") from ex     # pylint: disable=broad-exception-raised
+                        file_synced = table_sync.complete_unit(index, file_stats)
+                        scaler.record_completed(file_stats.records)
+                        gate.file_synced((table_sync.table_name, file_path, byte_range))
+                        if spooler and file_synced:
+                            spooler.release(file_path)
+
+                for table_sync in list(table_syncs):
+                    if table_sync.advance():
+                        LOGGER.info("Extracted %d/%d manifest files for table \"%s\".",
+                                    table_sync.watermark,
+                                    len(table_sync.files),
+                                    table_sync.table_name)
+
+                        # Every file up to the watermark is fully synced, write a bookmark
+                        state = singer.write_bookmark(state, table_sync.table_name, 'file',
+                                                      table_sync.files[table_sync.watermark - 1])
+                        gate.put_state(state)
+
+                    if table_sync.is_done():
+                        finish_table_sync(table_sync, gate)
+                        records_streamed[table_sync.table_name] = table_sync.records_streamed
+                        table_syncs.remove(table_sync)
+
+            # Signal the consumer process to stop once it has written everything before this
+            LOGGER.info("Main thread is ending the records after successful extraction!")
+            gate.put(consumer.EndOfRecords())
+
+            LOGGER.info("Waiting for all records in the Queue to sync.")
+            consumer_process.join()
+        except BaseException:
+            consumer.terminate_event.set()
+            raise
 
         # Clear any thread terminate event set earlier before stream extraction starts
-        terminate_event.clear()
+        consumer.terminate_event.clear()
 
-    if records_streamed > 0:
-        LOGGER.info('Sending activate version message %d', version)
-        message = singer.ActivateVersionMessage(stream=table_name, version=version)
-        singer.write_message(message)
-        record_queue.put(message)
-
-    LOGGER.info('Wrote %s records for table "%s".', records_streamed, table_name)
     return records_streamed
 
-
-@backoff.on_exception(backoff.constant,
-                      (Exception, queue.Full),
-                      max_tries=3,
-                      interval=60)
-def sync_file(bucket, s3_path, stream, version=None):
-    LOGGER.info('Syncing file "%s".', s3_path)
+def sync_stream(storage, state, stream, manifests, batch_size=5, config=None):    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    return sync_streams(storage, state, [stream], manifests, batch_size, config)[stream['stream']]
+
+
+class FileProgress():
+    """How far `sync_file` got through its byte range. A failed read resumes at the block that
+    was being decoded, skipping the rows of it that were already queued, and the chunk that was
+    being filled is kept, so a retry never writes a record twice or drops one."""
+
+    def __init__(self, byte_range):
+        self.byte_range = byte_range
+        self.chunk = []
+        self.schema_fingerprint = None
+        self.block_offset = None
+        self.block_rows = 0
+        self.records_synced = 0
+        self.finished = False
+
+    def get_resume_range(self):
+        if self.block_offset is None:
+            return self.byte_range
+        return (self.block_offset, self.byte_range[1] if self.byte_range else None)
+
+
+def sync_file(storage, s3_path, stream, version=None, chunk_size=DEFAULT_RECORD_CHUNK_SIZE,    # pylint: disable=too-many-locals,too-many-arguments,too-many-positional-arguments,too-many-statements
+              serialize_records=False, selector=None, byte_range=None, local_path=None,
+              report_progress=False, change_filter=None):
+    """Syncs the file at `s3_path`, or only the Avro blocks that start inside `byte_range`. The
+    file is decoded from `local_path` instead of S3 if it was spooled there. With
+    `report_progress` set, the consumer is told after each block which part of the file has
+    been written, for checkpoints. With a `change_filter`, rows it finds unchanged are skipped.
+    Returns the `FileStats` of the sync."""
+    started = time.monotonic()
+    if byte_range:
+        LOGGER.info('Syncing bytes %s-%s of file "%s".', byte_range[0], byte_range[1], s3_path)
+    else:
+        LOGGER.info('Syncing file "%s".', s3_path)
 
     table_name = stream['stream']
-
-    try:
-        s3_file_handle = s3.get_file_handle(bucket, s3_path)
-        iterator = fastavro.reader(s3_file_handle._raw_stream)
-        mdata = metadata.to_map(stream['metadata'])
-        schema = generate_schema_from_avro(iterator.schema)
-
-        key_properties = metadata.get(mdata, (), 'table-key-properties')
-        record_queue.put(singer.SchemaMessage(stream=(table_name),
-                                        schema=schema,
-                                        key_properties=key_properties),
-                timeout=QUEUE_TIMEOUT)
-
-        records_synced = 0
-        with Transformer() as transformer:
-            for row in iterator:
+    file_id = (table_name, s3_path, byte_range)
+    selector = selector or RecordSelector(stream)
+    progress = FileProgress(byte_range)
+    file_stats = stats.FileStats()
+    _, terminate = consumer.open_ipc()
+    row_changes = change_filter.open(s3_path, byte_range) \
+        if change_filter else None
+
+    if local_path:
+        open_stream = spool.open_mapped_file(local_path)
+    else:
+        open_stream = functools.partial(storage.open_file, s3_path)
+    open_stream = file_stats.meter(open_stream)
+
+    # When `serialize_records` is set the records are JSON encoded here, so the encoding work
+    # is spread across the pool and the consumer only copies bytes to stdout
+    encode_record = serialize.get_record_encoder() if serialize_records else None
+
+    def log_resume(details):
+        LOGGER.warning('Error reading file "%s", resuming from byte %s: %s',
+                       s3_path,
+                       (progress.get_resume_range() or (0, None))[0],
+                       details['exception'])
+
+    @backoff.on_exception(backoff.expo,
+                          Exception,
+                          max_tries=READ_MAX_TRIES,
+                          max_value=READ_MAX_BACKOFF,
+                          giveup=lambda ex: isinstance(ex, ProcessError),
+                          on_backoff=log_resume)
+    def sync_blocks():
+        # Deselected columns are left out of the reader schema, so they are never decoded
+        writer_schema, reader_schema, blocks = avro.read_blocks(open_stream,
+                                                                selector.deselected_fields,
+                                                                progress.get_resume_range())
+
+        # Only needs to filter rows if the reader still decodes some deselected columns
+        decoded_schema = reader_schema or writer_schema
+        select_fields = selector.compile([field['name'] for field in decoded_schema['fields']])
+
+        if progress.schema_fingerprint is None:
+            # The schema goes out with the first chunk so it always precedes the file's records
+            schema, progress.schema_fingerprint = translate_writer_schema(
+                json.dumps(writer_schema, sort_keys=True))
+            progress.chunk.insert(0, consumer.StreamSchema(
+                table_name,
+                progress.schema_fingerprint,
+                singer.SchemaMessage(stream=(table_name),
+                                     schema=schema,
+                                     key_properties=selector.key_properties)))
+
+        for offset, block in blocks:
+            if offset != progress.block_offset:
+                if report_progress and progress.records_synced:
+                    progress.chunk.append(consumer.BlocksSynced(file_id, offset))
+                progress.block_offset = offset
+                progress.block_rows = 0
+
+            for row in itertools.islice(block, progress.block_rows, None):
                 # Terminate the thread execution
                 # if any of produceror consumer threads exits abruptly
-                if terminate_event.is_set():
+                if terminate.is_set():
                     raise ProcessError("Received event to terminate the thread abruptly!")
 
-                to_write = transformer.filter_data_by_metadata(row, mdata)
-                record_queue.put(
-                    singer.RecordMessage(table_name, to_write, version=version),
-                    timeout=QUEUE_TIMEOUT)
-                records_synced += 1
+                to_write = select_fields(row) if select_fields else row
+                progress.block_rows += 1
+                if row_changes and not row_changes.is_changed(to_write):
+                    file_stats.unchanged_records += 1
+                    continue
 
-        LOGGER.info('Wrote %d records for file %s', records_synced, s3_path)
-        return records_synced
-    except queue.Full as ex:
-        raise ex
+                message = singer.RecordMessage(table_name, to_write, version=version)
+                progress.chunk.append(encode_record(message) if encode_record else message)
+                progress.records_synced += 1
+
+                if len(progress.chunk) >= chunk_size:
+                    consumer.put_chunk(progress.chunk, encode_record is not None, file_stats)
+                    progress.chunk = [consumer.StreamSchema(table_name,
+                                                            progress.schema_fingerprint)]
+
+        # Flush the remainder of the file, followed by the marker that it is complete
+        if not progress.finished:
+            progress.chunk.append(consumer.FileSynced(file_id))
+            progress.finished = True
+        consumer.put_chunk(progress.chunk, encode_record is not None, file_stats)
+
+    completed = False
+    try:
+        sync_blocks()
+        completed = True
     except ProcessError as ex:
         raise ex
     except Exception as ex:
         raise ProcessError(f"Terminated {s3_path} extraction thread!") from ex
+    finally:
+        if row_changes:
+            row_changes.close(completed)
+
+    LOGGER.info('Wrote %d records for file %s', progress.records_synced, s3_path)
+    file_stats.units = 1
+    file_stats.records = progress.records_synced
+    file_stats.total_seconds = time.monotonic() - started
+    file_stats.log('file_sync', stream=table_name, file=s3_path)
+    return file_stats
@@ -0,0 +1,126 @@
+import math
+import os
+import time
+
+import singer
+
+LOGGER = singer.get_logger()
+
+# How often the adaptive mode looks at the queue and the throughput, in seconds
+SCALE_INTERVAL = 10
+# The consumer is the bottleneck above this queue fill level, and idle below the low one
+QUEUE_HIGH_WATER = 0.8
+QUEUE_LOW_WATER = 0.2
+# An extra worker has to add this much throughput to be kept
+MIN_SCALE_UP_GAIN = 0.05
+# Intervals to wait before trying again to add a worker that did not pay off
+PLATEAU_INTERVALS = 6
+
+
+def get_cgroup_cpu_quota():
+    """Returns the number of CPUs the cgroup of this process may use, or None without a limit.
+    Reads the cgroup v2 `cpu.max` and falls back to the cgroup v1 CFS quota."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max', encoding='utf-8') as cpu_max:
+            quota, period = cpu_max.read().split()[:2]
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', encoding='utf-8') as quota_file, \
+             open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', encoding='utf-8') as period_file:
+            quota, period = int(quota_file.read()), int(period_file.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def get_available_cpus():
+    """Returns how many CPUs this process can run on, from its CPU affinity and any cgroup CPU
+    quota of the container it runs in."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = get_cgroup_cpu_quota()
+    if quota:
+        cpus = min(cpus, math.ceil(quota))
+    return max(cpus, 1)
+
+
+def get_default_max_workers():
+    # One CPU is left for the consumer process and the main process
+    return max(get_available_cpus() - 1, 1)
+
+
+class WorkerScaler():    # pylint: disable=too-many-instance-attributes
+    """Decides how many files `sync_streams` keeps in flight, between `min_workers` and
+    `max_workers`. Every `interval` seconds it compares the records synced per second with the
+    previous interval and the fill level of the record queue. It drops a worker when the queue
+    is nearly full, as the consumer cannot keep up anyway. It adds one when the queue is nearly
+    empty, and takes it back if throughput did not grow with it. With equal bounds the number
+    of workers is fixed."""
+
+    def __init__(self, min_workers, max_workers, interval=SCALE_INTERVAL):
+        self.min_workers = max(min(min_workers, max_workers), 1)
+        self.max_workers = max_workers
+        self.interval = interval
+        self.target = max_workers if self.is_fixed() else self.min_workers
+        self.window_start = time.monotonic()
+        self.window_records = 0
+        self.last_rate = None
+        self.scaled_up = False
+        self.plateau = None
+        self.plateau_intervals = 0
+
+    def is_fixed(self):
+        return self.min_workers == self.max_workers
+
+    def record_completed(self, records):
+        self.window_records += records
+
+    def update(self, queue_fill):
+        """Moves the target after each interval, given the fill level of the record queue as a
+        fraction, or None if it is not known. Returns the target."""
+        elapsed = time.monotonic() - self.window_start
+        # Records are counted as files finish, so wait until some have
+        if self.is_fixed() or elapsed < self.interval or not self.window_records:
+            return self.target
+
+        rate = self.window_records / elapsed
+        target = self.target
+        if self.plateau is not None:
+            self.plateau_intervals += 1
+            if self.plateau_intervals >= PLATEAU_INTERVALS:
+                self.plateau = None
+
+        if queue_fill is not None and queue_fill >= QUEUE_HIGH_WATER:
+            target -= 1
+        elif self.scaled_up and self.last_rate and \
+             rate < self.last_rate * (1 + MIN_SCALE_UP_GAIN):
+            # The last worker added did not pay off, so go back and stay there for a while
+            target -= 1
+            self.plateau = target
+            self.plateau_intervals = 0
+        elif (queue_fill is None or queue_fill <= QUEUE_LOW_WATER) and \
+             (self.plateau is None or target < self.plateau):
+            target += 1
+
+        target = min(max(target, self.min_workers), self.max_workers)
+        self.scaled_up = target > self.target
+        if target != self.target:
+            LOGGER.info("Changing workers from %d to %d (%.0f records/s, %.0f per worker, "
+                        "queue %s full).",
+                        self.target,
+                        target,
+                        rate,
+                        rate / self.target,
+                        'unknown' if queue_fill is None else f'{queue_fill:.0%}')
+
+        self.target = target
+        self.last_rate = rate
+        self.window_start = time.monotonic()
+        self.window_records = 0
+        return self.target
@@ -0,0 +1,163 @@
+import io
+import unittest
+from unittest import mock
+
+import fastavro
+
+from tap_heap import avro
+
+SCHEMA = {
+    "type": "record",
+    "name": "topLevelRecord",
+    "fields": [
+        {"name": "event_id", "type": ["long", "null"]},
+        {"name": "time", "type": ["string", "null"]},
+        {"name": "custom_property", "type": ["string", "null"]},
+        {"name": "score", "type": "double"},
+    ]
+}
+
+
+def write_avro_file(records, **kwargs):
+    avro_file = io.BytesIO()
+    fastavro.writer(avro_file, SCHEMA, records, **kwargs)
+    avro_file.seek(0)
+    return avro_file
+
+
+def open_stream(data, opened=None):
+    def open_range(offset, length=None):
+        if opened is not None:
+            opened.append((offset, length))
+        return io.BytesIO(data[offset:] if length is None else data[offset:offset + length])
+    return open_range
+
+
+def read_records(blocks):
+    return [record for _, block in blocks for record in block]
+
+
+class TestReadBlocks(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [{"event_id": i, "time": "2021-04-07", "custom_property": "x" * i,
+                         "score": i / 2} for i in range(500)]
+        self.data = write_avro_file(self.records, sync_interval=500).getvalue()
+
+    def test_reads_every_field_without_exclusions(self):
+        writer_schema, reader_schema, blocks = avro.read_blocks(open_stream(self.data))
+
+        self.assertEqual(SCHEMA["fields"], writer_schema["fields"])
+        self.assertIsNone(reader_schema)
+        self.assertListEqual(self.records, read_records(blocks))
+
+    def test_excluded_fields_are_not_decoded(self):
+        _, reader_schema, blocks = avro.read_blocks(open_stream(self.data),
+                                                    {"custom_property", "score"})
+
+        self.assertListEqual(["event_id", "time"],
+                             [field["name"] for field in reader_schema["fields"]])
+        self.assertListEqual([{"event_id": r["event_id"], "time": r["time"]}
+                              for r in self.records],
+                             read_records(blocks))
+
+    def test_byte_ranges_read_every_block_once(self):
+        for range_size in [100, 777, 4096, len(self.data) - 1]:
+            records = []
+            for start in range(0, len(self.data), range_size):
+                byte_range = (start, min(start + range_size, len(self.data)))
+                _, _, blocks = avro.read_blocks(open_stream(self.data), (), byte_range)
+                records += read_records(blocks)
+
+            self.assertListEqual(self.records, records, f"range size {range_size}")
+
+    @mock.patch("tap_heap.avro.BLOCK_READ_AHEAD", 1)
+    def test_byte_ranges_read_further_when_the_last_block_needs_it(self):
+        for range_size in [100, 777, 4096]:
+            records = []
+            for start in range(0, len(self.data), range_size):
+                byte_range = (start, min(start + range_size, len(self.data)))
+                _, _, blocks = avro.read_blocks(open_stream(self.data), (), byte_range)
+                records += read_records(blocks)
+
+            self.assertListEqual(self.records, records, f"range size {range_size}")
+
+    @mock.patch("tap_heap.avro.HEADER_READ_SIZES", (1000, None))
+    def test_byte_ranges_are_read_with_bounded_reads(self):
+        middle = len(self.data) // 2
+        opened = []
+        _, _, blocks = avro.read_blocks(open_stream(self.data, opened), (), (middle, middle + 600))
+        read_records(blocks)
+
+        # The header fits in the first read, and the range is read about a block past its end
+        self.assertEqual((0, 1000), opened[0])
+        self.assertEqual((middle - avro.SYNC_SIZE, avro.SYNC_SIZE + 600 + avro.BLOCK_READ_AHEAD),
+                         opened[1])
+        self.assertEqual(2, len(opened))
+
+    def test_block_offsets_are_file_offsets(self):
+        _, _, blocks = avro.read_blocks(open_stream(self.data))
+
+        expected_offsets = [block.offset for block in
+                            fastavro.block_reader(io.BytesIO(self.data))]
+        self.assertListEqual(expected_offsets, [offset for offset, _ in blocks])
+
+    def test_ranged_stream_reads_to_the_end_of_the_file(self):
+        opened = []
+        stream = avro.RangedStream(open_stream(b"0123456789", opened), 2, 4)
+
+        self.assertEqual(b"2345", stream.read(4))
+        # Reads further from a byte early, twice as much at a time
+        self.assertEqual(b"6789", stream.read())
+        self.assertEqual(b"", stream.read(1))
+        self.assertListEqual([(2, 4), (5, 9)], opened)
+
+    def test_ranged_stream_ends_where_the_file_ends(self):
+        opened = []
+        stream = avro.RangedStream(open_stream(b"0123456789", opened), 6, 4)
+
+        self.assertEqual(b"6789", stream.read(10))
+        self.assertListEqual([(6, 4), (9, 9)], opened)
+
+    @mock.patch("tap_heap.avro.HEADER_READ_SIZES", (100, 1000, None))
+    def test_bounded_header_reads_more_when_it_does_not_fit(self):
+        opened = []
+        header, header_bytes = avro.read_bounded_header(open_stream(self.data, opened))
+
+        self.assertEqual(header_bytes, self.data[:len(header_bytes)])
+        self.assertIn("avro.schema", header["meta"])
+        self.assertListEqual([(0, 100), (0, 1000)], opened)
+
+    def test_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            avro.read_header(io.BytesIO(b'{"not": "avro"}' * 10))
+
+
+class TestFindBlockStart(unittest.TestCase):
+
+    @mock.patch("tap_heap.avro.SCAN_SIZE", 5)
+    def test_finds_marker_split_across_reads(self):
+        sync_marker = bytes(range(16))
+        data = b'x' * 13 + sync_marker + b'block'
+
+        stream = io.BytesIO(data)
+
+        block_start, prefix = avro.find_block_start(stream, sync_marker, 100)
+
+        self.assertEqual(100 + 13 + 16, block_start)
+        self.assertEqual(b'block', prefix + stream.read())
+
+    def test_no_marker(self):
+        self.assertEqual((None, b''),
+                         avro.find_block_start(io.BytesIO(b'x' * 100), bytes(range(16)), 0))
+
+
+class TestChainedStream(unittest.TestCase):
+
+    def test_reads_prefix_then_stream(self):
+        stream = avro.ChainedStream(b'abc', io.BytesIO(b'defgh'))
+
+        self.assertEqual(b'ab', stream.read(2))
+        self.assertEqual(b'cde', stream.read(3))
+        self.assertEqual(5, stream.tell())
+        self.assertEqual(b'fgh', stream.read())
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+from tap_heap.cache import ManifestCache
+
+
+class TestManifestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = ManifestCache(self.temp_dir.name)
+        self.manifest = {"dump_id": 123, "tables": [{"name": "table1", "files": ["file1"]}]}
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_returns_cached_manifest(self):
+        self.cache.put("manifests/sync_123.json", '"etag1"', self.manifest)
+
+        self.assertDictEqual(self.manifest, self.cache.get("manifests/sync_123.json", '"etag1"'))
+
+    def test_changed_etag_is_a_miss(self):
+        self.cache.put("manifests/sync_123.json", '"etag1"', self.manifest)
+
+        self.assertIsNone(self.cache.get("manifests/sync_123.json", '"etag2"'))
+
+    def test_unreadable_entry_is_a_miss(self):
+        self.cache.put("manifests/sync_123.json", '"etag1"', self.manifest)
+        path = self.cache._path("manifests/sync_123.json", '"etag1"')
+        with open(path, 'w', encoding='utf-8') as cache_file:
+            cache_file.write('{"dump_id": ')
+
+        self.assertIsNone(self.cache.get("manifests/sync_123.json", '"etag1"'))
+        self.assertFalse(os.path.exists(path))
+
+    def test_evicts_least_recently_used_entries(self):
+        for dump_id in range(3):
+            self.cache.put(f"manifests/sync_{dump_id}.json", '"etag"', self.manifest)
+            path = self.cache._path(f"manifests/sync_{dump_id}.json", '"etag"')
+            os.utime(path, (dump_id, dump_id))
+        entry_size = os.path.getsize(path)
+
+        self.cache.max_bytes = entry_size * 2
+        self.cache.evict()
+
+        self.assertIsNone(self.cache.get("manifests/sync_0.json", '"etag"'))
+        self.assertIsNotNone(self.cache.get("manifests/sync_1.json", '"etag"'))
+        self.assertIsNotNone(self.cache.get("manifests/sync_2.json", '"etag"'))
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+from tap_heap.changes import ChangeIndex
+
+
+class TestChangeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.change_index = ChangeIndex(self.temp_dir.name, "users")
+        self.change_index.prepare(["sync_1/users/part-00000-a.avro"])
+
+    def tearDown(self):
+        self.change_index.close()
+        self.temp_dir.cleanup()
+
+    def sync_rows(self, change_filter, s3_path, rows, completed=True):
+        row_changes = change_filter.open(s3_path, None)
+        changed = [row for row in rows if row_changes.is_changed(row)]
+        row_changes.close(completed)
+        return changed
+
+    def test_full_dump_emits_new_and_changed_rows(self):
+        rows = [{"user_id": i, "name": f"user {i}"} for i in range(5)]
+        first_sync = self.change_index.get_filter(["user_id"], [1], None)
+        self.assertListEqual(rows, self.sync_rows(first_sync, "sync_1/users/part-00000-a.avro",
+                                                  rows))
+        self.change_index.commit_files(["sync_1/users/part-00000-a.avro"])
+
+        rows[2] = {"user_id": 2, "name": "renamed"}
+        rows.append({"user_id": 5, "name": "user 5"})
+        second_sync = self.change_index.get_filter(["user_id"], [2], "sync_1/users/part-00000-a.avro")
+        self.assertListEqual([rows[2], rows[5]],
+                             self.sync_rows(second_sync, "sync_2/users/part-00000-a.avro", rows))
+
+    def test_files_are_merged_in_the_background(self):
+        rows = [{"user_id": 1, "name": "user 1"}]
+        self.sync_rows(self.change_index.get_filter(["user_id"], [1], None),
+                       "sync_1/users/part-00000-a.avro", rows)
+        self.change_index.merge_files(["sync_1/users/part-00000-a.avro"]).result()
+
+        self.assertListEqual([], os.listdir(self.change_index.staging_directory))
+        second_sync = self.change_index.get_filter(["user_id"], [2], "sync_1/users/part-00000-a.avro")
+        self.assertListEqual([], self.sync_rows(second_sync, "sync_2/users/part-00000-a.avro", rows))
+
+    def test_rows_committed_past_the_bookmark_are_emitted_again(self):
+        rows = [{"user_id": 1, "name": "user 1"}]
+        self.sync_rows(self.change_index.get_filter(["user_id"], [1], None),
+                       "sync_1/users/part-00000-a.avro", rows)
+        self.change_index.commit_files(["sync_1/users/part-00000-a.avro"])
+
+        # The STATE that moved the bookmark to the file was lost, so it is synced again
+        resumed_sync = self.change_index.get_filter(["user_id"], [1], "sync_0/users/part-00000-a.avro")
+        self.assertListEqual(rows, self.sync_rows(resumed_sync, "sync_1/users/part-00000-a.avro",
+                                                  rows))
+
+    def test_rows_of_a_file_with_the_same_part_past_the_bookmark_are_emitted_again(self):
+        rows = [{"user_id": 1, "name": "user 1"}]
+        s3_path = "sync_1/users/part-00000-a-c001.avro"
+        self.change_index.prepare([s3_path])
+        self.sync_rows(self.change_index.get_filter(["user_id"], [1], None), s3_path, rows)
+        self.change_index.commit_files([s3_path])
+
+        resumed_sync = self.change_index.get_filter(["user_id"], [1],
+                                                    "sync_1/users/part-00000-a-c000.avro")
+        self.assertListEqual(rows, self.sync_rows(resumed_sync, s3_path, rows))
+
+    def test_incremental_rows_are_always_emitted_and_failed_units_stage_nothing(self):
+        rows = [{"user_id": 1, "name": "user 1"}]
+        change_filter = self.change_index.get_filter(["user_id"], [], "sync_1/users/part-00000-a.avro")
+
+        self.assertListEqual(rows, self.sync_rows(change_filter, "sync_2/users/part-00000-a.avro",
+                                                  rows, completed=False))
+        self.assertListEqual([], os.listdir(self.change_index.staging_directory))
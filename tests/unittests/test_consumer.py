@@ -0,0 +1,185 @@
+import collections
+import queue
+import unittest
+from multiprocessing import ProcessError
+from unittest import mock
+
+from tap_heap import consumer
+from tap_heap.consumer import CheckpointTracker
+from tap_heap.consumer import GatedMessage
+from tap_heap.consumer import MessageGate
+from tap_heap.consumer import StreamSchema
+from tap_heap.consumer import write_gated_messages
+from tap_heap.consumer import write_stream_schema
+
+
+@mock.patch("tap_heap.consumer.terminate_event", None)
+@mock.patch("tap_heap.consumer.record_queue", None)
+@mock.patch("tap_heap.consumer.queue_max_chunks", None)
+@mock.patch("tap_heap.consumer.multiprocessing")
+class TestOpenIpc(unittest.TestCase):
+
+    def test_sizes_the_queue_for_the_chunk_size(self, mock_multiprocessing):
+        consumer.open_ipc(100)
+        mock_multiprocessing.Queue.assert_called_once_with(maxsize=200)
+
+        # Workers look up the queue of the sync without resizing it
+        record_queue, _ = consumer.open_ipc()
+        self.assertIs(mock_multiprocessing.Queue.return_value, record_queue)
+        mock_multiprocessing.Queue.assert_called_once()
+
+    def test_holds_at_least_one_chunk(self, mock_multiprocessing):
+        consumer.open_ipc(50000)
+        mock_multiprocessing.Queue.assert_called_once_with(maxsize=1)
+
+    def test_creates_the_queue_again_for_another_chunk_size(self, mock_multiprocessing):
+        consumer.open_ipc(1000)
+        consumer.open_ipc(1000)
+        consumer.open_ipc(20000)
+
+        self.assertListEqual([mock.call(maxsize=20), mock.call(maxsize=1)],
+                             mock_multiprocessing.Queue.call_args_list)
+
+
+class TestWriteGatedMessages(unittest.TestCase):
+
+    @mock.patch("tap_heap.consumer.singer.write_message")
+    def test_waits_for_every_file(self, mock_write_message):
+        gated_messages = collections.deque([GatedMessage("state", frozenset({"file1", "file2"}))])
+        synced_files = {"file1"}
+
+        write_gated_messages(gated_messages, synced_files)
+        mock_write_message.assert_not_called()
+
+        synced_files.add("file2")
+        write_gated_messages(gated_messages, synced_files)
+        mock_write_message.assert_called_once_with("state")
+        self.assertSetEqual(set(), synced_files)
+
+    @mock.patch("tap_heap.consumer.singer.write_message")
+    def test_keeps_messages_in_order(self, mock_write_message):
+        gated_messages = collections.deque([GatedMessage("state1", frozenset({"file1"})),
+                                            GatedMessage("state2", frozenset())])
+
+        write_gated_messages(gated_messages, set())
+        mock_write_message.assert_not_called()
+
+        write_gated_messages(gated_messages, {"file1"})
+        self.assertListEqual([mock.call("state1"), mock.call("state2")],
+                             mock_write_message.call_args_list)
+
+
+@mock.patch("tap_heap.consumer.terminate_event")
+@mock.patch("tap_heap.consumer.record_queue")
+class TestMessageGate(unittest.TestCase):
+
+    def test_puts_messages_behind_the_files_synced_before_them(self, record_queue, _):
+        gate = MessageGate()
+        gate.file_synced("file1")
+        gate.put("state1")
+        gate.put("state2")
+
+        chunks = [put.args[0] for put in record_queue.put.call_args_list]
+        self.assertListEqual([("state1", frozenset({"file1"})), ("state2", frozenset())],
+                             [(chunk[0].message, chunk[0].file_ids) for chunk in chunks])
+
+    def test_stops_waiting_once_the_consumer_failed(self, record_queue, terminate_event):
+        record_queue.put.side_effect = queue.Full
+        terminate_event.is_set.side_effect = [False, True]
+
+        with self.assertRaises(ProcessError):
+            MessageGate().put("state")
+        self.assertEqual(2, record_queue.put.call_count)
+
+    @mock.patch("tap_heap.consumer.QUEUE_TIMEOUT", 15)
+    def test_stops_waiting_after_the_queue_timeout(self, record_queue, terminate_event):
+        record_queue.put.side_effect = queue.Full
+        terminate_event.is_set.return_value = False
+
+        with self.assertRaises(ProcessError):
+            MessageGate().put("state")
+        self.assertEqual(3, record_queue.put.call_count)
+
+
+class TestCheckpointTracker(unittest.TestCase):
+
+    def test_adds_synced_ranges_after_the_bookmark(self):
+        tracker = CheckpointTracker(60)
+        tracker.range_synced(("sessions", "sync_1/sessions/part-00001-a.avro", None), 500)
+        tracker.file_synced(("sessions", "sync_1/sessions/part-00002-a.avro", (0, 100)))
+        tracker.file_synced(("sessions", "sync_1/sessions/part-00000-a.avro", None))
+
+        state = {"bookmarks": {"sessions": {"version": 1,
+                                            "file": "sync_1/sessions/part-00000-a.avro"}}}
+        checkpointed = tracker.add_checkpoints(state)
+
+        self.assertDictEqual(
+            {"sync_1/sessions/part-00001-a.avro": [[0, 500]],
+             "sync_1/sessions/part-00002-a.avro": [[0, 100]]},
+            checkpointed["bookmarks"]["sessions"]["checkpoints"])
+        self.assertNotIn("checkpoints", state["bookmarks"]["sessions"])
+
+    def test_keeps_files_with_the_bookmarked_part_that_sort_after_it(self):
+        tracker = CheckpointTracker(60)
+        tracker.range_synced(("sessions", "sync_1/sessions/part-00000-a-c001.avro", None), 500)
+
+        state = {"bookmarks": {"sessions": {"version": 1,
+                                            "file": "sync_1/sessions/part-00000-a-c000.avro"}}}
+
+        self.assertDictEqual({"sync_1/sessions/part-00000-a-c001.avro": [[0, 500]]},
+                             tracker.add_checkpoints(state)["bookmarks"]["sessions"]["checkpoints"])
+
+    def test_checkpoints_are_dropped_once_the_bookmark_passes_them(self):
+        tracker = CheckpointTracker(60)
+        tracker.range_synced(("sessions", "sync_1/sessions/part-00001-a.avro", None), 500)
+        state = {"bookmarks": {"sessions": {
+            "version": 1,
+            "file": "sync_1/sessions/part-00001-a.avro",
+            "checkpoints": {"sync_1/sessions/part-00001-a.avro": [[0, 200]]}}}}
+
+        self.assertDictEqual({"version": 1, "file": "sync_1/sessions/part-00001-a.avro"},
+                             tracker.add_checkpoints(state)["bookmarks"]["sessions"])
+
+    def test_due_state_waits_for_new_progress_and_the_interval(self):
+        tracker = CheckpointTracker(0)
+        self.assertIsNone(tracker.get_due_state())
+
+        tracker.add_checkpoints({"bookmarks": {"sessions": {"version": 1}}})
+        self.assertIsNone(tracker.get_due_state())
+
+        tracker.range_synced(("sessions", "sync_1/sessions/part-00001-a.avro", None), 500)
+        self.assertDictEqual({"sync_1/sessions/part-00001-a.avro": [[0, 500]]},
+                             tracker.get_due_state()["bookmarks"]["sessions"]["checkpoints"])
+
+
+class TestWriteStreamSchema(unittest.TestCase):
+
+    @mock.patch("tap_heap.consumer.singer.write_message")
+    def test_writes_schema_only_when_it_changes(self, mock_write_message):
+        schema_messages, current_schemas = {}, {}
+        for stream_schema in [StreamSchema("sessions", "a", "schema a"),
+                              StreamSchema("sessions", "a"),
+                              StreamSchema("sessions", "b", "schema b"),
+                              StreamSchema("sessions", "b"),
+                              # A chunk of a file with the first schema, after the second
+                              StreamSchema("sessions", "a"),
+                              StreamSchema("sessions", "a", "schema a")]:
+            write_stream_schema(stream_schema, schema_messages, current_schemas)
+
+        self.assertListEqual([mock.call("schema a"), mock.call("schema b"),
+                              mock.call("schema a")],
+                             mock_write_message.call_args_list)
+
+    @mock.patch("tap_heap.consumer.singer.write_message")
+    def test_streams_with_the_same_fingerprint_keep_their_own_schema(self, mock_write_message):
+        schema_messages, current_schemas = {}, {}
+        for stream_schema in [StreamSchema("sessions", "a", "sessions schema a"),
+                              StreamSchema("sessions", "b", "sessions schema b"),
+                              StreamSchema("pageviews", "a", "pageviews schema a"),
+                              StreamSchema("sessions", "a"),
+                              StreamSchema("pageviews", "a")]:
+            write_stream_schema(stream_schema, schema_messages, current_schemas)
+
+        self.assertListEqual([mock.call("sessions schema a"), mock.call("sessions schema b"),
+                              mock.call("pageviews schema a"), mock.call("sessions schema a")],
+                             mock_write_message.call_args_list)
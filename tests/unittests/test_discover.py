@@ -0,0 +1,47 @@
+import io
+import unittest
+from unittest import mock
+
+import fastavro
+
+from tap_heap.discover import generate_schema_from_samples
+from tap_heap.discover import read_avro_schema
+
+
+class TestGenerateSchemaFromSamples(unittest.TestCase):
+
+    def test_newest_sample_wins_and_unsampled_columns_stay_strings(self):
+        newest = {"type": "record", "name": "r", "fields": [
+            {"name": "event_id", "type": "long"},
+            {"name": "score", "type": ["null", "double"]}]}
+        oldest = {"type": "record", "name": "r", "fields": [
+            {"name": "score", "type": ["null", "string"]},
+            {"name": "legacy", "type": ["null", "boolean"]}]}
+
+        schema = generate_schema_from_samples({"event_id", "score", "legacy", "dropped"},
+                                              [newest, oldest])
+
+        self.assertDictEqual({"event_id": {"type": ["integer"]},
+                              "score": {"type": ["null", "number"]},
+                              "legacy": {"type": ["null", "boolean"]},
+                              "dropped": {"type": "string"}},
+                             schema["properties"])
+
+
+class TestReadAvroSchema(unittest.TestCase):
+
+    @mock.patch("tap_heap.avro.HEADER_READ_SIZES", (100, None))
+    def test_reads_a_larger_range_when_the_header_does_not_fit(self):
+        avro_schema = {"type": "record", "name": "r",
+                       "fields": [{"name": f"column_{i}", "type": "long"} for i in range(20)]}
+        avro_file = io.BytesIO()
+        fastavro.writer(avro_file, avro_schema, [{f"column_{i}": i for i in range(20)}])
+        data = avro_file.getvalue()
+        storage = mock.Mock()
+        storage.open_file.side_effect = lambda s3_path, start, length: \
+            io.BytesIO(data[start:start + length] if length else data[start:])
+
+        self.assertEqual(avro_schema["fields"],
+                         read_avro_schema(storage, "sync_1/sessions/part-00000-a.avro")["fields"])
+        self.assertListEqual([100, None], [call.args[2]
+                                           for call in storage.open_file.call_args_list])
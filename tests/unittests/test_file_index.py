@@ -0,0 +1,76 @@
+import unittest
+
+from tap_heap.file_index import build_file_index
+from tap_heap.file_index import get_file_key
+from tap_heap.file_index import get_file_sort_key
+
+
+class TestBuildFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.manifests = {
+            3: {"sessions": {"files": ["s3://bucket/sync_3/sessions/part-00001-a.avro",
+                                       "s3://bucket/sync_3/sessions/part-00000-a.avro"],
+                             "incremental": True, "columns": ["event_id", "time"]}},
+            1: {"sessions": {"files": ["s3://bucket/sync_1/sessions/part-00000-a.avro"],
+                             "incremental": False, "columns": ["event_id"]}},
+            2: {"sessions": {"files": ["s3://bucket/sync_2/sessions/part-00010-a.avro",
+                                       "s3://bucket/sync_2/sessions/part-00002-a.avro"],
+                             "incremental": False, "columns": ["event_id"]},
+                "pageviews": {"files": ["s3://bucket/sync_2/pageviews/part-00000-a.avro"],
+                              "incremental": True, "columns": ["event_id"]}},
+        }
+        self.file_index = build_file_index(self.manifests, "bucket")
+
+    def test_files_are_sorted_by_dump_and_part(self):
+        table_files = self.file_index["sessions"]
+
+        self.assertListEqual(["sync_1/sessions/part-00000-a.avro",
+                              "sync_2/sessions/part-00002-a.avro",
+                              "sync_2/sessions/part-00010-a.avro",
+                              "sync_3/sessions/part-00000-a.avro",
+                              "sync_3/sessions/part-00001-a.avro"],
+                             table_files.get_files())
+        self.assertListEqual([1, 2], table_files.full_dump_ids)
+        self.assertSetEqual({"event_id", "time"}, table_files.columns)
+        self.assertListEqual(["pageviews", "sessions"], sorted(self.file_index))
+
+    def test_files_from_a_dump_and_after_a_bookmark(self):
+        table_files = self.file_index["sessions"]
+
+        self.assertListEqual(["sync_3/sessions/part-00000-a.avro",
+                              "sync_3/sessions/part-00001-a.avro"],
+                             table_files.get_files(2, "sync_2/sessions/part-00010-a.avro"))
+        self.assertListEqual(["sync_2/sessions/part-00002-a.avro",
+                              "sync_2/sessions/part-00010-a.avro",
+                              "sync_3/sessions/part-00000-a.avro",
+                              "sync_3/sessions/part-00001-a.avro"],
+                             table_files.get_files(2, "sync_1/sessions/part-00000-a.avro"))
+
+    def test_files_with_the_same_part_sort_by_path(self):
+        table_files = build_file_index({4: {"sessions": {"files": [
+            "s3://bucket/sync_4/sessions/part-00001-a.avro",
+            "s3://bucket/sync_4/sessions/part-00000-a-c001.avro",
+            "s3://bucket/sync_4/sessions/part-00000-a-c000.avro"]}}}, "bucket")["sessions"]
+
+        self.assertListEqual(["sync_4/sessions/part-00000-a-c001.avro",
+                              "sync_4/sessions/part-00001-a.avro"],
+                             table_files.get_files(4, "sync_4/sessions/part-00000-a-c000.avro"))
+        self.assertListEqual(["sync_4/sessions/part-00001-a.avro"],
+                             table_files.get_files(4, "sync_4/sessions/part-00000-a-c001.avro"))
+        self.assertLess(get_file_sort_key("sync_4/sessions/part-00000-a-c001.avro"),
+                        get_file_sort_key("sync_4/sessions/part-00001-a.avro"))
+
+    def test_recent_files_newest_dumps_first(self):
+        table_files = self.file_index["sessions"]
+
+        self.assertListEqual(["sync_3/sessions/part-00000-a.avro"],
+                             table_files.get_recent_files(1))
+        self.assertListEqual(["sync_3/sessions/part-00000-a.avro",
+                              "sync_3/sessions/part-00001-a.avro",
+                              "sync_2/sessions/part-00002-a.avro"],
+                             table_files.get_recent_files(3))
+
+    def test_file_key(self):
+        self.assertEqual((852, 16),
+                         get_file_key("sync_852/sessions/part-00016-4a06bab5-c000.avro"))
@@ -0,0 +1,67 @@
+import io
+import json
+import tempfile
+import threading
+import unittest
+from concurrent import futures
+from unittest import mock
+
+from tap_heap import manifest
+from tap_heap.cache import ManifestCache
+
+
+class FakeStorage():
+
+    def __init__(self, dump_ids, max_connections=None):
+        self.dump_ids = dump_ids
+        self.max_connections = max_connections
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def list_manifest_files(self, min_dump_id=None):
+        return [{"Key": f"manifests/sync_{dump_id}.json", "ETag": f'"{dump_id}"'}
+                for dump_id in self.dump_ids if dump_id >= (min_dump_id or 0)]
+
+    def open_file(self, path, start=0, length=None):
+        with self.lock:
+            self.opened.append(path)
+        dump_id = int(path.split('_')[1].split('.')[0])
+        return io.BytesIO(json.dumps({
+            "dump_id": dump_id,
+            "tables": [{"name": "sessions", "files": [f"sync_{dump_id}/sessions/part-0.avro"]}],
+            "property_definitions": []}).encode('utf-8'))
+
+
+class TestGetManifestFileContents(unittest.TestCase):
+
+    def test_reads_every_manifest_through_one_pool_in_listing_order(self):
+        storage = FakeStorage([1, 2, 10, 3, 4], max_connections=2)
+
+        with mock.patch("tap_heap.manifest.futures.ThreadPoolExecutor",
+                        wraps=futures.ThreadPoolExecutor) as executor:
+            contents = list(manifest.get_manifest_file_contents(storage, concurrency=16))
+
+        executor.assert_called_once_with(max_workers=2)
+        self.assertListEqual([1, 2, 10, 3, 4], [read["dump_id"] for read in contents])
+        self.assertNotIn("property_definitions", contents[0])
+        self.assertCountEqual([f"manifests/sync_{dump_id}.json" for dump_id in [1, 2, 10, 3, 4]],
+                              storage.opened)
+
+    def test_cache_hits_skip_the_storage(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ManifestCache(directory)
+            storage = FakeStorage([1, 2])
+            first = list(manifest.get_manifest_file_contents(storage, cache=cache))
+
+            storage.dump_ids.append(3)
+            storage.opened = []
+            second = list(manifest.get_manifest_file_contents(storage, cache=cache))
+
+        self.assertListEqual(first, second[:2])
+        self.assertListEqual(["manifests/sync_3.json"], storage.opened)
+
+    def test_generate_manifests_from_min_dump_id(self):
+        manifests = manifest.generate_manifests(FakeStorage([1, 2, 3]), {}, min_dump_id=2)
+
+        self.assertListEqual([2, 3], sorted(manifests))
+        self.assertListEqual(["sync_2/sessions/part-0.avro"], manifests[2]["sessions"]["files"])
@@ -0,0 +1,173 @@
+import unittest
+from concurrent import futures
+from unittest import mock
+
+from tap_heap.plan import advance_watermark
+from tap_heap.plan import estimate_sync_seconds
+from tap_heap.plan import get_unsynced_ranges
+from tap_heap.plan import merge_ranges
+from tap_heap.plan import plan_file_ranges
+from tap_heap.plan import TableSync
+from tap_heap.stats import FileStats
+
+
+class TestAdvanceWatermark(unittest.TestCase):
+
+    def test_advances_over_contiguous_completed_files(self):
+        completed_indexes = {0, 1, 2}
+
+        self.assertEqual(3, advance_watermark(completed_indexes, 0))
+        self.assertSetEqual(set(), completed_indexes)
+
+    def test_stops_at_first_incomplete_file(self):
+        completed_indexes = {0, 2, 3}
+
+        self.assertEqual(1, advance_watermark(completed_indexes, 0))
+        self.assertSetEqual({2, 3}, completed_indexes)
+
+        completed_indexes.add(1)
+        self.assertEqual(4, advance_watermark(completed_indexes, 1))
+
+    def test_does_not_move_when_next_file_incomplete(self):
+        completed_indexes = {5, 6}
+
+        self.assertEqual(4, advance_watermark(completed_indexes, 4))
+        self.assertSetEqual({5, 6}, completed_indexes)
+
+
+class TestPlanFileRanges(unittest.TestCase):
+
+    def test_small_files_are_not_split(self):
+        self.assertListEqual([None], plan_file_ranges(100, 100))
+        self.assertListEqual([None], plan_file_ranges(100, 0))
+
+    def test_large_files_are_split_into_contiguous_ranges(self):
+        self.assertListEqual([(0, 40), (40, 80), (80, 100)], plan_file_ranges(100, 40))
+
+
+class TestScheduleLargestFirst(unittest.TestCase):
+
+    def setUp(self):
+        stream = {"stream": "sessions", "metadata": [{"breadcrumb": [], "metadata": {}}]}
+        files = [f"sync_1/sessions/part-0000{i}-a.avro" for i in range(4)]
+        self.table_sync = TableSync(stream, None, files, 1,
+                                    [[None], [(0, 50), (50, 100)], [None], [(30, None)]])
+        self.sizes = [10, 100, 80, 100]
+
+    def test_starts_the_largest_files_first_with_their_units_together(self):
+        self.table_sync.schedule_largest_first(self.sizes)
+
+        self.assertListEqual([(1, (0, 50)), (1, (50, 100)), (2, None), (3, (30, None)),
+                              (0, None)],
+                             list(self.table_sync.pending_units))
+        self.assertListEqual([50, 50, 80, 70, 10], self.table_sync.get_unit_sizes(self.sizes))
+
+    def test_files_with_as_many_bytes_left_keep_file_order(self):
+        self.table_sync.schedule_largest_first([10, 100, 80, 130])
+
+        self.assertListEqual([1, 1, 3, 2, 0],
+                             [index for index, _ in self.table_sync.pending_units])
+
+    def test_watermark_still_moves_in_file_order(self):
+        self.table_sync.schedule_largest_first(self.sizes)
+        for _ in range(4):
+            index, _ = self.table_sync.start_unit()
+            self.table_sync.complete_unit(index, FileStats())
+
+        self.assertFalse(self.table_sync.advance())
+        index, _ = self.table_sync.start_unit()
+        self.table_sync.complete_unit(index, FileStats())
+        self.assertTrue(self.table_sync.advance())
+        self.assertTrue(self.table_sync.is_done())
+
+    def test_files_are_counted_once_their_last_unit_completes(self):
+        unit_stats = FileStats()
+        unit_stats.units = 1
+        for _ in range(4):
+            index, _ = self.table_sync.start_unit()
+            self.table_sync.complete_unit(index, unit_stats)
+
+        self.assertEqual(4, self.table_sync.file_stats.units)
+        self.assertEqual(3, self.table_sync.file_stats.files)
+
+    def test_estimate_is_bounded_by_the_largest_unit(self):
+        self.assertEqual(3, estimate_sync_seconds([20, 20, 20], 2, 10))
+        self.assertEqual(8, estimate_sync_seconds([80, 10, 10], 4, 10))
+        self.assertEqual(0, estimate_sync_seconds([], 4, 10))
+
+
+class TestTableSyncMerges(unittest.TestCase):
+
+    def setUp(self):
+        stream = {"stream": "users", "metadata": [{"breadcrumb": [], "metadata": {}}]}
+        self.files = [f"sync_1/users/part-0000{i}-a.avro" for i in range(3)]
+        self.merges = []
+        self.change_index = mock.Mock()
+        self.change_index.merge_files.side_effect = self.start_merge
+        self.table_sync = TableSync(stream, None, self.files, 1, change_index=self.change_index)
+
+    def start_merge(self, _files):
+        self.merges.append(futures.Future())
+        return self.merges[-1]
+
+    def complete_next_unit(self):
+        index, _ = self.table_sync.start_unit()
+        self.table_sync.complete_unit(index, FileStats())
+
+    def test_watermark_waits_for_the_merge_of_its_files(self):
+        self.complete_next_unit()
+        self.assertFalse(self.table_sync.advance())
+        self.change_index.merge_files.assert_called_once_with(self.files[:1])
+        self.assertListEqual(self.merges, self.table_sync.pending_merges())
+
+        # Files completed during a merge are merged together once it is done
+        self.complete_next_unit()
+        self.complete_next_unit()
+        self.assertFalse(self.table_sync.advance())
+        self.merges[0].set_result(None)
+        self.assertTrue(self.table_sync.advance())
+        self.assertEqual(1, self.table_sync.watermark)
+        self.change_index.merge_files.assert_called_with(self.files[1:])
+
+        self.merges[1].set_result(None)
+        self.assertTrue(self.table_sync.advance())
+        self.assertTrue(self.table_sync.is_done())
+        self.assertListEqual([], self.table_sync.pending_merges())
+
+    def test_a_failed_merge_fails_the_sync(self):
+        self.complete_next_unit()
+        self.table_sync.advance()
+        self.merges[0].set_exception(OSError("disk full"))
+
+        with self.assertRaises(OSError):
+            self.table_sync.advance()
+        self.assertEqual(0, self.table_sync.watermark)
+
+
+class TestMergeRanges(unittest.TestCase):
+
+    def test_merges_overlapping_and_adjacent_ranges(self):
+        self.assertListEqual([[0, 30], [40, 50]],
+                             merge_ranges([[40, 50], [10, 30], [0, 10], [5, 20]]))
+
+    def test_open_ended_range_covers_the_rest_of_the_file(self):
+        self.assertListEqual([[0, 10], [20, None]],
+                             merge_ranges([[20, None], [0, 10], [30, 40], [25, None]]))
+
+
+class TestGetUnsyncedRanges(unittest.TestCase):
+
+    def test_no_checkpoint_keeps_the_plan(self):
+        self.assertListEqual([None], get_unsynced_ranges([None], None))
+
+    def test_whole_file_resumes_after_the_synced_blocks(self):
+        self.assertListEqual([(300, None)], get_unsynced_ranges([None], [[0, 300]]))
+
+    def test_split_file_keeps_only_the_gaps(self):
+        self.assertListEqual([(0, 40), (60, 80), (90, 100)],
+                             get_unsynced_ranges([(0, 40), (40, 80), (80, 100)],
+                                                 [[40, 60], [80, 90]]))
+
+    def test_fully_synced_file_has_nothing_left(self):
+        self.assertListEqual([], get_unsynced_ranges([None], [[0, None]]))
+        self.assertListEqual([], get_unsynced_ranges([(0, 40), (40, 80)], [[0, 80]]))
@@ -0,0 +1,87 @@
+import datetime
+import unittest
+from unittest import mock
+
+import boto3
+
+from tap_heap import s3
+from tap_heap.s3 import get_partition_start_after
+from tap_heap.s3 import MANIFEST_KEY_PREFIX
+
+
+class TestGetPartitionStartAfter(unittest.TestCase):
+
+    def assert_lists_every_manifest_at_or_after(self, min_dump_id, dump_ids):
+        for dump_id in dump_ids:
+            key = f"{MANIFEST_KEY_PREFIX}{dump_id}.json"
+            start_after = get_partition_start_after(int(str(dump_id)[0]), min_dump_id)
+            if dump_id >= min_dump_id:
+                self.assertGreater(key, start_after, f"{key} skipped for dump {min_dump_id}")
+
+    def test_never_skips_newer_manifests(self):
+        dump_ids = list(range(1, 2100)) + [9999, 10000, 10001, 12345, 99999, 100000]
+        for min_dump_id in [1, 9, 10, 99, 100, 101, 500, 999, 1000, 1001, 1999, 2000]:
+            self.assert_lists_every_manifest_at_or_after(min_dump_id, dump_ids)
+
+    def test_skips_older_manifests_with_the_same_number_of_digits(self):
+        start_after = get_partition_start_after(5, 500)
+
+        self.assertGreater(start_after, f"{MANIFEST_KEY_PREFIX}499.json")
+        self.assertGreater(start_after, f"{MANIFEST_KEY_PREFIX}5.json")
+        self.assertLess(start_after, f"{MANIFEST_KEY_PREFIX}500.json")
+
+    def test_keeps_longer_dump_ids_in_lower_partitions(self):
+        start_after = get_partition_start_after(1, 500)
+
+        self.assertGreater(start_after, f"{MANIFEST_KEY_PREFIX}100.json")
+        self.assertLess(start_after, f"{MANIFEST_KEY_PREFIX}1000.json")
+
+
+class TestWorkerCredentials(unittest.TestCase):
+
+    def setUp(self):
+        self.credentials = {"access_key": "parent-key", "secret_key": "secret", "token": "token",
+                            "expiry_time": (datetime.datetime.now(datetime.timezone.utc) +
+                                            datetime.timedelta(hours=1)).isoformat()}
+        self.addCleanup(setattr, boto3, "DEFAULT_SESSION", None)
+        self.addCleanup(setattr, s3, "_CREDENTIALS", None)
+
+    @mock.patch("tap_heap.s3.create_credential_fetcher")
+    def test_worker_assumes_the_role_again_only_to_refresh(self, create_credential_fetcher):
+        create_credential_fetcher.return_value.fetch_credentials.return_value = "refreshed"
+        fetcher = s3.WorkerCredentialFetcher(self.credentials, {"role_name": "role"})
+
+        self.assertEqual(self.credentials, fetcher.fetch_credentials())
+        create_credential_fetcher.assert_not_called()
+        self.assertEqual("refreshed", fetcher.fetch_credentials())
+
+    @mock.patch("tap_heap.s3.create_credential_fetcher")
+    @mock.patch("tap_heap.s3.get_s3_client")
+    def test_init_worker_uses_the_parents_credentials(self, get_s3_client,
+                                                      create_credential_fetcher):
+        s3.init_worker(self.credentials, {})
+
+        self.assertEqual("parent-key",
+                         boto3.DEFAULT_SESSION.get_credentials().get_frozen_credentials().access_key)
+        self.assertEqual(self.credentials, s3.get_worker_credentials())
+        create_credential_fetcher.assert_not_called()
+        get_s3_client.assert_called_once_with()
+
+
+class TestProbeManifestFiles(unittest.TestCase):
+
+    @mock.patch("tap_heap.s3.get_s3_client")
+    def test_listing_continues_from_the_probed_page(self, get_s3_client):
+        first = {"Key": "manifests/sync_1.json"}
+        second = {"Key": "manifests/sync_2.json"}
+        list_objects_v2 = get_s3_client.return_value.list_objects_v2
+        list_objects_v2.side_effect = [
+            {"KeyCount": 1, "Contents": [first], "NextContinuationToken": "token"},
+            {"KeyCount": 1, "Contents": [second]}]
+
+        s3.probe_manifest_files("bucket")
+        self.assertListEqual([first, second], s3.list_objects("bucket", "manifests"))
+
+        self.assertEqual(1, list_objects_v2.call_args_list[0].kwargs["MaxKeys"])
+        self.assertEqual("token", list_objects_v2.call_args_list[1].kwargs["ContinuationToken"])
+        self.assertEqual(2, list_objects_v2.call_count)
@@ -0,0 +1,96 @@
+import decimal
+import io
+import json
+import unittest
+from unittest import mock
+
+import singer
+
+from tap_heap import serialize
+
+
+class TestRecordEncoder(unittest.TestCase):
+
+    def test_matches_singer_output(self):
+        message = singer.RecordMessage("table1", {"event_id": 1, "name": "héllo"}, version=123)
+        encode_record = serialize.get_record_encoder()
+
+        line = encode_record(message)
+
+        self.assertTrue(line.endswith(b'\n'))
+        self.assertDictEqual(json.loads(singer.format_message(message)), json.loads(line))
+
+    def test_decimals_fall_back_to_singer(self):
+        message = singer.RecordMessage("table1", {"amount": decimal.Decimal("1.10")}, version=123)
+
+        line = serialize.encode_with_orjson(message) if serialize.orjson else \
+            serialize.encode_with_singer(message)
+
+        self.assertIn(b'"amount": 1.10', line)
+
+    def test_non_finite_floats_are_refused_with_or_without_orjson(self):
+        encoders = [serialize.encode_with_singer, serialize.get_record_encoder()]
+        for value in [float("nan"), float("inf"), [float("-inf")]]:
+            message = singer.RecordMessage("table1", {"score": value, "name": None}, version=1)
+            for encode_record in encoders:
+                with self.assertRaises(ValueError):
+                    encode_record(message)
+
+
+class TestPackChunk(unittest.TestCase):
+
+    def test_joins_runs_of_encoded_lines(self):
+        schema_message = singer.SchemaMessage(stream="table1", schema={}, key_properties=[])
+        chunk = [schema_message, b'{"a": 1}\n', b'{"a": 2}\n']
+
+        self.assertListEqual([schema_message, b'{"a": 1}\n{"a": 2}\n'],
+                             serialize.pack_chunk(chunk))
+
+    def test_keeps_messages_in_order(self):
+        schema_message = singer.SchemaMessage(stream="table1", schema={}, key_properties=[])
+        chunk = [b'1\n', schema_message, b'2\n', b'3\n']
+
+        self.assertListEqual([b'1\n', schema_message, b'2\n3\n'], serialize.pack_chunk(chunk))
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = io.BytesIO()
+        self.now = 0
+        patcher = mock.patch("tap_heap.serialize.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_flushes_once_the_buffer_is_full(self):
+        writer = serialize.OutputWriter(buffer_size=10, flush_interval=60, stream=self.stream)
+
+        writer.write_encoded(b'{"a": 1}\n')
+        self.assertEqual(b'', self.stream.getvalue())
+
+        writer.write_encoded(b'{"a": 2}\n')
+        self.assertEqual(b'{"a": 1}\n{"a": 2}\n', self.stream.getvalue())
+
+    def test_flushes_records_and_state_together(self):
+        writer = serialize.OutputWriter(stream=self.stream)
+
+        writer.write_encoded(b'{"a": 1}\n')
+        writer.write_message(singer.StateMessage(value={"bookmarks": {}}))
+
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(b'{"a": 1}', lines[0])
+        self.assertEqual("STATE", json.loads(lines[1])["type"])
+
+    def test_flushes_after_the_interval(self):
+        writer = serialize.OutputWriter(flush_interval=1, stream=self.stream)
+        self.assertIsNone(writer.get_flush_timeout())
+
+        writer.write_encoded(b'{"a": 1}\n')
+        self.now = 0.5
+        self.assertEqual(0.5, writer.get_flush_timeout())
+        writer.flush_if_due()
+        self.assertEqual(b'', self.stream.getvalue())
+
+        self.now = 1
+        writer.flush_if_due()
+        self.assertEqual(b'{"a": 1}\n', self.stream.getvalue())
@@ -0,0 +1,87 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import fastavro
+
+from tap_heap import avro
+from tap_heap import spool
+
+SCHEMA = {
+    "type": "record",
+    "name": "topLevelRecord",
+    "fields": [
+        {"name": "event_id", "type": ["long", "null"]},
+        {"name": "custom_property", "type": ["string", "null"]},
+    ]
+}
+
+
+class TestOpenMappedFile(unittest.TestCase):
+
+    def test_reads_byte_ranges_from_the_mapped_file(self):
+        records = [{"event_id": i, "custom_property": "x" * i} for i in range(300)]
+        avro_file = io.BytesIO()
+        fastavro.writer(avro_file, SCHEMA, records, sync_interval=500)
+        data = avro_file.getvalue()
+
+        with tempfile.TemporaryDirectory() as directory:
+            local_path = os.path.join(directory, 'part.avro')
+            with open(local_path, 'wb') as local_file:
+                local_file.write(data)
+
+            open_stream = spool.open_mapped_file(local_path)
+            middle = len(data) // 2
+            synced = []
+            for byte_range in [(0, middle), (middle, len(data))]:
+                _, _, blocks = avro.read_blocks(open_stream, byte_range=byte_range)
+                synced += [record for _, block in blocks for record in block]
+
+        self.assertListEqual(records, synced)
+
+
+class TestSpooler(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_prefetch_stops_at_capacity_and_release_frees_room(self):
+        storage = mock.Mock()
+        storage.download_file.side_effect = lambda s3_path, local_path: \
+            open(local_path, 'wb').close()
+
+        with spool.Spooler(storage, self.temp_dir.name, 2) as spooler:
+            spooler.prefetch(['sync_1/a/part-0.avro', 'sync_1/a/part-1.avro',
+                              'sync_1/a/part-2.avro'])
+            self.assertEqual(2, len(spooler.downloads))
+
+            for download in spooler.downloads.values():
+                download.result()
+            local_path = spooler.get_local_path('sync_1/a/part-0.avro')
+            self.assertTrue(os.path.exists(local_path))
+            self.assertIsNone(spooler.get_local_path('sync_1/a/part-2.avro'))
+
+            spooler.release('sync_1/a/part-0.avro')
+            self.assertFalse(os.path.exists(local_path))
+
+            spooler.prefetch(['sync_1/a/part-1.avro', 'sync_1/a/part-2.avro'])
+            self.assertIn('sync_1/a/part-2.avro', spooler.downloads)
+            spool_directory = spooler.directory
+
+        self.assertFalse(os.path.exists(spool_directory))
+
+    def test_failed_download_raises_when_collected(self):
+        storage = mock.Mock()
+        storage.download_file.side_effect = OSError("disk full")
+
+        with spool.Spooler(storage, self.temp_dir.name, 1) as spooler:
+            spooler.prefetch(['sync_1/a/part-0.avro'])
+            spooler.downloads['sync_1/a/part-0.avro'].exception()
+
+            with self.assertRaises(OSError):
+                spooler.get_local_path('sync_1/a/part-0.avro')
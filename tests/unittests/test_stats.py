@@ -0,0 +1,41 @@
+import io
+import unittest
+from unittest import mock
+
+from tap_heap.stats import FileStats
+
+
+class TestFileStats(unittest.TestCase):
+
+    def test_metered_streams_count_bytes_read(self):
+        file_stats = FileStats()
+        open_stream = file_stats.meter(lambda offset, _length: io.BytesIO(b"0123456789"[offset:]))
+
+        first = open_stream(0)
+        first.read(4)
+        first.read()
+        open_stream(6).read()
+
+        self.assertEqual(14, file_stats.bytes_read)
+        self.assertIsNotNone(file_stats.first_byte_seconds)
+
+    @mock.patch("tap_heap.stats.metrics.log")
+    def test_stream_totals_log_the_mean_time_to_first_byte(self, mock_log):
+        stream_stats = FileStats()
+        for first_byte_seconds in [0.1, 0.3]:
+            file_stats = FileStats()
+            file_stats.units = 1
+            file_stats.records = 10
+            file_stats.first_byte_seconds = first_byte_seconds
+            file_stats.read_seconds = 1
+            file_stats.queue_put_seconds = 0.5
+            file_stats.total_seconds = 2
+            stream_stats.add(file_stats)
+
+        stream_stats.log("stream_sync", stream="sessions")
+
+        point = mock_log.call_args[0][1]
+        self.assertEqual(4, point.value)
+        self.assertEqual(20, point.tags["records"])
+        self.assertEqual(0.2, point.tags["time_to_first_byte"])
+        self.assertEqual(1, point.tags["decode_seconds"])
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+
+from tap_heap.storage import get_storage
+from tap_heap.storage import LocalStorage
+from tap_heap.storage import S3Storage
+
+
+class TestLocalStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.temp_dir.name
+        os.makedirs(os.path.join(self.directory, 'manifests'))
+        os.makedirs(os.path.join(self.directory, 'sync_1', 'sessions'))
+        for name in ['sync_1.json', 'sync_2.json', 'sync_10.json', 'notes.txt']:
+            with open(os.path.join(self.directory, 'manifests', name), 'w',
+                      encoding='utf-8') as manifest_file:
+                manifest_file.write('{}')
+        with open(os.path.join(self.directory, 'sync_1', 'sessions', 'part-0.avro'), 'wb') as f:
+            f.write(b'0123456789')
+        self.storage = LocalStorage('bucket', self.directory)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_lists_manifests_from_the_min_dump_id(self):
+        self.assertListEqual(['manifests/sync_1.json', 'manifests/sync_10.json',
+                              'manifests/sync_2.json'],
+                             [s3_object['Key'] for s3_object in self.storage.list_manifest_files()])
+        self.assertListEqual(['manifests/sync_10.json', 'manifests/sync_2.json'],
+                             [s3_object['Key'] for s3_object in self.storage.list_manifest_files(2)])
+
+    def test_opens_files_and_ranges(self):
+        path = 'sync_1/sessions/part-0.avro'
+
+        with self.storage.open_file(path) as fo:
+            self.assertEqual(b'0123456789', fo.read())
+        with self.storage.open_file(path, 4) as fo:
+            self.assertEqual(b'456789', fo.read())
+        self.assertEqual(b'45', self.storage.open_file(path, 4, 2).read())
+        self.assertListEqual([10], self.storage.get_file_sizes([path]))
+
+    def test_get_storage(self):
+        self.assertIsInstance(get_storage({'bucket': 'bucket'}), S3Storage)
+        self.assertIsInstance(get_storage({'bucket': 'bucket', 'local_directory': self.directory}),
+                              LocalStorage)
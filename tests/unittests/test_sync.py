@@ -1,205 +1,353 @@
+import io
 import unittest
 import json
-from tap_heap.sync import filter_manifests_to_sync
-from tap_heap.sync import get_files_to_sync
+from unittest import mock
+from singer import metadata
+from singer import Transformer
+from tap_heap.sync import get_indexed_files_to_sync
+from tap_heap.sync import get_first_dump_to_sync
+from tap_heap.sync import start_table_sync
+from tap_heap.file_index import TableFiles
+from tap_heap.sync import get_min_bookmarked_dump_id
+from tap_heap.sync import get_deselected_fields
+from tap_heap.sync import RecordSelector
+from tap_heap.sync import sync_file
+from tap_heap.consumer import FileSynced
+from tap_heap.consumer import StreamSchema
+import fastavro
 
-class TestFilterManifests(unittest.TestCase):
+class TestPlanFilesToSync(unittest.TestCase):
+    """The files `start_table_sync` plans for a table, from `get_first_dump_to_sync` and the
+    table's `TableFiles`."""
 
     def setUp(self):
-        self.manifests = {
-            123: {"table1": {"files": ["file1", "file2", "file3"],
-                             "incremental": False,
-                             "columns": ["column1", "column2", "column3"]},
-                  "table2": {"files": ["file1", "file2", "file3"],
-                             "incremental": True,
-                             "columns": ["column1", "column2", "column3"]},
-                  "table3": {"files": ["file1", "file2", "file3"],
-                             "incremental": True,
-                             "columns": ["column1", "column2", "column3"]}},
-            124: {"table1": {"files": ["file1", "file2", "file3"],
-                             "incremental": True,
-                             "columns": ["column1", "column2", "column3"]},
-                  "table2": {"files": ["file1", "file2", "file3"],
-                             "incremental": True,
-                             "columns": ["column1", "column2", "column3"]},
-                  "table3": {"files": ["file1", "file2", "file3"],
-                             "incremental": True,
-                             "columns": ["column1", "column2", "column3"]}},
-            125: {"table1": {"files": ["file1", "file2", "file3"],
-                             "incremental": True,
-                             "columns": ["column1", "column2", "column3"]},
-                  "table2": {"files": ["file1", "file2", "file3"],
-                             "incremental": True,
-                             "columns": ["column1", "column2", "column3"]},
-                  "table3": {"files": ["file1", "file2", "file3"],
-                             "incremental": True,
-                             "columns": ["column1", "column2", "column3"]}},
-        }
-        self.maxDiff = None
+        self.incremental = {123: True, 124: True, 125: True}
 
-    def test_one_false_incremental_no_bookmark(self):
-        self.manifests[123]["table1"]["incremental"] = False
-
-        expected_table_manifests = {
-            123: {"files": ["file1", "file2", "file3"],
-                  "incremental": False,
-                  "columns": ["column1", "column2", "column3"]},
-            124: {"files": ["file1", "file2", "file3"],
-                  "incremental": True,
-                  "columns": ["column1", "column2", "column3"]},
-            125: {"files": ["file1", "file2", "file3"],
-                  "incremental": True,
-                  "columns": ["column1", "column2", "column3"]},
-        }
+    def plan(self, state):
+        table_files = TableFiles()
+        for dump_id, incremental in self.incremental.items():
+            table_files.add_dump(dump_id, {
+                "incremental": incremental,
+                "files": [f"s3://bucket1/sync_{dump_id}/table1/part-0000{part}-GUID.avro"
+                          for part in range(3)]}, "s3://bucket1/")
+        table_files.sort()
 
-        expected_should_send_activate_version = True
+        min_dump_id, should_create_new_version = get_first_dump_to_sync(
+            table_files.full_dump_ids, "table1", state)
+        return (get_indexed_files_to_sync(table_files, min_dump_id, "table1", state),
+                should_create_new_version)
 
-        actual_value = filter_manifests_to_sync(self.manifests, "table1", {})
+    def get_files(self, dump_ids, first_part=0):
+        return [f"sync_{dump_id}/table1/part-0000{part}-GUID.avro"
+                for dump_id in dump_ids for part in range(3)][first_part:]
 
-        self.assertDictEqual(expected_table_manifests, actual_value[0])
-        self.assertEqual(expected_should_send_activate_version, actual_value[1])
+    def get_state(self, bookmark):
+        return {"bookmarks": {"table1": {"file": bookmark, "version": 1607032341846}}}
 
-    def test_two_false_incremental_no_bookmark(self):
-        self.manifests[123]["table1"]["incremental"] = False
-        self.manifests[125]["table1"]["incremental"] = False
+    def test_no_bookmark(self):
+        self.assertTupleEqual((self.get_files([123, 124, 125]), True), self.plan({}))
 
-        expected_table_manifests = {
-            125: {"files": ["file1", "file2", "file3"],
-                  "incremental": False,
-                  "columns": ["column1", "column2", "column3"]},
-        }
+    def test_one_false_incremental_no_bookmark(self):
+        self.incremental[123] = False
 
-        expected_should_send_activate_version = True
+        self.assertTupleEqual((self.get_files([123, 124, 125]), True), self.plan({}))
 
-        actual_value = filter_manifests_to_sync(self.manifests, "table1", {})
+    def test_two_false_incremental_no_bookmark(self):
+        self.incremental[123] = False
+        self.incremental[125] = False
 
-        self.assertDictEqual(expected_table_manifests, actual_value[0])
-        self.assertEqual(expected_should_send_activate_version, actual_value[1])
+        self.assertTupleEqual((self.get_files([125]), True), self.plan({}))
 
     def test_has_bookmark_after_false_dump_id(self):
-        self.manifests[123]["table1"]["incremental"] = False
-
-        expected_table_manifests = {
-            124: {"files": ["file1", "file2", "file3"],
-                  "incremental": True,
-                  "columns": ["column1", "column2", "column3"]},
-            125: {"files": ["file1", "file2", "file3"],
-                  "incremental": True,
-                  "columns": ["column1", "column2", "column3"]},
-        }
-
-        expected_should_send_activate_version = False
-        state = {
-            "bookmarks": {
-                "table1": {
-                    "file": "sync_124/table1/part-00001-GUID.avro",
-                    "version": 1607032341846
-                }
-            }
-        }
-        actual_value = filter_manifests_to_sync(self.manifests, "table1", state)
+        self.incremental[123] = False
+        state = self.get_state("sync_124/table1/part-00001-GUID.avro")
 
-        self.assertDictEqual(expected_table_manifests, actual_value[0])
-        self.assertEqual(expected_should_send_activate_version, actual_value[1])
+        self.assertTupleEqual((self.get_files([124, 125], 2), False), self.plan(state))
 
     def test_has_bookmark_before_false_dump_id(self):
+        self.incremental[123] = False
+        self.incremental[125] = False
+        state = self.get_state("sync_124/table1/part-00001-GUID.avro")
 
-        self.manifests[123]["table1"]["incremental"] = False
-        self.manifests[125]["table1"]["incremental"] = False
+        self.assertTupleEqual((self.get_files([125]), True), self.plan(state))
 
-        expected_table_manifests = {
-            125: {"files": ["file1", "file2", "file3"],
-                  "incremental": False,
-                  "columns": ["column1", "column2", "column3"]},
-        }
+    def test_has_bookmark_on_false_dump_id(self):
+        self.incremental[123] = False
+        self.incremental[124] = False
+        state = self.get_state("sync_124/table1/part-00001-GUID.avro")
+
+        self.assertTupleEqual((self.get_files([124, 125], 2), False), self.plan(state))
+
+
+class TestGetFirstDumpToSync(unittest.TestCase):
+
+    def test_starts_a_new_version_for_a_new_full_dump(self):
+        state = {"bookmarks": {"table1": {"version": 1, "version_dump_id": 3,
+                                          "file": "sync_4/table1/part-00000-a.avro"}}}
+
+        self.assertTupleEqual((5, True), get_first_dump_to_sync([3, 5], "table1", state))
+
+    def test_resumes_the_version_of_the_latest_full_dump_before_its_first_bookmark(self):
+        # The sync of the full dump stopped before its first file moved the `file` bookmark
+        for bookmarks in [{"version": 1, "version_dump_id": 5},
+                          {"version": 1, "version_dump_id": 5,
+                           "file": "sync_4/table1/part-00000-a.avro"}]:
+            state = {"bookmarks": {"table1": bookmarks}}
+            self.assertTupleEqual((5, False), get_first_dump_to_sync([3, 5], "table1", state))
+
+    def test_resumes_a_first_sync_of_incremental_dumps(self):
+        state = {"bookmarks": {"table1": {"version": 1, "version_dump_id": 0}}}
+
+        self.assertTupleEqual((0, False), get_first_dump_to_sync([], "table1", state))
+
+
+class TestStartTableSync(unittest.TestCase):
+
+    def setUp(self):
+        self.table_files = TableFiles()
+        for dump_id, incremental in [(1, False), (2, False)]:
+            self.table_files.add_dump(dump_id, {
+                "incremental": incremental,
+                "files": [f"s3://bucket/sync_{dump_id}/table1/part-0000{part}-a.avro"
+                          for part in range(2)]}, "s3://bucket/")
+        self.table_files.sort()
+        self.stream = {"stream": "table1", "metadata": [{"breadcrumb": [], "metadata": {}}]}
+
+    def test_new_version_records_its_full_dump(self):
+        gate = mock.Mock()
+        state = {"bookmarks": {"table1": {"version": 1, "file": "sync_1/table1/part-00001-a.avro"}}}
+
+        table_sync = start_table_sync(mock.Mock(), state, self.stream, self.table_files, gate)
+
+        self.assertNotEqual(1, table_sync.version)
+        written = gate.put_state.call_args.args[0]["bookmarks"]["table1"]
+        self.assertEqual(table_sync.version, written["version"])
+        self.assertEqual(2, written["version_dump_id"])
+
+    def test_resumes_the_checkpoints_of_an_unbookmarked_version(self):
+        checkpoints = {"sync_2/table1/part-00000-a.avro": [[0, 100]]}
+        state = {"bookmarks": {"table1": {"version": 7, "version_dump_id": 2,
+                                          "file": "sync_1/table1/part-00001-a.avro",
+                                          "checkpoints": checkpoints}}}
+
+        table_sync = start_table_sync(mock.Mock(), state, self.stream, self.table_files,
+                                      mock.Mock())
+
+        self.assertEqual(7, table_sync.version)
+        self.assertListEqual(["sync_2/table1/part-00000-a.avro", "sync_2/table1/part-00001-a.avro"],
+                             table_sync.files)
+        self.assertListEqual([(0, (100, None)), (1, None)], list(table_sync.pending_units))
+
+    @mock.patch("tap_heap.sync.changes.get_change_index")
+    def test_change_index_is_only_reset_for_a_new_version(self, get_change_index):
+        change_index = get_change_index.return_value
+        stream = {"stream": "table1", "metadata": [
+            {"breadcrumb": [], "metadata": {"table-key-properties": ["id"]}}]}
+        resumed_state = {"bookmarks": {"table1": {"version": 7, "version_dump_id": 2}}}
+
+        start_table_sync(mock.Mock(), resumed_state, stream, self.table_files, mock.Mock(),
+                         config={"change_index_dir": "index"})
+        change_index.reset.assert_not_called()
+
+        start_table_sync(mock.Mock(), {}, stream, self.table_files, mock.Mock(),
+                         config={"change_index_dir": "index"})
+        change_index.reset.assert_called_once()
+
+
+class TestGetMinBookmarkedDumpId(unittest.TestCase):
+
+    def setUp(self):
+        self.streams = [{"tap_stream_id": "table1"}, {"tap_stream_id": "table2"}]
 
-        expected_should_send_activate_version = True
+    def test_oldest_bookmarked_dump(self):
         state = {
             "bookmarks": {
-                "table1": {
-                    "file": "sync_124/table1/part-00001-GUID.avro",
-                    "version": 1607032341846
-                }
+                "table1": {"file": "sync_124/table1/part-00001-GUID.avro", "version": 1},
+                "table2": {"file": "sync_1000/table2/part-00003-GUID.avro", "version": 1}
             }
         }
-        actual_value = filter_manifests_to_sync(self.manifests, "table1", state)
 
-        self.assertDictEqual(expected_table_manifests, actual_value[0])
-        self.assertEqual(expected_should_send_activate_version, actual_value[1])
+        self.assertEqual(124, get_min_bookmarked_dump_id(self.streams, state))
 
-    def test_has_bookmark_on_false_dump_id(self):
-        self.manifests[123]["table1"]["incremental"] = False
-        self.manifests[124]["table1"]["incremental"] = False
-
-        expected_table_manifests = {
-            124: {"files": ["file1", "file2", "file3"],
-                  "incremental": False,
-                  "columns": ["column1", "column2", "column3"]},
-            125: {"files": ["file1", "file2", "file3"],
-                  "incremental": True,
-                  "columns": ["column1", "column2", "column3"]},
+    def test_stream_without_bookmark_needs_every_manifest(self):
+        state = {
+            "bookmarks": {
+                "table1": {"file": "sync_124/table1/part-00001-GUID.avro", "version": 1}
+            }
         }
 
-        expected_should_send_activate_version = False
+        self.assertIsNone(get_min_bookmarked_dump_id(self.streams, state))
+
+    def test_stream_without_version_needs_every_manifest(self):
         state = {
             "bookmarks": {
-                "table1": {
-                    "file": "sync_124/table1/part-00001-GUID.avro",
-                    "version": 1607032341846
-                }
+                "table1": {"file": "sync_124/table1/part-00001-GUID.avro", "version": 1},
+                "table2": {"file": "sync_125/table2/part-00001-GUID.avro"}
             }
         }
-        actual_value = filter_manifests_to_sync(self.manifests, "table1", state)
 
-        self.assertDictEqual(expected_table_manifests, actual_value[0])
-        self.assertEqual(expected_should_send_activate_version, actual_value[1])
+        self.assertIsNone(get_min_bookmarked_dump_id(self.streams, state))
+
+
+class TestGetDeselectedFields(unittest.TestCase):
+
+    def test_matches_transformer(self):
+        mdata = metadata.to_map([
+            {"breadcrumb": [], "metadata": {"selected": True}},
+            {"breadcrumb": ["properties", "event_id"],
+             "metadata": {"inclusion": "automatic", "selected": False}},
+            {"breadcrumb": ["properties", "selected"],
+             "metadata": {"inclusion": "available", "selected": True}},
+            {"breadcrumb": ["properties", "deselected"],
+             "metadata": {"inclusion": "available", "selected": False}},
+            {"breadcrumb": ["properties", "default"], "metadata": {"inclusion": "available"}},
+            {"breadcrumb": ["properties", "unsupported"], "metadata": {"inclusion": "unsupported"}},
+        ])
+        row = {"event_id": 1, "selected": 2, "deselected": 3, "default": 4, "unsupported": 5,
+               "unknown": 6}
+
+        with Transformer() as transformer:
+            expected_row = transformer.filter_data_by_metadata(dict(row), mdata)
 
-class TestGetFilesToSync(unittest.TestCase):
+        deselected_fields = get_deselected_fields(mdata)
+        self.assertSetEqual({"deselected", "unsupported"}, deselected_fields)
+        self.assertDictEqual(expected_row,
+                             {k: v for k, v in row.items() if k not in deselected_fields})
+
+
+class TestRecordSelector(unittest.TestCase):
 
     def setUp(self):
-        """Note: `fileX` here would look like `"sync_123/table1/part_00013/GUID.avro"`"""
-        self.manifests = {
-            123: {"files": ["s3://bucket1/sync_123/file1", "s3://bucket1/sync_123/file2", "s3://bucket1/sync_123/file3"],
-                  "incremental": False,
-                  "columns": ["column1", "column2", "column3"]},
-            124: {"files": ["s3://bucket1/sync_123/file4", "s3://bucket1/sync_123/file5", "s3://bucket1/sync_123/file6"],
-                  "incremental": True,
-                  "columns": ["column1", "column2", "column3"]},
-            125: {"files": ["s3://bucket1/sync_123/file7", "s3://bucket1/sync_123/file8", "s3://bucket1/sync_123/file9"],
-                  "incremental": True,
-                  "columns": ["column1", "column2", "column3"]},
+        self.stream = {
+            "stream": "table1",
+            "metadata": [
+                {"breadcrumb": [], "metadata": {"selected": True,
+                                                "table-key-properties": ["event_id"]}},
+                {"breadcrumb": ["properties", "event_id"],
+                 "metadata": {"inclusion": "automatic", "selected": False}},
+                {"breadcrumb": ["properties", "time"],
+                 "metadata": {"inclusion": "available", "selected": True}},
+                {"breadcrumb": ["properties", "custom_property"],
+                 "metadata": {"inclusion": "available", "selected": False}},
+            ]
         }
-        self.maxDiff = None
+        self.row = {"event_id": 1, "time": "2021-04-07", "custom_property": "x", "new_column": 2}
 
-    def test_no_bookmark(self):
-        expected_value = ["sync_123/file1",
-                          "sync_123/file2",
-                          "sync_123/file3",
-                          "sync_123/file4",
-                          "sync_123/file5",
-                          "sync_123/file6",
-                          "sync_123/file7",
-                          "sync_123/file8",
-                          "sync_123/file9"]
-        state = {}
-        actual_value = get_files_to_sync(self.manifests, "table1", state, "bucket1")
-
-        self.assertListEqual(expected_value, actual_value)
-
-    def test_has_bookmark(self):
-        expected_value = ["sync_123/file5",
-                          "sync_123/file6",
-                          "sync_123/file7",
-                          "sync_123/file8",
-                          "sync_123/file9"]
-        state = {
-            "bookmarks": {
-                "table1": {
-                    "file": "sync_123/file4",
-                    "version": 1607032341846
-                }
-            }
-        }
-        actual_value = get_files_to_sync(self.manifests, "table1", state, "bucket1")
+    def test_matches_transformer(self):
+        selector = RecordSelector(self.stream)
+        select_fields = selector.compile(list(self.row))
+
+        with Transformer() as transformer:
+            expected_row = transformer.filter_data_by_metadata(
+                dict(self.row), metadata.to_map(self.stream["metadata"]))
+
+        self.assertEqual(["event_id"], selector.key_properties)
+        self.assertDictEqual(expected_row, select_fields(self.row))
+        self.assertListEqual(list(expected_row), list(select_fields(self.row)))
+
+    def test_no_filter_when_nothing_is_dropped(self):
+        selector = RecordSelector(self.stream)
+
+        self.assertIsNone(selector.compile(["event_id", "time", "new_column"]))
+
+
+class FlakyStream():
+    """Reads `data` from `offset`, failing once `fail_at` bytes of the file have been read."""
+
+    def __init__(self, data, offset, fail_at):
+        self.stream = io.BytesIO(data[offset:])
+        self.position = offset
+        self.fail_at = fail_at
+
+    def read(self, size=-1):
+        if self.fail_at is not None and self.position >= self.fail_at:
+            raise ConnectionResetError("Connection reset by peer")
+        data = self.stream.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class TestSyncFileRetries(unittest.TestCase):
+
+    def setUp(self):
+        schema = {"type": "record", "name": "topLevelRecord",
+                  "fields": [{"name": "event_id", "type": "long"}]}
+        self.records = [{"event_id": i} for i in range(1000)]
+        avro_file = io.BytesIO()
+        fastavro.writer(avro_file, schema, self.records, sync_interval=200)
+        self.data = avro_file.getvalue()
+        self.stream = {"stream": "sessions", "metadata": [
+            {"breadcrumb": [], "metadata": {"table-key-properties": ["event_id"]}}]}
+
+    @mock.patch("tap_heap.sync.READ_MAX_BACKOFF", 0)
+    @mock.patch("tap_heap.consumer.put_chunk")
+    def test_resumes_from_the_failed_block_without_duplicates(self, put_chunk):
+        opened_at = []
+        def open_file(_s3_path, offset=0, _length=None):
+            opened_at.append(offset)
+            # Only the first read of the file fails, halfway through
+            fail_at = len(self.data) // 2 if len(opened_at) == 1 else None
+            return FlakyStream(self.data, offset, fail_at)
+        storage = mock.Mock()
+        storage.open_file.side_effect = open_file
+
+        chunks = []
+        put_chunk.side_effect = lambda chunk, *_: chunks.append(list(chunk))
+        file_stats = sync_file(storage, "sync_1/sessions/part-00000-a.avro", self.stream,
+                               chunk_size=7)
+
+        messages = [message for chunk in chunks for message in chunk
+                    if not isinstance(message, StreamSchema)]
+        self.assertEqual(1000, file_stats.records)
+        # The header and the failed block are read again
+        self.assertGreater(file_stats.bytes_read, len(self.data))
+        self.assertEqual("SCHEMA", chunks[0][0].message.asdict()["type"])
+        self.assertListEqual(self.records, [message.record for message in messages[:-1]])
+        self.assertIsInstance(messages[-1], FileSynced)
+        # The retry reads the header again, then makes a ranged GET from the block that failed
+        self.assertListEqual([0, 0], opened_at[:2])
+        self.assertGreater(opened_at[2], 0)
+
+
+class TestSyncFileChunks(unittest.TestCase):
+
+    def setUp(self):
+        schema = {"type": "record", "name": "topLevelRecord",
+                  "fields": [{"name": "event_id", "type": "long"}]}
+        self.records = [{"event_id": i} for i in range(1000)]
+        avro_file = io.BytesIO()
+        fastavro.writer(avro_file, schema, self.records, sync_interval=200)
+        self.storage = mock.Mock()
+        self.storage.open_file.side_effect = \
+            lambda _s3_path, offset=0, _length=None: io.BytesIO(avro_file.getvalue()[offset:])
+        self.stream = {"stream": "sessions", "metadata": [
+            {"breadcrumb": [], "metadata": {"table-key-properties": ["event_id"]}}]}
+
+    @mock.patch("tap_heap.consumer.put_chunk")
+    def test_puts_full_chunks_and_flushes_the_rest_at_the_end_of_the_file(self, put_chunk):
+        chunks = []
+        put_chunk.side_effect = lambda chunk, *_: chunks.append(list(chunk))
+        sync_file(self.storage, "sync_1/sessions/part-00000-a.avro", self.stream, chunk_size=300)
+
+        # Every chunk names its schema, and only the first one carries the SCHEMA message
+        self.assertTrue(all(isinstance(chunk[0], StreamSchema) for chunk in chunks))
+        self.assertIsNotNone(chunks[0][0].message)
+        self.assertTrue(all(chunk[0].message is None for chunk in chunks[1:]))
+        # The schema of a chunk counts towards its size
+        self.assertListEqual([300, 300, 300, 105], [len(chunk) for chunk in chunks])
+        self.assertIsInstance(chunks[-1][-1], FileSynced)
+        self.assertListEqual(self.records,
+                             [message.record for chunk in chunks for message in chunk[1:]
+                              if not isinstance(message, FileSynced)])
+
+    @mock.patch("tap_heap.consumer.put_chunk")
+    def test_flushes_the_marker_after_a_full_last_chunk(self, put_chunk):
+        chunks = []
+        put_chunk.side_effect = lambda chunk, *_: chunks.append(list(chunk))
+        sync_file(self.storage, "sync_1/sessions/part-00000-a.avro", self.stream, chunk_size=201)
 
-        self.assertListEqual(expected_value, actual_value)
+        self.assertListEqual([201] * 5 + [2], [len(chunk) for chunk in chunks])
+        self.assertIsInstance(chunks[-1][-1], FileSynced)
@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+
+from tap_heap import workers
+from tap_heap.workers import WorkerScaler
+
+
+class TestGetAvailableCpus(unittest.TestCase):
+
+    @mock.patch("tap_heap.workers.get_cgroup_cpu_quota", return_value=2.5)
+    @mock.patch("tap_heap.workers.os.sched_getaffinity", return_value=set(range(32)))
+    def test_cgroup_quota_limits_the_affinity(self, *_):
+        self.assertEqual(3, workers.get_available_cpus())
+
+    @mock.patch("tap_heap.workers.get_cgroup_cpu_quota", return_value=None)
+    @mock.patch("tap_heap.workers.os.sched_getaffinity", return_value={0, 1, 2, 3})
+    def test_affinity_without_quota(self, *_):
+        self.assertEqual(4, workers.get_available_cpus())
+        self.assertEqual(3, workers.get_default_max_workers())
+
+    def test_reads_cgroup_v2_quota(self):
+        with mock.patch("builtins.open", mock.mock_open(read_data="150000 100000\n")):
+            self.assertEqual(1.5, workers.get_cgroup_cpu_quota())
+
+        with mock.patch("builtins.open", mock.mock_open(read_data="max 100000\n")):
+            self.assertIsNone(workers.get_cgroup_cpu_quota())
+
+
+class TestWorkerScaler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        patcher = mock.patch("tap_heap.workers.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_interval(self, scaler, records, queue_fill):
+        self.now += scaler.interval
+        scaler.record_completed(records)
+        return scaler.update(queue_fill)
+
+    def test_fixed_bounds_never_change(self):
+        scaler = WorkerScaler(4, 4)
+
+        self.assertEqual(4, self.run_interval(scaler, 1000, 0.0))
+        self.assertEqual(4, self.run_interval(scaler, 1000, 1.0))
+
+    def test_scales_up_while_throughput_grows(self):
+        scaler = WorkerScaler(1, 4)
+
+        self.assertEqual(2, self.run_interval(scaler, 1000, 0.0))
+        self.assertEqual(3, self.run_interval(scaler, 2000, 0.0))
+        self.assertEqual(4, self.run_interval(scaler, 3000, 0.0))
+        self.assertEqual(4, self.run_interval(scaler, 4000, 0.0))
+
+    def test_steps_back_when_a_worker_does_not_pay_off(self):
+        scaler = WorkerScaler(1, 8)
+        self.run_interval(scaler, 1000, 0.0)
+        self.run_interval(scaler, 2000, 0.0)
+
+        self.assertEqual(2, self.run_interval(scaler, 2000, 0.0))
+        # Stays below the plateau for a while before trying again
+        self.assertEqual(2, self.run_interval(scaler, 2000, 0.0))
+
+    def test_scales_down_when_the_consumer_falls_behind(self):
+        scaler = WorkerScaler(1, 4)
+        self.run_interval(scaler, 1000, 0.0)
+
+        self.assertEqual(1, self.run_interval(scaler, 2000, 0.9))
+
+    def test_waits_for_records(self):
+        scaler = WorkerScaler(1, 4)
+
+        self.assertEqual(1, self.run_interval(scaler, 0, 0.0))